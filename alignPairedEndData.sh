@@ -3,6 +3,11 @@
 # Assumes data is already FASTQ formatted with Solexa > v1.3 quality
 # $1 is index prefix, $2 is first FASTQ file, and $3 is second FASTQ for
 # paired-end reads
+#
+# SAM is printed to stdout unless $4 is given; the alignments are then
+# summarized as Bowtie produces them and the read summaries written to $4,
+# with no SAM file. If $5 is also given, the alignments are archived there as
+# BAM.
 
 MIN_LENGTH=100
 MAX_LENGTH=300
@@ -10,11 +15,20 @@ MAX_MISMATCHES=2
 #
 N_THREADS=12
 
-time bowtie --solexa1.3-quals -q \
-    -n $MAX_MISMATCHES --best -M 1 \
-    -I $MIN_LENGTH -X $MAX_LENGTH \
-    --threads $N_THREADS \
-    -S \
-    $1 \
-    -1 $2 -2 $3
+align() {
+    bowtie --solexa1.3-quals -q \
+        -n $MAX_MISMATCHES --best -M 1 \
+        -I $MIN_LENGTH -X $MAX_LENGTH \
+        --threads $N_THREADS \
+        -S \
+        $1 \
+        -1 $2 -2 $3
+}
 
+if [ -z "$4" ]; then
+    time align $1 $2 $3
+else
+    set -o pipefail
+    time align $1 $2 $3 | \
+        parseSAMOutput.py --stream ${5:+--tee-bam=$5} --output=$4 -
+fi
@@ -0,0 +1,153 @@
+#!python
+
+# Load libraries
+import sys, getopt
+
+import numpy as np
+
+import libPipeline
+
+# Set constants
+HELP_MSG = '''
+SYNOPSIS
+    alignmentsToCounts
+    alignmentsToCounts [OPTIONS] SAMFILE
+    #
+DESCRIPTION
+    alignmentsToCounts.py
+
+    Tabulates read centers per base pair and the fragment length distribution
+    directly from SAM/BAM alignments in a single pass, optionally writing the
+    read summaries along the way. Equivalent to running parseSAMOutput.py
+    --stream, readsToChromCounts.py and buildReadLengthDist.py in turn.
+    Use - as SAMFILE to read SAM from stdin (e.g. piped from bowtie).
+    Prints counts to stdout unless --counts or --counts-dir is given.
+
+OPTIONS
+    --counts=           Write counts to file; compressed if it ends in
+                        .gz/.bgz (bgzip) or .zst
+    --lengths=          Write fragment length distribution to file
+    --summary=          Write read summaries to file
+    --binary            Write read summaries in binary format
+    --rmdup             Remove duplicate reads (reduces PCR effects)
+    -r/--randomize      Randomize assignment of ambiguous fragment centers
+    --seed=             Set seed for RNG, giving reproducible counts with
+                        --randomize; initialized from /dev/urandom by
+                        default.
+    --layout=           SAM/BAM file or FASTA index (.fai) giving the
+                        chromosome names and lengths; defaults to yeast
+    --format=           Counts encoding: text (default), sparse, npz or
+                        bedgraph; see readsToChromCounts.py
+    --counts-dir=       Accumulate counts in memory-mapped .npy files in this
+                        directory, one per chromosome
+    --dtype=            Counts type: float64 (default), float32, uint32 or
+                        uint16; integer types require --randomize, except
+                        with --coverage
+    --coverage          Count the fragments covering each base instead of
+                        fragment centers
+    --metrics=          Write stage metrics (records, discards, bytes and time
+                        spent parsing, computing and writing) to file as JSON at
+                        exit
+    --progress=         Print progress to stderr every given number of seconds
+    -h/--help           Print help message and exit
+'''
+
+if __name__ == "__main__":
+  # Set defaults
+  countsFile = None
+  lengthDistFile = None
+  summaryFile = None
+  binary = False
+  rmdup = False
+  randomize = False
+  seed = None
+  chromLayout = libPipeline.DEFAULT_LAYOUT
+  countsFormat = 'text'
+  countsDir = None
+  dtype = 'float64'
+  mode = 'centers'
+  metricsPath = None
+  progressInterval = None
+
+  # Parse arguments
+  options, args = getopt.getopt(sys.argv[1:], "hr",
+                                ["help", "counts=", "lengths=", "summary=",
+                                 "binary", "rmdup", "randomize", "seed=",
+                                 "layout=", "format=", "counts-dir=",
+                                 "dtype=", "coverage", "metrics=",
+                                 "progress="])
+
+  for opt, value in options:
+    if opt in ('-h', "--help"):
+      sys.stderr.write(HELP_MSG)
+      sys.exit(2)
+    elif opt == "--counts":
+      countsFile = libPipeline.openCompressed(value, "wb")
+    elif opt == "--lengths":
+      lengthDistFile = libPipeline.openCompressed(value, "wb")
+    elif opt == "--summary":
+      summaryFile = libPipeline.openCompressed(value, "wb")
+    elif opt == "--binary":
+      binary = True
+    elif opt == "--rmdup":
+      rmdup = True
+    elif opt in ('-r', "--randomize"):
+      randomize = True
+    elif opt == "--seed":
+      seed = int(value)
+    elif opt == "--layout":
+      chromLayout = libPipeline.loadChromLayout(value)
+    elif opt == "--format":
+      if value not in libPipeline.COUNTS_FORMATS:
+        print >> sys.stderr, "Error: unknown format %s" % value
+        sys.exit(1)
+      countsFormat = value
+    elif opt == "--counts-dir":
+      countsDir = value
+    elif opt == "--dtype":
+      if value not in ('float64', 'float32', 'uint32', 'uint16'):
+        print >> sys.stderr, "Error: unsupported dtype %s" % value
+        sys.exit(1)
+      dtype = value
+    elif opt == "--coverage":
+      mode = 'coverage'
+    elif opt == "--metrics":
+      metricsPath = value
+    elif opt == "--progress":
+      progressInterval = float(value)
+    else:
+      print >> sys.stderr, "Error: unknown option %s" % opt
+      sys.exit(1)
+
+  if len(args) > 0:
+    alignmentPath = args[0]
+  else:
+    print >> sys.stderr, "Error -- need path to SAM file"
+    sys.exit(1)
+
+  if countsFile is None and countsDir is None:
+    countsFile = sys.stdout
+
+  if dtype.startswith('uint') and not randomize and mode != 'coverage':
+    print >> sys.stderr, "Error: --dtype=%s requires --randomize" % dtype
+    sys.exit(1)
+
+  # Report metrics as requested
+  metrics = libPipeline.Metrics(progressInterval)
+  if metricsPath is not None:
+    metrics.exportAtExit(metricsPath)
+
+  # Summarize, count and tabulate lengths in one pass
+  libPipeline.alignmentsToCounts(alignmentPath, countsFile, lengthDistFile,
+                                 summaryFile, rmdup=rmdup, randomize=randomize,
+                                 chromLayout=chromLayout,
+                                 countsFormat=countsFormat,
+                                 countsDir=countsDir, dtype=np.dtype(dtype),
+                                 binary=binary, mode=mode, seed=seed,
+                                 metrics=metrics)
+
+  for outFile in (countsFile, lengthDistFile, summaryFile):
+    if outFile is not None:
+      outFile.close()
+
+  sys.exit(0)
@@ -0,0 +1,328 @@
+#!python
+
+# Load libraries
+import sys, os, getopt, time, json, shutil, tempfile
+import subprocess
+import multiprocessing
+import resource
+from distutils.spawn import find_executable
+
+import numpy as np
+import pysam
+
+import libPipeline
+
+# Set constants
+STAGES = ("convert", "bowtie", "sam", "samStream", "bam", "sortedBam",
+          "counts", "lengths")
+
+HELP_MSG = '''
+SYNOPSIS
+    benchmarkPipeline
+    benchmarkPipeline [OPTIONS]
+    #
+DESCRIPTION
+    benchmarkPipeline.py
+
+    Benchmarks each libPipeline stage on synthetic data: Illumina text,
+    Bowtie alignments, SAM, BAM and read summaries for the chosen number of
+    reads
+    (FASTQ is the output of the conversion). Each stage runs in a fresh
+    process; reads/sec, input bytes/sec and peak RSS are reported as JSON,
+    along with the git revision, so runs can be compared between commits.
+
+    Stages are %s. sam (processSAMOutput) requires samtools and is
+    skipped without it; samStream is streamSAMOutput on the same file.
+    bam times processSAMOutput on an unsorted BAM of the same alignments,
+    also requiring samtools; sortedBam on a .sorted.bam, which skips the
+    sort and needs samtools only to index it with more than one process.
+
+OPTIONS
+    -n/--reads=         Number of reads (or pairs) to generate; defaults to
+                        100000
+    --stages=           Comma-separated stages to run; defaults to all
+    -p/--processes=     Processes for convert, sam, bam and sortedBam;
+                        defaults to 1
+    --seed=             Seed for data generation; defaults to 0
+    --work-dir=         Directory for generated data; defaults to a temporary
+                        directory, removed afterwards
+    --output=           Write JSON results to file instead of stdout
+    --compare=          JSON results of an earlier run; exit with status 1 if
+                        any stage's reads/sec fell by more than the tolerance
+    --tolerance=        Allowed fractional slowdown for --compare; defaults to
+                        0.2
+    -h/--help           Print help message and exit
+''' % ', '.join(STAGES)
+
+READ_LENGTH = 36
+BASES = np.array(list('ACGT'))
+QUALITIES = np.array([chr(c) for c in xrange(66, 105)])
+
+def randomStrings(rng, alphabet, n, length):
+  '''Function to draw n random strings of the given length'''
+  chars = alphabet[rng.randint(alphabet.size, size=(n, length))]
+  return np.ascontiguousarray(chars).view('S%d' % length).ravel()
+
+def readBlocks(nReads, seed=0, blockSize=libPipeline.CHUNK_SIZE):
+  '''Generator over blocks of synthetic fragments, as (ids, chromosome
+  index, start, length) arrays. Fragments are 100-300bp, spread uniformly
+  over the yeast genome.'''
+  rng = np.random.RandomState(seed)
+  chromLengths = np.array(libPipeline.CHROM_LENGTHS)
+
+  for first in xrange(0, nReads, blockSize):
+    n = min(blockSize, nReads - first)
+    chroms = rng.randint(chromLengths.size, size=n)
+    lengths = rng.randint(100, 301, size=n)
+    starts = (rng.random_sample(n) *
+              (chromLengths[chroms] - lengths)).astype(np.int64)
+    yield np.arange(first, first + n), chroms, starts, lengths, rng
+
+def writeIllumina(path, nReads, seed=0):
+  '''Function to write synthetic Illumina text for the first mates'''
+  with open(path, 'wb') as outFile:
+    for ids, chroms, starts, lengths, rng in readBlocks(nReads, seed):
+      seqs = randomStrings(rng, BASES, ids.size, READ_LENGTH)
+      quals = randomStrings(rng, QUALITIES, ids.size, READ_LENGTH)
+      outFile.write(''.join(['HWI-BENCH:1:1:%d:%d#0/1:%s:%s\n' %
+                             (i // 1000, i, seq, qual)
+                             for i, seq, qual in zip(ids, seqs, quals)]))
+
+def writeBowtie(path, nReads, seed=0):
+  '''Function to write synthetic paired Bowtie alignments, mates adjacent'''
+  seq = 'A' * READ_LENGTH
+  qual = 'I' * READ_LENGTH
+  with open(path, 'wb') as outFile:
+    for ids, chroms, starts, lengths, rng in readBlocks(nReads, seed):
+      nvalid = rng.randint(4, size=ids.size)
+      outFile.write(''.join([
+          'HWI-BENCH:1:1:%d:%d#0/1\t+\tchr%02d\t%d\t%s\t%s\t%d\t\n'
+          'HWI-BENCH:1:1:%d:%d#0/2\t-\tchr%02d\t%d\t%s\t%s\t%d\t\n' %
+          (i // 1000, i, c + 1, s, seq, qual, v,
+           i // 1000, i, c + 1, s + l - READ_LENGTH, seq, qual, v)
+          for i, c, s, l, v in zip(ids, chroms, starts, lengths, nvalid)]))
+
+def writeSAM(path, nReads, seed=0):
+  '''Function to write synthetic paired SAM alignments, as from bowtie -S'''
+  seq = 'A' * READ_LENGTH
+  qual = 'I' * READ_LENGTH
+  with open(path, 'wb') as outFile:
+    outFile.write('@HD\tVN:1.0\tSO:unsorted\n')
+    for i, chromLength in enumerate(libPipeline.CHROM_LENGTHS):
+      outFile.write('@SQ\tSN:chr%02d\tLN:%d\n' % (i + 1, chromLength))
+
+    for ids, chroms, starts, lengths, rng in readBlocks(nReads, seed):
+      mismatches = rng.randint(3, size=ids.size)
+      outFile.write(''.join([
+          'r%d\t99\tchr%02d\t%d\t255\t%dM\t=\t%d\t%d\t%s\t%s\tXM:i:%d\n'
+          'r%d\t147\tchr%02d\t%d\t255\t%dM\t=\t%d\t%d\t%s\t%s\tXM:i:%d\n' %
+          (i, c + 1, s + 1, READ_LENGTH, s + l - READ_LENGTH + 1, l, seq,
+           qual, m,
+           i, c + 1, s + l - READ_LENGTH + 1, READ_LENGTH, s + 1, -l, seq,
+           qual, m)
+          for i, c, s, l, m in zip(ids, chroms, starts, lengths,
+                                   mismatches)]))
+
+def writeBAM(path, nReads, seed=0):
+  '''Function to write the synthetic SAM alignments as an unsorted BAM'''
+  samPath = path + '.sam'
+  writeSAM(samPath, nReads, seed)
+  try:
+    with pysam.AlignmentFile(samPath, 'r') as inFile:
+      with pysam.AlignmentFile(path, 'wb', template=inFile) as outFile:
+        for read in inFile:
+          outFile.write(read)
+  finally:
+    os.remove(samPath)
+
+def writeSortedBAM(path, nReads, seed=0):
+  '''Function to write the synthetic SAM alignments as a coordinate-sorted
+  BAM'''
+  bamPath = path + '.bam'
+  writeBAM(bamPath, nReads, seed)
+  try:
+    pysam.sort('-O', 'bam', '-o', path, bamPath)
+  finally:
+    os.remove(bamPath)
+
+def writeSummaries(path, nReads, seed=0):
+  '''Function to write synthetic read summaries in text format'''
+  with open(path, 'wb') as outFile:
+    outFile.write(libPipeline.HEADER)
+    for ids, chroms, starts, lengths, rng in readBlocks(nReads, seed):
+      nvalid = rng.randint(4, size=ids.size)
+      outFile.write(''.join([
+          libPipeline.OUTPUT_FORMAT % (c + 1, '+', s, s + l - 1,
+                                       s + (l - 1) / 2., l, v)
+          for c, s, l, v in zip(chroms, starts, lengths, nvalid)]))
+
+# Input generator and file name for each stage
+STAGE_INPUTS = {"convert" : (writeIllumina, "reads.txt"),
+                "bowtie" : (writeBowtie, "alignments.bowtie"),
+                "sam" : (writeSAM, "alignments.sam"),
+                "samStream" : (writeSAM, "alignments.sam"),
+                "bam" : (writeBAM, "alignments.bam"),
+                "sortedBam" : (writeSortedBAM, "alignments.sorted.bam"),
+                "counts" : (writeSummaries, "summaries.txt"),
+                "lengths" : (writeSummaries, "summaries.txt")}
+
+def runStage(stage, inputPath, workDir, nProcesses):
+  '''Function to run a single stage, writing its output in workDir'''
+  outPath = os.path.join(workDir, stage + '.out')
+  with open(outPath, 'wb') as outFile:
+    if stage == "convert":
+      with open(inputPath, 'rb') as dataFile:
+        libPipeline.convertIlluminaToFASTQ(dataFile, outFile, nProcesses)
+    elif stage == "bowtie":
+      libPipeline.processBowtieOutput(open(inputPath, 'rb'), outFile)
+    elif stage in ("sam", "bam", "sortedBam"):
+      libPipeline.processSAMOutput(inputPath, outFile, nProcesses=nProcesses)
+    elif stage == "samStream":
+      libPipeline.streamSAMOutput(inputPath, outFile)
+    elif stage == "counts":
+      with open(inputPath, 'rb') as dataFile:
+        libPipeline.readsToCounts(dataFile, outFile, randomize=False)
+    elif stage == "lengths":
+      with open(inputPath, 'rb') as dataFile:
+        libPipeline.getReadLengthDist(dataFile, outFile)
+
+def timeStage(args):
+  '''Worker function to time a stage in a fresh process. Returns (seconds,
+  peak RSS in KB).'''
+  time_start = time.time()
+  runStage(*args)
+  seconds = time.time() - time_start
+
+  return seconds, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+def benchmarkStage(stage, inputPath, nReads, workDir, nProcesses=1):
+  '''Function to benchmark a stage. Returns a dict of results.'''
+  pool = multiprocessing.Pool(1, maxtasksperchild=1)
+  seconds, peakRSS = pool.apply(timeStage, ((stage, inputPath, workDir,
+                                             nProcesses),))
+  pool.close()
+  pool.join()
+
+  inputBytes = os.path.getsize(inputPath)
+  return {"reads" : nReads, "seconds" : seconds,
+          "readsPerSec" : nReads / seconds, "inputBytes" : inputBytes,
+          "bytesPerSec" : inputBytes / seconds, "peakRSSKB" : peakRSS}
+
+def gitRevision():
+  '''Function to get the git revision of the checkout, or None'''
+  try:
+    return subprocess.check_output(['git', 'rev-parse', 'HEAD'],
+                                   cwd=os.path.dirname(
+                                       os.path.abspath(__file__)),
+                                   stderr=open(os.devnull, 'wb')).strip()
+  except (OSError, subprocess.CalledProcessError):
+    return None
+
+def compareResults(results, baseline, tolerance=0.2):
+  '''Function to compare reads/sec with an earlier run, printing the ratio
+  for each stage. Returns the stages slower than allowed by tolerance.'''
+  regressions = []
+  for stage, result in sorted(results["stages"].iteritems()):
+    old = baseline["stages"].get(stage, {})
+    if "readsPerSec" not in result or "readsPerSec" not in old:
+      continue
+
+    ratio = result["readsPerSec"] / old["readsPerSec"]
+    print >> sys.stderr, '%s: %.2fx baseline reads/sec' % (stage, ratio)
+    if ratio < 1 - tolerance:
+      regressions.append(stage)
+
+  return regressions
+
+if __name__ == "__main__":
+  # Set defaults
+  nReads = 10**5
+  stages = STAGES
+  nProcesses = 1
+  seed = 0
+  workDir = None
+  outFile = sys.stdout
+  baselinePath = None
+  tolerance = 0.2
+
+  # Parse arguments
+  options, args = getopt.getopt(sys.argv[1:], "hn:p:",
+                                ["help", "reads=", "stages=", "processes=",
+                                 "seed=", "work-dir=", "output=", "compare=",
+                                 "tolerance="])
+
+  for opt, value in options:
+    if opt in ('-h', "--help"):
+      sys.stderr.write(HELP_MSG)
+      sys.exit(2)
+    elif opt in ('-n', "--reads"):
+      nReads = int(float(value))
+    elif opt == "--stages":
+      stages = value.split(',')
+      for stage in stages:
+        if stage not in STAGES:
+          print >> sys.stderr, "Error: unknown stage %s" % stage
+          sys.exit(1)
+    elif opt in ('-p', "--processes"):
+      nProcesses = int(value)
+    elif opt == "--seed":
+      seed = int(value)
+    elif opt == "--work-dir":
+      workDir = value
+    elif opt == "--output":
+      outFile = open(value, 'wb')
+    elif opt == "--compare":
+      baselinePath = value
+    elif opt == "--tolerance":
+      tolerance = float(value)
+    else:
+      print >> sys.stderr, "Error: unknown option %s" % opt
+      sys.exit(1)
+
+  removeWorkDir = workDir is None
+  if workDir is None:
+    workDir = tempfile.mkdtemp(prefix='benchmarkPipeline')
+  elif not os.path.isdir(workDir):
+    os.makedirs(workDir)
+
+  results = {"revision" : gitRevision(), "reads" : nReads, "seed" : seed,
+             "processes" : nProcesses, "numpy" : np.__version__,
+             "python" : sys.version.split()[0], "stages" : {}}
+
+  try:
+    for stage in stages:
+      # Generate input once per file, reusing it across stages and runs
+      writer, name = STAGE_INPUTS[stage]
+      inputPath = os.path.join(workDir, '%d.%d.%s' % (nReads, seed, name))
+      if not os.path.exists(inputPath):
+        print >> sys.stderr, 'Generating %s' % inputPath
+        writer(inputPath + '.tmp', nReads, seed)
+        os.rename(inputPath + '.tmp', inputPath)
+
+      # Only the sort and parallel index of processSAMOutput need samtools
+      needsSamtools = (stage in ("sam", "bam") or
+                       (stage == "sortedBam" and nProcesses > 1))
+      if needsSamtools and find_executable('samtools') is None:
+        results["stages"][stage] = {"skipped" : "samtools not found"}
+        continue
+
+      print >> sys.stderr, 'Running %s' % stage
+      results["stages"][stage] = benchmarkStage(stage, inputPath, nReads,
+                                                workDir, nProcesses)
+  finally:
+    if removeWorkDir:
+      shutil.rmtree(workDir, ignore_errors=True)
+
+  json.dump(results, outFile, indent=2, sort_keys=True)
+  outFile.write('\n')
+  outFile.close()
+
+  if baselinePath is not None:
+    with open(baselinePath, 'rb') as baselineFile:
+      baseline = json.load(baselineFile)
+    regressions = compareResults(results, baseline, tolerance)
+    if len(regressions) > 0:
+      print >> sys.stderr, 'Regressions: %s' % ', '.join(regressions)
+      sys.exit(1)
+
+  sys.exit(0)
@@ -9,6 +9,7 @@ helpMsg = '''
 SYNOPSIS
     buildReadLengthDist
     buildReadLengthDist [OPTIONS] [FILE]
+    buildReadLengthDist [OPTIONS] --merge PARTIAL [PARTIAL ...]
     #
 DESCRIPTION
     buildReadLengthDist.py
@@ -16,20 +17,45 @@ DESCRIPTION
     Builds distribution of read lengths from file of raw paired-end data.
     Prints distribution in two-column format to stdout.
     First column is length, second is number of reads with that length.
+    FILE may be a text or binary read summary, optionally gzip/bgzip or zstd
+    compressed.
+    With --merge, sums partial histograms saved with --partial (e.g. one per
+    lane) instead of reading summaries.
 
 OPTIONS
-    -o/--offset=        Offset (number of base pairs read per end);
-                        defaults to 35bp
+    -o/--offset=        Offset (number of base pairs read per end), added
+                        to each length; defaults to 0
+    --max-length=       Longest length tabulated separately; longer fragments
+                        are pooled at this length. Defaults to %d
+    --partial=          Also save the partial histogram to this .npz file
+    --merge             Merge partial histograms given as arguments
+    --layout=           SAM/BAM file or FASTA index (.fai) giving the
+                        chromosome names and lengths; defaults to yeast
+    --output=           Write results to file instead of stdout; compressed
+                        if it ends in .gz/.bgz (bgzip) or .zst
+    --metrics=          Write stage metrics (records, discards, bytes and time
+                        spent parsing, computing and writing) to file as JSON at
+                        exit
+    --progress=         Print progress to stderr every given number of seconds
     -h/--help           Print help message and exit
-'''
+''' % libPipeline.MAX_FRAGMENT_LENGTH
 
 if __name__=="__main__":
     # Set default parameters
     offset = 0
+    outFile = sys.stdout
+    chromLayout = libPipeline.DEFAULT_LAYOUT
+    maxLength = libPipeline.MAX_FRAGMENT_LENGTH
+    partialFile = None
+    merge = False
+    metricsPath = None
+    progressInterval = None
     
     # Parse arguments
     options, args = getopt.getopt(sys.argv[1:], "o:h",
-                                  ["offset=","help"])
+                                  ["offset=","help","output=","layout=",
+                                   "max-length=","partial=","merge",
+                                   "metrics=","progress="])
     #
     for opt, value in options:
         if opt in ('-h', "--help"):
@@ -37,21 +63,57 @@ if __name__=="__main__":
             sys.exit(2)
         elif opt in ('-o', "--offset"):
             offset = int(value)
+        elif opt == "--output":
+            outFile = libPipeline.openCompressed(value, "wb")
+        elif opt == "--layout":
+            chromLayout = libPipeline.loadChromLayout(value)
+        elif opt == "--max-length":
+            maxLength = int(value)
+        elif opt == "--partial":
+            partialFile = value
+        elif opt == "--merge":
+            merge = True
+        elif opt == "--metrics":
+            metricsPath = value
+        elif opt == "--progress":
+            progressInterval = float(value)
         else:
             print >> sys.stderr, "Error -- option %s not recognized" % opt
             sys.exit(1)
     #
+    if merge:
+        if len(args) < 1:
+            print >> sys.stderr, "Error -- need partial histograms to merge"
+            sys.exit(1)
+        try:
+            libPipeline.mergeReadLengthDists(args, outFile)
+        except ValueError as e:
+            print >> sys.stderr, "Error -- %s" % e
+            sys.exit(1)
+        outFile.close()
+        sys.exit(0)
+    #
     if len(args) < 1:
         dataFile = sys.stdin
     else:
         rawDataFilename = args[0]
         try:
-            dataFile = open(rawDataFilename, "rb")
+            dataFile = libPipeline.openCompressed(rawDataFilename, "rb")
         except:
             print >> sys.stderr, "Error -- could not open %s" % rawDataFilename
             sys.exit(1)
     
+    # Report metrics as requested
+    metrics = libPipeline.Metrics(progressInterval)
+    if metricsPath is not None:
+        metrics.exportAtExit(metricsPath)
+
     # Build distribution and write to stdout
-    libPipeline.getReadLengthDist(dataFile, sys.stdout, offset)
+    libPipeline.getReadLengthDist(dataFile, outFile, offset,
+                                  chromLayout=chromLayout,
+                                  maxLength=maxLength,
+                                  partialFile=partialFile,
+                                  metrics=metrics)
+    outFile.close()
     
     sys.exit(0)
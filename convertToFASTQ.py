@@ -16,35 +16,66 @@ DESCRIPTION
 
     Converts Illumina-formatted data (one read per row) to FASTQ.
     Prints result to stdout.
+    FILE may be gzip/bgzip or zstd compressed.
 
 OPTIONS
+    -p/--processes=     Number of processes used for conversion; defaults to 1
+    --output=           Write results to file instead of stdout; compressed
+                        if it ends in .gz/.bgz (bgzip) or .zst
+    --metrics=          Write stage metrics (records, discards, bytes and time
+                        spent parsing, computing and writing) to file as JSON at
+                        exit
+    --progress=         Print progress to stderr every given number of seconds
     -h/--help           Print help message and exit
 '''
 
 
 if __name__ == '__main__':
+    # Set defaults
+    nProcesses = 1
+    metricsPath = None
+    progressInterval = None
+    outFile = sys.stdout
+    
     # Parse arguments
-    options, args = getopt.getopt(sys.argv[1:], 'h', ["help"])
+    options, args = getopt.getopt(sys.argv[1:], 'hp:',
+                                  ["help", "processes=", "output=",
+                                   "metrics=", "progress="])
     
     for opt, value in options:
         if opt in ("-h", "--help"):
             print >> sys.stderr, helpMsg
             sys.exit(2)
+        elif opt in ("-p", "--processes"):
+            nProcesses = int(value)
+        elif opt == "--output":
+            outFile = libPipeline.openCompressed(value, "wb")
+        elif opt == "--metrics":
+            metricsPath = value
+        elif opt == "--progress":
+            progressInterval = float(value)
         else:
             print >> sys.stderr, "Error -- option %s not recognized" % opt
             sys.exit(1)
     
     if len(args) > 0:
         try:
-            dataFile = open(args[0], "rb")
+            dataFile = libPipeline.openCompressed(args[0], "rb")
         except:
             print >> sys.stderr, "Error -- could not open %s" % args[0]
             sys.exit(1)
     else:
         dataFile = sys.stdin
     
+    # Report metrics as requested
+    metrics = libPipeline.Metrics(progressInterval)
+    if metricsPath is not None:
+        metrics.exportAtExit(metricsPath)
+
     # Run conversion and output results to stdout
-    libPipeline.convertIlluminaToFASTQ(dataFile, sys.stdout)
+    libPipeline.convertIlluminaToFASTQ(dataFile, outFile, nProcesses,
+                                       metrics=metrics)
+    outFile.close()
     
     sys.exit(0)
     
\ No newline at end of file
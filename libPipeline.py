@@ -8,9 +8,23 @@ Created on Apr 8, 2011
 import re
 import sys
 import StringIO
-import csv
 import os
 import time
+import itertools
+import collections
+import multiprocessing
+import struct
+import subprocess
+import gzip
+import heapq
+import hashlib
+import shutil
+import tempfile
+import threading
+import contextlib
+import atexit
+import json
+from distutils.spawn import find_executable
 
 import numpy as np
 import pysam
@@ -18,10 +32,18 @@ import pysam
 # Define constants
 ILLUMINA_REGEXP_PAIRED = re.compile(r"(.*#0/[12]):([^:]*):([^:]*)")
 FASTQ_PATTERN = r"@\1\n\2\n+\1\n\3"
+FASTQ_FORMAT = "@%s\n%s\n+%s\n%s%s"
+ILLUMINA_BLOCK_SIZE = 2**22
 
 BOWTIE_FIELDS = ( "name", "strand", "refseq", "offset", "readseq",
                  "readqual", "nvalid", "mismatches" )
 BOWTIE_DELIM = '\t'
+BOWTIE_OPTIONS = ("--solexa1.3-quals", "-q", "-n", "2", "--best", "-M", "1",
+                  "-I", "100", "-X", "300")
+BOWTIE_EXIT_TIMEOUT = 5.
+(BOWTIE_NAME, BOWTIE_REFSEQ, BOWTIE_OFFSET, BOWTIE_READSEQ,
+ BOWTIE_NVALID) = [BOWTIE_FIELDS.index(field) for field in
+                   ("name", "refseq", "offset", "readseq", "nvalid")]
 
 ID_RE = re.compile(r"(.+)#.+")
 
@@ -32,6 +54,13 @@ HEADER = BOWTIE_DELIM.join(OUTPUT_FIELDS) + os.linesep
 OUTPUT_FORMAT = BOWTIE_DELIM.join(("%s", "%s", "%d", "%d", "%.1f", "%d", "%d"))
 OUTPUT_FORMAT += os.linesep
 
+SUMMARY_DTYPE = np.dtype([("chromosome", "<u2"), ("strand", "S1"),
+                          ("start", "<i4"), ("end", "<i4"),
+                          ("center", "<f8"), ("length", "<i4"),
+                          ("nvalid", "<i4")])
+SUMMARY_MAGIC = "\x93RSUM\x01\x00\x00"
+SUMMARY_TRAILER = struct.Struct("<Q8s")
+
 CHROM_RE = re.compile(r"[0-9]+")
 CHROM_DELIM = ','
 
@@ -40,116 +69,682 @@ XM_RE = re.compile(r"XM:i:([0-9]+)")
 CHROM_LENGTHS = (230208,813178,316617,1531919,576869,270148,1090947,562643,
                  439885,745741,666454,1078175,924429,784334,1091289,948062)
 NCHROM = len(CHROM_LENGTHS)
+DEFAULT_LAYOUT = collections.OrderedDict((str(i+1), CHROM_LENGTHS[i])
+                                         for i in xrange(NCHROM))
+
+GROUP_MAX_MASKS = 16
+CHUNK_SIZE = 2**16
+
+COUNTS_FORMATS = ("text", "sparse", "npz", "bedgraph")
+COUNTS_MODES = ("centers", "coverage")
+COUNTS_LAYOUT_FILE = "layout.txt"
+BINCOUNT_MAX_SPAN = 64
+
+MAX_DUP_KEYS = 2**20
+MAX_UNPAIRED_MATES = 2**20
+MAX_FRAGMENT_LENGTH = 2**12
+
+FastqRecord = collections.namedtuple("FastqRecord",
+                                     ("name", "sequence", "quality"))
+
+COMPRESSION_MAGIC = (("\x1f\x8b", "gzip"), ("\x28\xb5\x2f\xfd", "zstd"))
+COMPRESSION_EXTENSIONS = {".gz" : "gzip", ".bgz" : "gzip", ".zst" : "zstd"}
+DECOMPRESS_COMMANDS = {"gzip" : (("pigz", "-dc"), ("gzip", "-dc")),
+                       "zstd" : (("zstd", "-dcq"),)}
+COMPRESS_COMMANDS = {"gzip" : (("bgzip", "-c"),),
+                     "zstd" : (("zstd", "-cq"),)}
+
+CACHE_MAX_BYTES = 2**34
+HASH_BLOCK_SIZE = 2**20
+
+INDEX_MAGIC = "\x93RIDX\x01\x00\x00"
+INDEX_DTYPES = ("<i4", "<i4", "<i8")
+REGION_INDEX_SUFFIX = ".idx"
+COUNTS_INDEX_SUFFIX = ".idx.npz"
+COUNTS_INDEX_STEP = 2**12
+
+TRACK_BIN_SIZES = (10, 50, 1000)
+SMOOTH_TRUNCATE = 4.
+SMOOTH_FFT_SIZE = 2**13
+REGION_RE = re.compile(r"^(.+?)(?::([0-9,]+)(?:-([0-9,]+))?)?$")
+
+class PipeFile:
+  '''
+  File-like wrapper around a (de)compression subprocess, so compression runs
+  concurrently with parsing. Closing waits for the subprocess to finish.
+  '''
+  def __init__(self, process, fileObj, name, mode):
+    self.process = process
+    self.fileObj = fileObj
+    self.name = name
+    self.mode = mode
+
+  def __getattr__(self, attr):
+    return getattr(self.fileObj, attr)
+
+  def __iter__(self):
+    return iter(self.fileObj)
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *args):
+    self.close()
+
+  def close(self):
+    # Stop decompression quietly if input was not read to the end
+    if 'r' in self.mode and self.process.poll() is None:
+      self.process.terminate()
+
+    self.fileObj.close()
+    status = self.process.wait()
+    if 'w' in self.mode and status != 0:
+      raise IOError('Compression of %s failed with status %d' % (self.name,
+                                                                 status))
+
+class CountingFile:
+  '''
+  File-like wrapper counting the bytes written through it in nBytes.
+  '''
+  def __init__(self, fileObj):
+    self.fileObj = fileObj
+    self.nBytes = 0
+
+  def __getattr__(self, attr):
+    return getattr(self.fileObj, attr)
+
+  def write(self, data):
+    self.fileObj.write(data)
+    self.nBytes += len(data)
+
+def getCompression(path):
+  '''Function to detect compression of a file from its magic bytes, or
+  from its extension if it does not exist yet. Returns 'gzip' (including
+  bgzip), 'zstd' or None.'''
+  if os.path.isfile(path):
+    with open(path, 'rb') as f:
+      magic = f.read(4)
+    for prefix, compression in COMPRESSION_MAGIC:
+      if magic.startswith(prefix):
+        return compression
+    return None
+
+  return COMPRESSION_EXTENSIONS.get(os.path.splitext(path)[1].lower())
+
+def openCompressed(path, mode='rb'):
+  '''Function to open a possibly compressed file. Compression is detected
+  from magic bytes when reading and from the extension when writing; gzip
+  output is written as bgzip so it stays block-seekable. (De)compression runs
+  in a subprocess where possible. Returns a file-like object.'''
+  if 'r' in mode:
+    compression = getCompression(path)
+    commands = DECOMPRESS_COMMANDS
+  else:
+    compression = COMPRESSION_EXTENSIONS.get(os.path.splitext(path)[1].lower())
+    commands = COMPRESS_COMMANDS
+
+  if compression is None:
+    return open(path, mode)
+
+  # Find first available command
+  command = None
+  for candidate in commands[compression]:
+    if find_executable(candidate[0]) is not None:
+      command = list(candidate)
+      break
+
+  # Fall back to in-process (de)compression
+  if command is None:
+    if compression != 'gzip':
+      raise IOError('No %s executable found for %s' % (compression, path))
+    if 'r' in mode:
+      return gzip.open(path, mode)
+    return pysam.BGZFile(path, mode)
+
+  if 'r' in mode:
+    process = subprocess.Popen(command + [path], stdout=subprocess.PIPE,
+                               bufsize=-1)
+    return PipeFile(process, process.stdout, path, mode)
+
+  with open(path, mode) as outFile:
+    process = subprocess.Popen(command, stdin=subprocess.PIPE, stdout=outFile,
+                               bufsize=-1)
+  return PipeFile(process, process.stdin, path, mode)
+
+class JobCancelled(Exception):
+  '''Raised from Metrics.add once a stage's metrics have been cancelled'''
+  pass
+
+class Metrics:
+  '''
+  Counters and timers that pipeline stages report into, e.g.
+  metrics.add('sam', 'recordsIn', n) or "with metrics.timer('sam', 'write')".
+  Stages time their parse, write and total phases; compute is the rest.
+
+  snapshot() is safe to poll from another thread (e.g. the GUI) while a stage
+  runs, and writeJSON() or exportAtExit() export everything. If
+  progressInterval is given, records in and records/sec are printed to
+  progressFile at most once per progressInterval seconds, or passed to
+  onProgress(stage, stageMetrics) instead if it is given.
+
+  cancel() may also be called from another thread; the stage reporting into
+  these metrics then stops with JobCancelled at its next add().
+  '''
+  def __init__(self, progressInterval=None, progressFile=sys.stderr,
+               onProgress=None):
+    self.progressInterval = progressInterval
+    self.progressFile = progressFile
+    self.onProgress = onProgress
+    self.cancelled = threading.Event()
+    self.lock = threading.Lock()
+    self.startTime = time.time()
+    self.lastProgress = self.startTime
+    self.stages = collections.OrderedDict()
+
+  def _getStage(self, stage):
+    if stage not in self.stages:
+      self.stages[stage] = (time.time(), collections.defaultdict(int),
+                            collections.defaultdict(float))
+    return self.stages[stage]
+
+  def add(self, stage, counter, n=1):
+    '''Add n to a counter for a stage'''
+    if self.cancelled.is_set():
+      raise JobCancelled('%s cancelled' % stage)
+
+    with self.lock:
+      self._getStage(stage)[1][counter] += n
+
+    if counter == 'recordsIn' and self.progressInterval is not None:
+      self.progress(stage)
+
+  @contextlib.contextmanager
+  def timer(self, stage, phase):
+    '''Context manager adding the time spent in its block to a phase'''
+    time_start = time.time()
+    with self.lock:
+      self._getStage(stage)
+    try:
+      yield
+    finally:
+      with self.lock:
+        self._getStage(stage)[2][phase] += time.time() - time_start
+
+  def timeIter(self, stage, phase, iterable):
+    '''Generator passing through iterable, timing each step as phase'''
+    iterator = iter(iterable)
+    while True:
+      with self.timer(stage, phase):
+        try:
+          item = next(iterator)
+        except StopIteration:
+          return
+      yield item
+
+  def progress(self, stage):
+    '''Print progress for a stage if progressInterval has passed'''
+    now = time.time()
+    if now - self.lastProgress < self.progressInterval:
+      return
+    self.lastProgress = now
+
+    stageMetrics = self.snapshot()['stages'][stage]
+    if self.onProgress is not None:
+      self.onProgress(stage, stageMetrics)
+      return
+
+    print >> self.progressFile, '%s: %d records in, %.0f records/sec' % (
+        stage, stageMetrics['recordsIn'], stageMetrics['recordsPerSec'])
+
+  def cancel(self):
+    '''Stop the stage reporting into these metrics at its next add()'''
+    self.cancelled.set()
+
+  def snapshot(self):
+    '''Return a copy of all metrics as a dictionary, by stage'''
+    with self.lock:
+      now = time.time()
+      stages = collections.OrderedDict()
+      for stage, (stageStart, counters, timers) in self.stages.iteritems():
+        stageMetrics = dict(counters)
+        seconds = dict(timers)
+        if 'total' in seconds:
+          seconds['compute'] = max(0., seconds['total'] -
+                                   seconds.get('parse', 0.) -
+                                   seconds.get('write', 0.))
+        stageMetrics['seconds'] = seconds
+        stageMetrics['recordsPerSec'] = (counters['recordsIn'] /
+                                         max(seconds.get('total',
+                                                         now - stageStart),
+                                             1e-9))
+        stages[stage] = stageMetrics
+
+    return {'elapsed' : now - self.startTime, 'stages' : stages}
+
+  def writeJSON(self, outFile):
+    '''Write a snapshot of all metrics to a file or path as JSON'''
+    if isinstance(outFile, basestring):
+      with open(outFile, 'wb') as f:
+        return self.writeJSON(f)
+
+    json.dump(self.snapshot(), outFile, indent=2)
+    outFile.write('\n')
+
+  def exportAtExit(self, path):
+    '''Write metrics to path as JSON when the interpreter exits'''
+    atexit.register(self.writeJSON, path)
+
+class StageCache:
+  '''
+  Cache of pipeline stage outputs in cacheDir, keyed by a hash of the stage
+  name, its input files and its parameters. Inputs are fingerprinted by size
+  and mtime (with their path), or by a hash of their content if hashContent
+  is set (slower, but survives copies and touches).
 
-def convertIlluminaToFASTQ(dataFile, outFile):
-  '''Function to convert file from Illumina to FASTQ format'''
+  Each entry is a directory of output files, named by their position in the
+  list of outputs. Entries are evicted least
+  recently used first once their total size exceeds maxBytes.
+  '''
+  def __init__(self, cacheDir, maxBytes=CACHE_MAX_BYTES, hashContent=False):
+    self.cacheDir = cacheDir
+    self.maxBytes = maxBytes
+    self.hashContent = hashContent
+    if not os.path.isdir(cacheDir):
+      os.makedirs(cacheDir)
+
+  def fingerprint(self, path):
+    '''Fingerprint of a single input file'''
+    if not self.hashContent:
+      stat = os.stat(path)
+      return '%s:%d:%r' % (os.path.abspath(path), stat.st_size, stat.st_mtime)
+
+    digest = hashlib.sha1()
+    with open(path, 'rb') as f:
+      for block in iter(lambda: f.read(HASH_BLOCK_SIZE), ''):
+        digest.update(block)
+    return digest.hexdigest()
+
+  def key(self, stage, inputs, params=None):
+    '''Key for a stage run on the given input paths with the given
+    parameters, a dict of values with stable reprs'''
+    digest = hashlib.sha1(stage)
+    for path in inputs:
+      digest.update('\0' + self.fingerprint(path))
+    if params is not None:
+      digest.update('\0' + repr(sorted(params.items())))
+    return digest.hexdigest()
+
+  def fetch(self, key, outputs):
+    '''Copy cached outputs for key to the given paths, unless already there
+    (same size and mtime). Returns True on a hit, False if any output is
+    missing from the cache.'''
+    entry = os.path.join(self.cacheDir, key)
+    try:
+      for i, path in enumerate(outputs):
+        cachedPath = os.path.join(entry, str(i))
+        cachedStat = os.stat(cachedPath)
+        if os.path.exists(path):
+          stat = os.stat(path)
+          if (stat.st_size == cachedStat.st_size and
+              stat.st_mtime == cachedStat.st_mtime):
+            continue
+        shutil.copy2(cachedPath, path)
+      os.utime(entry, None)
+    except (IOError, OSError):
+      return False
+
+    return True
+
+  def store(self, key, outputs):
+    '''Copy outputs into the cache under key, then evict old entries. If
+    an entry for key already exists (e.g. another sample made the same
+    outputs), the outputs are matched to it instead, as by fetch, so that
+    keys computed from them downstream agree.'''
+    entry = os.path.join(self.cacheDir, key)
+    if os.path.isdir(entry):
+      self.fetch(key, outputs)
+      return
+
+    # Fill a temporary entry so concurrent readers never see a partial one
+    tmpEntry = tempfile.mkdtemp(dir=self.cacheDir, prefix='.tmp')
+    try:
+      for i, path in enumerate(outputs):
+        shutil.copy2(path, os.path.join(tmpEntry, str(i)))
+        # Match mtimes exactly, as copies may lose sub-microsecond precision
+        shutil.copystat(os.path.join(tmpEntry, str(i)), path)
+      os.rename(tmpEntry, entry)
+    except (IOError, OSError):
+      shutil.rmtree(tmpEntry, ignore_errors=True)
+
+      # Another process may have stored the entry first
+      if os.path.isdir(entry):
+        self.fetch(key, outputs)
+
+    self.evict()
+
+  def evict(self):
+    '''Remove least recently used entries until within maxBytes'''
+    entries = []
+    totalBytes = 0
+    for key in os.listdir(self.cacheDir):
+      entry = os.path.join(self.cacheDir, key)
+      if key.startswith('.') or not os.path.isdir(entry):
+        continue
+      try:
+        nBytes = sum(os.path.getsize(os.path.join(entry, name))
+                     for name in os.listdir(entry))
+        entries.append( (os.path.getmtime(entry), nBytes, entry) )
+      except OSError:
+        continue
+      totalBytes += nBytes
+
+    for mtime, nBytes, entry in sorted(entries):
+      if totalBytes <= self.maxBytes:
+        break
+      shutil.rmtree(entry, ignore_errors=True)
+      totalBytes -= nBytes
+
+def runCachedCommand(command, stage, inputPath, outputPath, cache=None):
+  '''Function to run a shell command making outputPath from inputPath. If
+  cache is given, the output is restored from it when inputPath is unchanged,
+  and stored in it after a successful run. Returns the command's exit
+  status (0 on a cache hit).'''
+  if cache is not None:
+    key = cache.key(stage, [inputPath])
+    if cache.fetch(key, [outputPath]):
+      print >> sys.stderr, 'Using cached %s of %s' % (stage, inputPath)
+      return 0
+
+  status = os.system(command)
+  if cache is not None and status == 0:
+    cache.store(key, [outputPath])
+
+  return status
+
+def convertIlluminaToFASTQ(dataFile, outFile, nProcesses=1,
+                           blockSize=ILLUMINA_BLOCK_SIZE, metrics=None):
+  '''Function to convert file from Illumina to FASTQ format. Input is read in
+  blocks of about blockSize bytes; if nProcesses > 1, blocks are converted in
+  a process pool and written back in order. Reports to metrics (a Metrics)
+  as stage 'convert', if given.'''
+  if metrics is None:
+    metrics = Metrics()
+
+  blocks = metrics.timeIter('convert', 'parse',
+                            iter(lambda: dataFile.readlines(blockSize), []))
+
+  with metrics.timer('convert', 'total'):
+    if nProcesses > 1:
+      # Convert a bounded batch of blocks at a time to limit memory use
+      pool = multiprocessing.Pool(nProcesses)
+      while True:
+        batch = list(itertools.islice(blocks, 2*nProcesses))
+        if len(batch) == 0:
+          break
+        for lines, converted in zip(batch,
+                                    pool.map(convertIlluminaBlock, batch)):
+          writeFASTQBlock(lines, converted, outFile, metrics)
+      pool.close()
+      pool.join()
+    else:
+      for lines in blocks:
+        writeFASTQBlock(lines, convertIlluminaBlock(lines), outFile, metrics)
+
+  return 0
+
+def convertIlluminaBlock(lines):
+  '''Function to convert a list of Illumina-formatted lines to FASTQ via
+  iterIlluminaRecords and formatFASTQ. Returns the converted block as a
+  single string and the number of records in it.'''
+  records = list(iterIlluminaRecords(lines))
+  return formatFASTQ(records), len(records)
+
+def writeFASTQBlock(lines, converted, outFile, metrics):
+  '''Function to write a block converted by convertIlluminaBlock, reporting
+  its records and bytes to metrics'''
+  out, nRecords = converted
+  with metrics.timer('convert', 'write'):
+    outFile.write(out)
+
+  metrics.add('convert', 'recordsIn', len(lines))
+  metrics.add('convert', 'recordsOut', nRecords)
+  metrics.add('convert', 'discardedMalformed', len(lines) - nRecords)
+  metrics.add('convert', 'bytesRead', sum(itertools.imap(len, lines)))
+  metrics.add('convert', 'bytesWritten', len(out))
+
+def iterIlluminaRecords(dataFile):
+  '''Generator over FastqRecord tuples for the Illumina-formatted reads in
+  dataFile (any iterable of lines).'''
   for line in dataFile:
     match = ILLUMINA_REGEXP_PAIRED.match(line)
     if match:
-      out = ILLUMINA_REGEXP_PAIRED.sub(FASTQ_PATTERN, line)
-      outFile.write(out)
+      readId, readSeq, readQual = match.groups()
+      yield FastqRecord(readId, readSeq, readQual.rstrip('\r\n'))
+
+def writeFASTQ(records, outFile):
+  '''Function to write FastqRecord tuples to outFile in FASTQ format.
+  Returns the number of records written.'''
+  records = iter(records)
+  nRecords = 0
+  for block in iter(lambda: list(itertools.islice(records, CHUNK_SIZE)), []):
+    outFile.write(formatFASTQ(block))
+    nRecords += len(block)
 
-    return 0
+  return nRecords
 
-def processBowtieOutput(alignmentFile, outFile, pairedEnd=True):
+def formatFASTQ(records):
+  '''Function to format a list of FastqRecord tuples as a FASTQ string'''
+  return ''.join([FASTQ_FORMAT % (record.name, record.sequence, record.name,
+                                  record.quality, '\n')
+                  for record in records])
+
+def bowtieCommand(indexBase, fastqPaths, options=BOWTIE_OPTIONS, nThreads=1,
+                  sam=True):
+  '''Function to build the argument list for a Bowtie run on one (single-end)
+  or two (paired-end) FASTQ files. Output is SAM if sam is set, otherwise
+  Bowtie's standard format.'''
+  cmd = ['bowtie'] + list(options) + ['--threads', str(nThreads)]
+  if sam:
+    cmd.append('-S')
+  cmd.append(indexBase)
+
+  if len(fastqPaths) > 1:
+    cmd += ['-1', fastqPaths[0], '-2', fastqPaths[1]]
+  else:
+    cmd.append(fastqPaths[0])
+
+  return cmd
+
+def processBowtieOutput(alignmentFile, outFile, pairedEnd=True, binary=False,
+                        maxUnpaired=MAX_UNPAIRED_MATES, tempDir=None,
+                        metrics=None):
   '''Function to convert Bowtie output (standard format, not SAM) to read
   summaries. Takes alignment file and output file-like object as argument.
-  Returns completion code.'''
-  # Print header
-  outFile.write(HEADER)
-
-  # Setup DictReader to pull structured lines from Bowtie output file
-  alignmentReader = csv.DictReader( alignmentFile, fieldnames=BOWTIE_FIELDS,
-                                   delimiter=BOWTIE_DELIM )
-
-  # Initialize alignments
-  align2 = None
-  align1 = alignmentReader.next()
-
-  # Initialize ID values
-  idMatch = ID_RE.match( align1['name'] )
-  if idMatch is None:
-    id1 = align1['name']
-  else:
-    id1 = idMatch.group(1)
-
-  # If not paired-end, write first summary
-  if not pairedEnd:
-    output = combineAlignments(align1)
-    outFile.write( OUTPUT_FORMAT % output )
-
-  # Iterate through lines of file
-  for line in alignmentReader:
-    # Get next alignment from input
-    align2 = align1
-    id2 = id1
-    align1 = line
-
-    # Extract new ID
-    idMatch = ID_RE.match( align1['name'] )
-    if idMatch is None:
-      id1 = align1['name']
-    else:
-      id1 = idMatch.group(1)
-
-    # Check if IDs match (paired-end)
-    if pairedEnd:
-      if id1 == id2:
-        # If they do, combine the two alignments & print result
-        output = combineAlignments( align1, align2 )
-        outFile.write( OUTPUT_FORMAT % output )
-      else:
-        output = combineAlignments(align1)
-        outFile.write( OUTPUT_FORMAT % output )
+  If binary is set, summaries are written in the binary format. Mates need
+  not be adjacent; see iterBowtieSummaries for maxUnpaired and tempDir.
+  Reports to metrics as stage 'bowtie', if given. Returns completion code.'''
+  if metrics is None:
+    metrics = Metrics()
 
+  with metrics.timer('bowtie', 'total'):
+    writeSummaries(iterBowtieSummaries(alignmentFile, pairedEnd, maxUnpaired,
+                                       tempDir, metrics),
+                   outFile, binary, metrics, 'bowtie')
   alignmentFile.close()
 
   return 0
 
-def combineAlignments( *args ):
-  '''Function to combine paired-end alignments into single summary of read.
-  Takes parsed alignment dictionaries as inputs, returns read summary tuple.'''
-  limits = []
-  chromList = []
-  nvalidList = []
-  for align in args:
-    # Find limits of reads
-    start = int(align['offset'])
-    readLen = len(align['readseq'])
-    limits.append( (start, start+readLen) )
-
-    # Extract chromosome ID
-    match = CHROM_RE.search(align['refseq'])
+def iterBowtieSummaries(alignmentFile, pairedEnd=True,
+                        maxUnpaired=MAX_UNPAIRED_MATES, tempDir=None,
+                        metrics=None):
+  '''Generator over read summary tuples for Bowtie output (standard format,
+  not SAM). alignmentFile may be any iterable of lines.
+
+  For paired-end data, mates are matched by read ID in any order. Mates
+  waiting for their partner are held in memory; beyond maxUnpaired of them,
+  they are spilled to sorted run files in tempDir and paired by merging the
+  runs at the end. Mates whose partner never appears are discarded.
+
+  Lines read and discarded are reported to metrics as stage 'bowtie'.'''
+  if metrics is None:
+    metrics = Metrics()
+
+  # Cache chromosome labels by refseq
+  chromCache = {}
+
+  # Iterate through lines of file, counting locally between reports
+  unpaired = {}
+  runs = []
+  nLines = nBytes = nMalformed = 0
+  for line in alignmentFile:
+    nLines += 1
+    nBytes += len(line)
+    if nLines == CHUNK_SIZE:
+      metrics.add('bowtie', 'bytesRead', nBytes)
+      metrics.add('bowtie', 'recordsIn', nLines)
+      nLines = nBytes = 0
+
+    # Get next alignment from input, skipping blank lines
+    fields = line.rstrip('\r\n').split(BOWTIE_DELIM)
+    if len(fields) <= BOWTIE_NVALID:
+      nMalformed += 1
+      continue
+
+    readId, align = parseBowtieAlignment(fields, chromCache)
+    if not pairedEnd:
+      yield combineParsedAlignments(align)
+      continue
+
+    # Combine with waiting mate if present
+    mate = unpaired.pop(readId, None)
+    if mate is not None:
+      yield combineParsedAlignments(align, mate)
+      continue
+
+    unpaired[readId] = align
+    if len(unpaired) > maxUnpaired:
+      runs.append(_spillMates(unpaired, tempDir))
+      unpaired = {}
+
+  metrics.add('bowtie', 'bytesRead', nBytes)
+  metrics.add('bowtie', 'recordsIn', nLines)
+  metrics.add('bowtie', 'discardedMalformed', nMalformed)
+
+  # Pair spilled mates by merging sorted runs
+  nUnpaired = len(unpaired)
+  if len(runs) > 0:
+    runs.append(_spillMates(unpaired, tempDir))
+    nUnpaired = 0
+    lastId = None
+    for mate in heapq.merge(*[_iterMates(run) for run in runs]):
+      if mate[0] == lastId:
+        yield combineParsedAlignments(mate[1:], lastMate)
+        lastId = None
+        nUnpaired -= 1
+      else:
+        lastId = mate[0]
+        lastMate = mate[1:]
+        nUnpaired += 1
+
+    for run in runs:
+      run.close()
+
+  metrics.add('bowtie', 'discardedUnpaired', nUnpaired)
+
+def _spillMates(unpaired, tempDir=None):
+  '''Function to write unpaired mates to a temporary file sorted by read
+  ID. Returns the file, rewound for reading.'''
+  run = tempfile.TemporaryFile(dir=tempDir)
+  for readId in sorted(unpaired):
+    chrom, start, end, nvalid = unpaired[readId]
+    run.write('%s\t%s\t%d\t%d\t%d\n' % (readId, chrom, start, end, nvalid))
+  run.seek(0)
+
+  return run
+
+def _iterMates(run):
+  '''Generator over (readId, chrom, start, end, nvalid) tuples from a run
+  written by _spillMates'''
+  for line in run:
+    readId, chrom, start, end, nvalid = line.rstrip('\n').split('\t')
+    yield (readId, chrom, int(start), int(end), int(nvalid))
+
+def parseBowtieAlignment(fields, chromCache):
+  '''Function to parse a single Bowtie alignment from its list of fields.
+  Returns (readID, (chrom, start, end, nvalid)), caching chromosome labels
+  by refseq in chromCache.'''
+  # Extract read ID
+  name = fields[BOWTIE_NAME]
+  idMatch = ID_RE.match(name)
+  if idMatch is not None:
+    name = idMatch.group(1)
+
+  # Extract chromosome ID
+  refseq = fields[BOWTIE_REFSEQ]
+  chrom = chromCache.get(refseq)
+  if chrom is None:
+    match = CHROM_RE.search(refseq)
     if match is None:
-      chromList.append( align['refseq'] )
+      chrom = refseq
     else:
-      chromList.append( align['refseq'][match.start():match.end()] )
+      chrom = match.group(0)
+    chromCache[refseq] = chrom
+
+  # Find limits of read
+  start = int(fields[BOWTIE_OFFSET])
+  end = start + len(fields[BOWTIE_READSEQ])
+
+  return name, (chrom, start, end, int(fields[BOWTIE_NVALID]))
+
+def combineParsedAlignments( *args ):
+  '''Function to combine parsed alignments from parseBowtieAlignment into
+  single summary of read. Returns read summary tuple.'''
+  chrom, start, end, nvalid = args[0]
+  chromList = [chrom]
+  for align in args[1:]:
+    # Combine limits and nvalid information
+    start = min(start, align[1])
+    end = max(end, align[2])
+    nvalid += align[3]
 
-    # Get number of valid alignments
-    nvalidList.append( int(align['nvalid']) )
+    if align[0] != chrom:
+      chromList.append(align[0])
 
-    # Combine limits
-    limits = np.array(limits)
-    start = limits.min()
-    end = limits.max()+1
-    length = limits.ptp()
-    center = start + length/2.0
+  # Combine chromosomes
+  if len(chromList) > 1:
+    chrom = CHROM_DELIM.join(set(chromList))
 
-    # Combine chromosomes
-    chromSet = set(chromList)
-    chrom = CHROM_DELIM.join(chromSet)
+  length = end - start
+  center = start + length/2.0
 
-    # Combine nvalid information
-    nvalid = np.array( nvalidList ).sum()
+  return (chrom, '+', start, end+1, center, length, nvalid)
 
-    # Build tuple of return values
-    retval = (chrom, '+', start, end, center, length, nvalid)
+def combineAlignments( *args ):
+  '''Function to combine paired-end alignments into single summary of read.
+  Takes parsed alignment dictionaries as inputs, returns read summary tuple.'''
+  chromCache = {}
+  aligns = [parseBowtieAlignment([align[field] for field in BOWTIE_FIELDS],
+                                 chromCache)[1] for align in args]
 
-    return retval
+  return combineParsedAlignments(*aligns)
 
-def processSAMOutput(alignmentPath, outFile, pairedEnd=True, rmdup=False):
+def processSAMOutput(alignmentPath, outFile, pairedEnd=True, rmdup=False,
+                     nProcesses=1, windowSize=None, binary=False, cache=None,
+                     metrics=None):
   '''Function to convert SAM output to read summaries. Takes alignment file and
-  output file-like object as argument. Returns completion code.'''
+  output file-like object as argument. If binary is set, summaries are written
+  in the binary format. Returns completion code.
+
+  If cache (a StageCache) is given, the samtools conversion, sort and rmdup
+  outputs are restored from it when their input is unchanged.
+
+  If nProcesses > 1, the sorted BAM is indexed and summarized in parallel,
+  one shard per reference or per windowSize bp window within each reference.
+  Shards are merged in order, so output matches the serial run.
+
+  Alignments read and discarded are reported to metrics as stage 'sam'.'''
+  if metrics is None:
+    metrics = Metrics()
 
   # Strip file extension from path
   file_name, file_ext = os.path.splitext(alignmentPath)
@@ -160,14 +755,16 @@ def processSAMOutput(alignmentPath, outFile, pairedEnd=True, rmdup=False):
   # Make into sorted BAM file
   inputPath = alignmentPath
   if file_ext.lower() != '.bam':
-    os.system('samtools view -bS -o %s %s' %
-              (file_base + '.bam', alignmentPath))
+    runCachedCommand('samtools view -bS -o %s %s' %
+                     (file_base + '.bam', alignmentPath),
+                     'samtools view', alignmentPath, file_base + '.bam', cache)
     inputPath = file_base + '.bam'
   
   if ((file_ext.lower() != '.bam') or
       (file_special.lower() not in ('.sorted', '.unique'))):
-    os.system('samtools sort %s %s.sorted' % 
-              (inputPath, file_base))
+    runCachedCommand('samtools sort %s %s.sorted' % (inputPath, file_base),
+                     'samtools sort', inputPath, file_base + '.sorted.bam',
+                     cache)
     inputPath = file_base + '.sorted.bam'
   else:
     print >> sys.stderr, 'Skipping sorting due to %s extension' % (file_special
@@ -175,118 +772,1854 @@ def processSAMOutput(alignmentPath, outFile, pairedEnd=True, rmdup=False):
 
   # Remove duplicates if requested
   if rmdup and file_special.lower() != '.unique':
-    os.system('samtools rmdup %s %s' %
-              (inputPath, file_base + '.unique.bam'))
+    runCachedCommand('samtools rmdup %s %s' %
+                     (inputPath, file_base + '.unique.bam'),
+                     'samtools rmdup', inputPath, file_base + '.unique.bam',
+                     cache)
     inputPath = file_base + '.unique.bam'
   else:
     print >> sys.stderr, 'Skipping rmdup due to %s extension' % (file_special +
                                                                  file_ext)
 
-  # Print header
-  outFile.write(HEADER)
-
   # Iterate over alignments in SAM file
   time_start = time.time()
+  with metrics.timer('sam', 'total'):
+    if nProcesses > 1:
+      # Build index if needed for region queries
+      if not os.path.exists(inputPath + '.bai'):
+        os.system('samtools index %s' % inputPath)
+
+      # Summarize shards in parallel, writing them back in order
+      writer = openSummaryWriter(outFile, binary)
+      regions = [region + (binary,) for region in samRegions(inputPath,
+                                                             windowSize)]
+      pool = multiprocessing.Pool(nProcesses)
+      shards = metrics.timeIter('sam', 'parse',
+                                pool.imap(_summarizeRegion, regions))
+      for shard, counters in shards:
+        with metrics.timer('sam', 'write'):
+          writer.writeShard(shard)
+        for counter, n in counters.iteritems():
+          metrics.add('sam', counter, n)
+      pool.close()
+      pool.join()
+      writer.close()
+
+      metrics.add('sam', 'bytesRead', os.path.getsize(inputPath))
+      metrics.add('sam', 'bytesWritten', writer.nBytes)
+    else:
+      writeSummaries(iterSAMSummaries(inputPath, metrics=metrics), outFile,
+                     binary, metrics, 'sam')
+  
+  time_end = time.time()
+  print >> sys.stderr, 'Processing time: %f seconds' % (time_end - time_start)
+
+  return 0
+
+def samRegions(inputPath, windowSize=None):
+  '''Function to split an indexed BAM file into regions for parallel
+  processing. Returns a list of (path, tid, start, end) tuples in file order,
+  one per reference or per windowSize bp window.'''
   with pysam.Samfile(inputPath, 'rb') as f:
-    for alignedRead in f:
-      if alignedRead.is_proper_pair and alignedRead.tlen > 0:
-        rname = f.getrname(alignedRead.tid)
-        match = CHROM_RE.search(rname)
-        if match:
-          chrom = int(match.group(0))
-        else:
-          chrom = rname
+    refLengths = f.lengths
 
-        start = alignedRead.pos
-        length = alignedRead.tlen
-        end = start + length - 1
-        center = start + (length - 1) / 2.
+  regions = []
+  for tid, refLength in enumerate(refLengths):
+    if windowSize is None:
+      regions.append( (inputPath, tid, 0, refLength) )
+    else:
+      for start in xrange(0, refLength, windowSize):
+        regions.append( (inputPath, tid, start, min(start + windowSize,
+                                                    refLength)) )
 
-        nvalid = [tag[1] for tag in alignedRead.tags if tag[0] == 'XM']
-        if len(nvalid) == 0:
-          nvalid = 0
-        else:
-          nvalid = nvalid[0]
+  return regions
+
+def _summarizeRegion(region):
+  '''Worker function to summarize the proper pairs starting within a single
+  region of an indexed BAM file. Returns formatted read summaries, or a list
+  of summary tuples if binary is set, and a dictionary of metrics counters.'''
+  inputPath, tid, start, end, binary = region
+
+  outputs = []
+  nReads = nImproper = nTlen = 0
+  with pysam.Samfile(inputPath, 'rb') as f:
+    chromLabels = samChromLabels(f)
+    for alignedRead in f.fetch(f.references[tid], start, end):
+      # Skip reads overlapping the region but starting before it
+      if alignedRead.pos < start:
+        continue
+
+      nReads += 1
+      if not alignedRead.is_proper_pair:
+        nImproper += 1
+      elif alignedRead.tlen <= 0:
+        nTlen += 1
+      else:
+        outputs.append(summarizeAlignedRead(alignedRead, chromLabels))
+
+  counters = {'recordsIn' : nReads, 'recordsOut' : len(outputs),
+              'discardedImproper' : nImproper, 'discardedTlen' : nTlen}
+  if binary:
+    return outputs, counters
+  return ''.join([OUTPUT_FORMAT % output for output in outputs]), counters
+
+def samChromLabels(samFile):
+  '''Function to build chromosome labels for each reference of an open
+  SAM/BAM file. See refChromLabels.'''
+  return refChromLabels(samFile.references)
+
+def refChromLabels(refNames):
+  '''Function to build chromosome labels from reference names. Numbered
+  references are labeled by their number, unless that would give two
+  references the same label (e.g. chr1 and chr1_random), in which case all
+  references keep their full names.'''
+  chromLabels = []
+  for rname in refNames:
+    match = CHROM_RE.search(rname)
+    if match:
+      chromLabels.append(int(match.group(0)))
+    else:
+      chromLabels.append(rname)
+
+  if len(set(chromLabels)) < len(chromLabels):
+    return list(refNames)
+
+  return chromLabels
+
+def chromLayoutFromSAM(alignmentPath):
+  '''Function to read the chromosome layout from the header of a SAM/BAM
+  file. Returns an OrderedDict mapping chromosome labels, as written in read
+  summaries, to lengths.'''
+  with pysam.Samfile(alignmentPath, 'r') as f:
+    return collections.OrderedDict(
+      (str(label), length) for label, length in
+      itertools.izip(samChromLabels(f), f.lengths))
+
+def chromLayoutFromFAI(faiPath):
+  '''Function to read the chromosome layout from a FASTA index (.fai).
+  Returns an OrderedDict mapping chromosome labels to lengths.'''
+  refNames = []
+  refLengths = []
+  with open(faiPath, 'rb') as f:
+    for line in f:
+      fields = line.split(BOWTIE_DELIM)
+      refNames.append(fields[0])
+      refLengths.append(int(fields[1]))
+
+  return collections.OrderedDict(
+    (str(label), length) for label, length in
+    itertools.izip(refChromLabels(refNames), refLengths))
+
+def loadChromLayout(path):
+  '''Function to load a chromosome layout from a FASTA index (.fai) or the
+  header of a SAM/BAM file, chosen by extension.'''
+  if path.lower().endswith('.fai'):
+    return chromLayoutFromFAI(path)
+  return chromLayoutFromSAM(path)
+
+def summarizeAlignedRead(alignedRead, chromLabels):
+  '''Function to summarize the leftmost read of a proper pair. Returns read
+  summary tuple.'''
+  chrom = chromLabels[alignedRead.tid]
+
+  start = alignedRead.pos
+  length = alignedRead.tlen
+  end = start + length - 1
+  center = start + (length - 1) / 2.
+
+  nvalid = [tag[1] for tag in alignedRead.tags if tag[0] == 'XM']
+  if len(nvalid) == 0:
+    nvalid = 0
+  else:
+    nvalid = nvalid[0]
+
+  return (chrom, '+', start, end, center, length, nvalid)
+
+def streamSAMOutput(alignmentPath, outFile, pairedEnd=True, rmdup=False,
+                    maxDupKeys=MAX_DUP_KEYS, binary=False, metrics=None,
+                    teePath=None):
+  '''Function to convert SAM or BAM output to read summaries in a single
+  streaming pass, without samtools or intermediate files. alignmentPath may be
+  '-' to read SAM from stdin (e.g. piped from bowtie), or an open file such as
+  a pipe. Returns completion code.
+
+  If rmdup is set, duplicates on (tid, pos, tlen) are removed in memory,
+  keeping the first occurrence. For coordinate-sorted input this is exact;
+  otherwise at most maxDupKeys keys are retained, oldest evicted first.
+  If binary is set, summaries are written in the binary format. If teePath is
+  given, every alignment read is also written there as BAM. Reports to
+  metrics as stage 'sam', if given.'''
+  if metrics is None:
+    metrics = Metrics()
+
+  # Iterate over alignments in SAM file
+  time_start = time.time()
+  with metrics.timer('sam', 'total'):
+    writeSummaries(iterSAMSummaries(alignmentPath, rmdup, maxDupKeys,
+                                    metrics, teePath),
+                   outFile, binary, metrics, 'sam')
 
-        output = (chrom, '+', start, end, center, length, nvalid)
-        outFile.write(OUTPUT_FORMAT % output)
-  
   time_end = time.time()
   print >> sys.stderr, 'Processing time: %f seconds' % (time_end - time_start)
 
   return 0
 
-def readsToCounts(dataFile, outFile, randomize=True):
+def iterSAMSummaries(alignmentPath, rmdup=False, maxDupKeys=MAX_DUP_KEYS,
+                     metrics=None, teePath=None):
+  '''Generator over read summary tuples for the proper pairs in a SAM or BAM
+  file or open file, read in a single pass. See streamSAMOutput. Alignments
+  read and discarded (improper pairs, tlen <= 0 and duplicates) are reported
+  to metrics as stage 'sam'.'''
+  if metrics is None:
+    metrics = Metrics()
+
+  # Choose mode from extension; htslib detects the format from stdin
+  if (isinstance(alignmentPath, basestring) and
+      os.path.splitext(alignmentPath)[1].lower() == '.bam'):
+    mode = 'rb'
+  else:
+    mode = 'r'
+
+  with pysam.Samfile(alignmentPath, mode) as f:
+    chromLabels = samChromLabels(f)
+    isSorted = f.header.get('HD', {}).get('SO') == 'coordinate'
+
+    teeFile = None
+    if teePath is not None:
+      teeFile = pysam.Samfile(teePath, 'wb', template=f)
+
+    seen = collections.OrderedDict()
+    lastPos = None
+    nReads = nImproper = nTlen = nDuplicate = 0
+    try:
+      for alignedRead in f:
+        if teeFile is not None:
+          teeFile.write(alignedRead)
+
+        # Count locally between reports
+        nReads += 1
+        if nReads == CHUNK_SIZE:
+          metrics.add('sam', 'recordsIn', nReads)
+          nReads = 0
+
+        if not alignedRead.is_proper_pair:
+          nImproper += 1
+          continue
+        if alignedRead.tlen <= 0:
+          nTlen += 1
+          continue
+
+        if rmdup:
+          # Sorted input never revisits a position, so drop keys behind us
+          pos = (alignedRead.tid, alignedRead.pos)
+          if isSorted and pos != lastPos:
+            seen.clear()
+            lastPos = pos
+
+          key = (alignedRead.tid, alignedRead.pos, alignedRead.tlen)
+          if key in seen:
+            nDuplicate += 1
+            continue
+          seen[key] = None
+          if len(seen) > maxDupKeys:
+            seen.popitem(last=False)
+
+        yield summarizeAlignedRead(alignedRead, chromLabels)
+    finally:
+      # Finish the BAM with its EOF block even if reading stopped early
+      if teeFile is not None:
+        teeFile.close()
+
+  metrics.add('sam', 'recordsIn', nReads)
+  metrics.add('sam', 'discardedImproper', nImproper)
+  metrics.add('sam', 'discardedTlen', nTlen)
+  metrics.add('sam', 'discardedDuplicate', nDuplicate)
+  if isinstance(alignmentPath, basestring) and os.path.isfile(alignmentPath):
+    metrics.add('sam', 'bytesRead', os.path.getsize(alignmentPath))
+
+def alignToSummaries(command, outFile, rmdup=False, binary=False,
+                     teePath=None, logFile=None, metrics=None):
+  '''Function to run a Bowtie command producing SAM (see bowtieCommand) and
+  summarize its output as it is produced, so summarization overlaps alignment
+  and no SAM file is written. Arguments are as for streamSAMOutput; Bowtie's
+  stderr goes to logFile. Returns Bowtie's exit status.
+
+  If summarization fails because Bowtie stopped early (e.g. a bad index gives
+  no SAM header), a RuntimeError giving Bowtie's exit status and log is
+  raised instead of the parsing error. Otherwise Bowtie is killed and the
+  error re-raised.'''
+  bowtie = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=logFile)
+  try:
+    streamSAMOutput(bowtie.stdout, outFile, rmdup=rmdup, binary=binary,
+                    metrics=metrics, teePath=teePath)
+  except:
+    excInfo = sys.exc_info()
+
+    # A failing Bowtie closes its output and exits by itself, so give it a
+    # moment unless the job was stopped
+    status = bowtie.poll()
+    if not issubclass(excInfo[0], (JobCancelled, KeyboardInterrupt)):
+      deadline = time.time() + BOWTIE_EXIT_TIMEOUT
+      while status is None and time.time() < deadline:
+        time.sleep(0.05)
+        status = bowtie.poll()
+
+    if status is None:
+      bowtie.kill()
+      bowtie.wait()
+    elif status != 0:
+      raise RuntimeError('Bowtie exited with status %d; see %s' %
+                         (status, getattr(logFile, 'name', 'its output')))
+    raise excInfo[0], excInfo[1], excInfo[2]
+  finally:
+    bowtie.stdout.close()
+
+  return bowtie.wait()
+
+class TextSummaryWriter:
+  '''Writer for tab-delimited read summaries'''
+  def __init__(self, outFile):
+    self.outFile = outFile
+    self.outFile.write(HEADER)
+    self.nBytes = len(HEADER)
+
+  def write(self, output):
+    line = OUTPUT_FORMAT % output
+    self.outFile.write(line)
+    self.nBytes += len(line)
+
+  def writeShard(self, shard):
+    self.outFile.write(shard)
+    self.nBytes += len(shard)
+
+  def close(self):
+    pass
+
+class BinarySummaryWriter:
   '''
-  Function to convert read information to chromosome-level counts.
-  Outputs comma-separated counts, one chromosome per line.
+  Writer for binary read summaries. The file holds SUMMARY_MAGIC, then packed
+  SUMMARY_DTYPE records, then the chromosome names (one per line) and a
+  SUMMARY_TRAILER giving their length. Chromosomes are stored as indices into
+  the name table, which is only needed at close, so output can be streamed.
   '''
-  # Setup data structure for read counts
-  reads = []
-  for i in xrange(NCHROM):
-    reads.append( np.zeros(CHROM_LENGTHS[i], dtype=np.float64) )
+  def __init__(self, outFile, chunkSize=CHUNK_SIZE):
+    self.outFile = outFile
+    self.chunkSize = chunkSize
+    self.chromCodes = {}
+    self.chromNames = []
+    self.buffer = []
+    self.outFile.write(SUMMARY_MAGIC)
+    self.nBytes = len(SUMMARY_MAGIC)
 
-  # Setup reader object to parse data file into structure format
-  dataReader = csv.DictReader(dataFile, delimiter=BOWTIE_DELIM)
+  def write(self, output):
+    chrom = str(output[0])
+    code = self.chromCodes.get(chrom)
+    if code is None:
+      code = len(self.chromNames)
+      if code > np.iinfo(SUMMARY_DTYPE['chromosome']).max:
+        raise ValueError('Too many chromosomes for binary summary format')
+      self.chromCodes[chrom] = code
+      self.chromNames.append(chrom)
 
-  chromSet = set()
-  for line in dataReader:
-    # Discard mitochondrial reads
-    try:
-      chromIndex = int(line['chromosome'])-1
-    except:
+    self.buffer.append( (code,) + tuple(output[1:]) )
+    if len(self.buffer) >= self.chunkSize:
+      self.flush()
+
+  def writeShard(self, shard):
+    for output in shard:
+      self.write(output)
+
+  def flush(self):
+    if len(self.buffer) > 0:
+      records = np.array(self.buffer, dtype=SUMMARY_DTYPE)
+      self.outFile.write(records.tostring())
+      self.nBytes += records.nbytes
+      self.buffer = []
+
+  def close(self):
+    self.flush()
+    names = ''.join([name + '\n' for name in self.chromNames])
+    self.outFile.write(names)
+    self.outFile.write(SUMMARY_TRAILER.pack(len(names), SUMMARY_MAGIC))
+    self.nBytes += len(names) + SUMMARY_TRAILER.size
+
+def openSummaryWriter(outFile, binary=False):
+  '''Function to setup a read summary writer on a file-like object. Writers
+  provide write(summaryTuple) and close(); closing does not close outFile.
+  nBytes gives the number of bytes written so far.'''
+  if binary:
+    return BinarySummaryWriter(outFile)
+  return TextSummaryWriter(outFile)
+
+def writeSummaries(summaries, outFile, binary=False, metrics=None,
+                   stage='summaries'):
+  '''Function to write read summary tuples to outFile, in binary format if
+  binary is set. Returns the number of summaries written.
+
+  Summaries are pulled in blocks, so time spent producing them (parse) and
+  writing them (write) is reported separately to metrics under stage, along
+  with records and bytes written.'''
+  if metrics is None:
+    metrics = Metrics()
+
+  summaries = iter(summaries)
+  blocks = metrics.timeIter(stage, 'parse', iter(
+      lambda: list(itertools.islice(summaries, CHUNK_SIZE)), []))
+
+  writer = openSummaryWriter(outFile, binary)
+  nSummaries = 0
+  for block in blocks:
+    with metrics.timer(stage, 'write'):
+      for output in block:
+        writer.write(output)
+    metrics.add(stage, 'recordsOut', len(block))
+    nSummaries += len(block)
+  writer.close()
+  metrics.add(stage, 'bytesWritten', writer.nBytes)
+
+  return nSummaries
+
+def teeSummaries(summaries, outFile, binary=False):
+  '''Generator passing read summary tuples through unchanged while writing
+  them to outFile, so a summary file can be kept mid-stream.'''
+  writer = openSummaryWriter(outFile, binary)
+  for output in summaries:
+    writer.write(output)
+    yield output
+  writer.close()
+
+def loadBinarySummary(path):
+  '''Function to load a binary read summary file without copying it into
+  memory. Returns (chromNames, records), where records is a memory-mapped
+  SUMMARY_DTYPE array whose chromosome field indexes into chromNames.'''
+  with open(path, 'rb') as f:
+    f.seek(-SUMMARY_TRAILER.size, os.SEEK_END)
+    trailerStart = f.tell()
+    namesLength, magic = SUMMARY_TRAILER.unpack(f.read(SUMMARY_TRAILER.size))
+    if magic != SUMMARY_MAGIC:
+      raise ValueError('%s is not a complete binary read summary' % path)
+
+    namesStart = trailerStart - namesLength
+    f.seek(namesStart)
+    chromNames = f.read(namesLength).splitlines()
+
+  # Map records between magic and name table
+  nRecords = (namesStart - len(SUMMARY_MAGIC)) // SUMMARY_DTYPE.itemsize
+  if nRecords == 0:
+    records = np.zeros(0, dtype=SUMMARY_DTYPE)
+  else:
+    records = np.memmap(path, dtype=SUMMARY_DTYPE, mode='r',
+                        offset=len(SUMMARY_MAGIC), shape=(nRecords,))
+
+  return chromNames, records
+
+def parseBinarySummary(data):
+  '''Function to parse a binary read summary held in a string, e.g. read from
+  a pipe. Returns (chromNames, records) as for loadBinarySummary.'''
+  namesLength, magic = SUMMARY_TRAILER.unpack(data[-SUMMARY_TRAILER.size:])
+  if magic != SUMMARY_MAGIC:
+    raise ValueError('Incomplete binary read summary')
+
+  namesStart = len(data) - SUMMARY_TRAILER.size - namesLength
+  chromNames = data[namesStart:len(data)-SUMMARY_TRAILER.size].splitlines()
+  records = np.frombuffer(data[len(SUMMARY_MAGIC):namesStart],
+                          dtype=SUMMARY_DTYPE)
+
+  return chromNames, records
+
+def iterSummaryChunks(dataFile, fields=OUTPUT_FIELDS, chunkSize=CHUNK_SIZE,
+                      metrics=None, stage='summaries'):
+  '''Generator to read summaries in blocks of up to chunkSize rows.
+  Yields (chromNames, chunk) tuples, where chunk is a dictionary mapping each
+  requested field to a NumPy array. The chromosome column is given as integer
+  codes indexing into chromNames.
+
+  Binary summaries are detected automatically and read without copying.
+  Rows and bytes read are reported to metrics under stage, if given.'''
+  if metrics is None:
+    metrics = Metrics()
+
+  # Check for binary format
+  magic = dataFile.read(len(SUMMARY_MAGIC))
+  if magic == SUMMARY_MAGIC:
+    # Only a plain file can be memory-mapped; compressed files and pipes
+    # are read into memory
+    if (isinstance(dataFile, file) and os.path.isfile(dataFile.name) and
+        getCompression(dataFile.name) is None):
+      chromNames, records = loadBinarySummary(dataFile.name)
+    else:
+      chromNames, records = parseBinarySummary(magic + dataFile.read())
+    chromNames = np.array(chromNames)
+
+    for start in xrange(0, records.size, chunkSize):
+      block = records[start:start+chunkSize]
+      metrics.add(stage, 'bytesRead', block.nbytes)
+      metrics.add(stage, 'recordsIn', block.size)
+      yield chromNames, dict((field, block[field]) for field in fields)
+
+    return
+
+  # Locate requested fields using header
+  header = (magic + dataFile.readline()).rstrip('\r\n').split(BOWTIE_DELIM)
+  nFields = len(header)
+  columnIndex = dict((field, i) for i, field in enumerate(header))
+
+  while True:
+    lines = list(itertools.islice(dataFile, chunkSize))
+    if len(lines) == 0:
+      break
+
+    # Split rows into columns, skipping blank or truncated lines
+    rows = [line.rstrip('\r\n').split(BOWTIE_DELIM) for line in lines]
+    rows = [row for row in rows if len(row) >= nFields]
+    metrics.add(stage, 'bytesRead', sum(itertools.imap(len, lines)))
+    metrics.add(stage, 'discardedMalformed', len(lines) - len(rows))
+    metrics.add(stage, 'recordsIn', len(lines))
+    if len(rows) == 0:
       continue
+    columns = zip(*rows)
+
+    # Convert columns to arrays
+    chromNames = ()
+    chunk = {}
+    for field in fields:
+      column = columns[columnIndex[field]]
+      if field == 'chromosome':
+        chromNames, chunk[field] = np.unique(np.array(column),
+                                             return_inverse=True)
+      elif field == 'strand':
+        chunk[field] = np.array(column)
+      elif field == 'center':
+        chunk[field] = np.array(column, dtype=np.float64)
+      else:
+        chunk[field] = np.array(column, dtype=np.int64)
+
+    yield chromNames, chunk
+
+def chunkSummaries(summaries, chunkSize=CHUNK_SIZE):
+  '''Generator to group read summary tuples into blocks of up to chunkSize
+  rows, yielding (chromNames, chunk) tuples as for iterSummaryChunks.'''
+  summaries = iter(summaries)
+  while True:
+    outputs = list(itertools.islice(summaries, chunkSize))
+    if len(outputs) == 0:
+      break
+
+    columns = zip(*outputs)
+    chromNames, codes = np.unique(np.array([str(chrom) for chrom in
+                                            columns[0]]),
+                                  return_inverse=True)
+    chunk = {'chromosome' : codes, 'strand' : np.array(columns[1]),
+             'center' : np.array(columns[4], dtype=np.float64)}
+    for i in (2, 3, 5, 6):
+      chunk[OUTPUT_FIELDS[i]] = np.array(columns[i], dtype=np.int64)
+
+    yield chromNames, chunk
+
+def accumulateChunks(chunks, *accumulators):
+  '''Function to feed each (chromNames, chunk) block from a stream, e.g.
+  iterSummaryChunks or chunkSummaries, to every accumulator (such as
+  CenterCounter or LengthDistribution). Returns the accumulators.'''
+  for chromNames, chunk in chunks:
+    for accumulator in accumulators:
+      accumulator.add(chromNames, chunk)
 
-    chromSet.add(chromIndex)
-    
-    # Extract start and length information
-    start = int(line['start'])
-    length = int(line['length'])
-    center = float(line['center'])
-    
-    # Allocate read center to one of two positions
-    if center==np.floor(center):
-      reads[chromIndex][center] += 1.0
+  return accumulators
+
+def layoutIndices(chromNames, chromLayout=DEFAULT_LAYOUT):
+  '''Function to map chromosome names to their positions in chromLayout.
+  Numbered names match regardless of zero-padding (e.g. 05 and 5).
+  Chromosomes outside the layout (e.g. mitochondrial with the default yeast
+  layout) are mapped to None.'''
+  layoutIndex = dict((name, i) for i, name in enumerate(chromLayout))
+
+  indices = []
+  for name in chromNames:
+    index = layoutIndex.get(name)
+    if index is None:
+      try:
+        index = layoutIndex.get(str(int(name)))
+      except ValueError:
+        pass
+    indices.append(index)
+
+  return indices
+
+def chromGroups(chromNames, codes, chromLayout=DEFAULT_LAYOUT):
+  '''Generator over the chromosomes present in a block of reads, given the
+  block's chromosome codes indexing into chromNames (as from
+  iterSummaryChunks). Yields (chromIndex, rows), where chromIndex is as from
+  layoutIndices and rows (a mask or indices) selects that chromosome's reads
+  in their original order. Only the codes present are visited, so the cost
+  does not grow with the number of chromosome names: a few are picked out
+  by masks, more by one stable sort of the block.'''
+  sizes = np.bincount(codes, minlength=len(chromNames))
+  present = np.flatnonzero(sizes)
+  chromIndices = layoutIndices([chromNames[code] for code in present],
+                               chromLayout)
+
+  if present.size <= GROUP_MAX_MASKS:
+    for code, chromIndex in itertools.izip(present, chromIndices):
+      yield chromIndex, (codes == code)
+    return
+
+  order = np.argsort(codes, kind='mergesort')
+  bounds = np.r_[0, np.cumsum(sizes[present])]
+  for i, chromIndex in enumerate(chromIndices):
+    yield chromIndex, order[bounds[i]:bounds[i+1]]
+
+def newSeed():
+  '''Function to draw a seed for newRNG from /dev/urandom'''
+  return struct.unpack('<I', os.urandom(4))[0]
+
+def newRNG(seed=None, *keys):
+  '''Function to get the random stream for a seed and any further integer
+  keys, such as a chromosome index, so that each key has its own
+  reproducible substream regardless of what else is drawn or in what order.
+  Returns a NumPy Generator, or a RandomState seeded the same way before
+  NumPy 1.17. The seed is drawn with newSeed if None.'''
+  if seed is None:
+    seed = newSeed()
+
+  if hasattr(np.random, 'default_rng'):
+    return np.random.default_rng([seed] + list(keys))
+  return np.random.RandomState([seed] + list(keys))
+
+def tieCoins(rng, n):
+  '''Function to draw n fair coins (0 or 1) from a stream given by newRNG
+  in one call. Each coin takes one 32-bit draw, so the coins drawn do not
+  depend on how a stream is split across calls.'''
+  if hasattr(rng, 'integers'):
+    return rng.integers(0, 2, size=n)
+  return rng.randint(0, 2, size=n)
+
+def addCenterCounts(counts, centers, randomize=True, rng=None, coins=None):
+  '''Function to add a block of fragment centers to the counts array for a
+  single chromosome. With randomize, each half-integer center goes to
+  either neighbouring position with equal probability, using one coin per
+  center: coins, if given, else drawn from rng (see newRNG) in one batch.'''
+  # Split centers into integer positions and half-integer ties
+  base = np.floor(centers)
+  isTie = (centers != base)
+  base = base.astype(np.intp)
+
+  # Allocate read center to one of two positions
+  if randomize:
+    if coins is None:
+      coins = tieCoins(newRNG() if rng is None else rng, centers.size)
+    base[isTie] += coins[isTie]
+    addPositionCounts(counts, base)
+  else:
+    # Ties add 0.5 at floor(center), as the slice floor:ceil always has
+    addPositionCounts(counts, base, np.where(isTie, 0.5, 1.0))
+
+def addPositionCounts(counts, positions, weights=None):
+  '''Function to add (weighted) counts at the given positions in place.
+  Only the span of positions touched is updated, so for sorted input only a
+  few pages of a memory-mapped counts array are touched per block.'''
+  if positions.size == 0:
+    return
+
+  lo = positions.min()
+  hi = positions.max() + 1
+  if hi - lo <= BINCOUNT_MAX_SPAN * positions.size:
+    np.add(counts[lo:hi], np.bincount(positions - lo, weights=weights,
+                                      minlength=hi-lo),
+           out=counts[lo:hi], casting='unsafe')
+  else:
+    # Scattered positions; avoid a temporary as long as the span
+    if weights is None:
+      weights = 1
+    np.add.at(counts, positions, weights)
+
+def addCoverageCounts(diffs, starts, ends):
+  '''Function to add a block of fragments covering [start, end) to the
+  difference array for a single chromosome in place: +1 at each start and -1
+  at each end. Boundaries past the chromosome are dropped, as its cumulative
+  sum never reaches them. Integer arrays wrap around, which the cumulative
+  sum undoes.'''
+  starts = starts[starts < diffs.size]
+  ends = ends[ends < diffs.size]
+  if starts.size == 0:
+    return
+
+  # Only the span of boundaries touched is updated, as in addPositionCounts
+  lo = starts.min()
+  hi = max(starts.max(), ends.max() if ends.size > 0 else 0) + 1
+  if hi - lo <= BINCOUNT_MAX_SPAN * (starts.size + ends.size):
+    delta = (np.bincount(starts - lo, minlength=hi-lo) -
+             np.bincount(ends - lo, minlength=hi-lo))
+    np.add(diffs[lo:hi], delta, out=diffs[lo:hi], casting='unsafe')
+  else:
+    np.add.at(diffs, starts, 1)
+    np.subtract.at(diffs, ends, 1)
+
+def readsToCounts(dataFile, outFile, randomize=True, chunkSize=CHUNK_SIZE,
+                  countsFormat='text', chromLayout=DEFAULT_LAYOUT,
+                  countsDir=None, dtype=np.float64, tracksDir=None,
+                  binSizes=(), smoothSigma=None, lengthBins=None,
+                  mode='centers', seed=None, metrics=None):
+  '''
+  Function to convert read information to chromosome-level counts.
+  Outputs comma-separated counts, one chromosome per line, or any other
+  encoding in COUNTS_FORMATS (see writeCounts).
+
+  mode is one of COUNTS_MODES: 'centers' counts fragment centers per base
+  (see CenterCounter); 'coverage' counts the fragments covering each base
+  (see CoverageCounter), for which randomize is ignored.
+
+  chromLayout maps chromosome names to lengths (see loadChromLayout) and
+  defaults to yeast. Counts are only allocated for chromosomes with reads.
+
+  If countsDir is given, counts are accumulated in memory-mapped .npy files
+  there, one per chromosome, which form the binary output (see
+  loadCountsDir); outFile may then be None. dtype sets the counts type;
+  integer types require randomize, as ties otherwise give half counts.
+  Randomized ties are broken with one substream of seed per chromosome (see
+  newRNG), so counts for a given seed do not depend on chunking, file
+  format or which process runs them; seed is drawn with newSeed if None.
+
+  If tracksDir is given, binned sums for each of binSizes and, if
+  smoothSigma is given, a Gaussian-smoothed track are computed from the
+  counts and written there (see writeTracks) for reading at any zoom level.
+
+  If lengthBins is also given, as (low, high) fragment length classes (see
+  parseLengthBins), fragment centers are counted separately for each class
+  in the same pass and each class written to tracksDir as its own counts
+  directory with zoom levels (see LengthClassCounter).
+
+  Reads counted and discarded are reported to metrics as stage 'counts'.
+  '''
+  if metrics is None:
+    metrics = Metrics()
+
+  if seed is None:
+    seed = newSeed()
+
+  counter = newCounter(mode, chromLayout, randomize, countsDir, dtype, seed)
+  accumulators = [counter]
+  if lengthBins is not None:
+    if tracksDir is None:
+      raise ValueError('Length classes require a tracks directory')
+    accumulators.append(LengthClassCounter(lengthBins, chromLayout,
+                                           randomize, dtype, seed))
+
+  # Read the fields needed by any accumulator, once
+  fields = []
+  for accumulator in accumulators:
+    fields.extend(field for field in accumulator.FIELDS
+                  if field not in fields)
+
+  with metrics.timer('counts', 'total'):
+    # Tabulate centers or coverage one block of reads at a time
+    chunks = iterSummaryChunks(dataFile, fields, chunkSize, metrics, 'counts')
+    accumulateChunks(metrics.timeIter('counts', 'parse', chunks),
+                     *accumulators)
+
+    # Write results
+    with metrics.timer('counts', 'write'):
+      metrics.add('counts', 'bytesWritten',
+                  counter.write(outFile, countsFormat))
+
+    # Compute zoom levels from the finished counts
+    if tracksDir is not None:
+      writeTracks(counter.finish(), counter.chromNames, tracksDir, binSizes,
+                  smoothSigma)
+    for classCounter in accumulators[1:]:
+      classCounter.writeClasses(tracksDir, binSizes, smoothSigma)
+
+  metrics.add('counts', 'recordsOut', counter.nAdded)
+  metrics.add('counts', 'discardedChromosome', counter.nDiscarded)
+  for classCounter in accumulators[1:]:
+    metrics.add('counts', 'discardedLength', classCounter.nDiscarded)
+
+class CenterCounter:
+  '''
+  Accumulator for per-base fragment center counts over blocks of read
+  summaries. See readsToCounts for the arguments.
+  '''
+  # Summary fields used
+  FIELDS = ('chromosome', 'center')
+
+  def __init__(self, chromLayout=DEFAULT_LAYOUT, randomize=True,
+               countsDir=None, dtype=np.float64, seed=None):
+    if not randomize and np.issubdtype(dtype, np.integer):
+      raise ValueError('Half counts require a floating-point dtype')
+
+    self.chromLayout = chromLayout
+    self.chromNames = chromLayout.keys()
+    self.chromLengths = chromLayout.values()
+    self.randomize = randomize
+    self.seed = newSeed() if seed is None else seed
+    self.rngs = {}
+    self.countsDir = countsDir
+    self.dtype = dtype
+    self.nAdded = 0
+    self.nDiscarded = 0
+
+    # Setup data structure for read counts
+    self.reads = {}
+    if countsDir is not None:
+      createCountsDir(countsDir, chromLayout)
+
+  def getCounts(self, chromIndex):
+    '''Get the counts array for a chromosome, allocating it if needed'''
+    if chromIndex not in self.reads:
+      self.reads[chromIndex] = newCountsArray(self.chromLengths[chromIndex],
+                                              self.dtype, self.countsDir,
+                                              self.chromNames[chromIndex])
+    return self.reads[chromIndex]
+
+  def getRNG(self, chromIndex):
+    '''Get the random substream for a chromosome (see newRNG)'''
+    if chromIndex not in self.rngs:
+      self.rngs[chromIndex] = newRNG(self.seed, chromIndex)
+    return self.rngs[chromIndex]
+
+  def drawCoins(self, chromIndex, n):
+    '''Draw the tie-breaking coins for the next n reads on a chromosome
+    (see addCenterCounts); None unless randomizing'''
+    if not self.randomize:
+      return None
+    return tieCoins(self.getRNG(chromIndex), n)
+
+  def add(self, chromNames, chunk):
+    '''Add a block of reads, as yielded by iterSummaryChunks'''
+    for chromIndex, rows in chromGroups(chromNames, chunk['chromosome'],
+                                        self.chromLayout):
+      centers = chunk['center'][rows]
+
+      # Discard reads outside layout
+      if chromIndex is None:
+        self.nDiscarded += centers.size
+        continue
+
+      addCenterCounts(self.getCounts(chromIndex), centers, self.randomize,
+                      coins=self.drawCoins(chromIndex, centers.size))
+      self.nAdded += centers.size
+
+  def finish(self):
+    '''Return the list of counts arrays for all chromosomes in the layout,
+    flushing any memory-mapped arrays to disk'''
+    counts = [self.getCounts(i) for i in xrange(len(self.chromNames))]
+    if self.countsDir is not None:
+      for chrom in counts:
+        chrom.flush()
+    return counts
+
+  def counted(self):
+    '''Return the list of counts arrays for all chromosomes in the layout,
+    with None for chromosomes without reads, allocating nothing'''
+    return [self.reads.get(i) for i in xrange(len(self.chromNames))]
+
+  def write(self, outFile, countsFormat='text'):
+    '''Finish counting and write counts to outFile, if given. Chromosomes
+    without reads are only allocated to fill a counts directory. Returns the
+    number of bytes written.'''
+    if self.countsDir is not None:
+      counts = self.finish()
     else:
-      if randomize:
-        reads[chromIndex][np.floor(center)+np.random.randint(1)] += 1.0
+      counts = self.counted()
+
+    if outFile is None:
+      return 0
+    return writeCounts(counts, outFile, self.chromNames, countsFormat,
+                       self.chromLengths)
+
+class CoverageCounter(CenterCounter):
+  '''
+  Accumulator for per-base fragment coverage: the number of fragments
+  covering each base from start to start + length - 1. Each fragment adds
+  +1 at its start and -1 past its end to a difference array per chromosome,
+  held in the counts array itself, which is summed in place once in finish.
+  Cost is then O(reads + genome) rather than O(total fragment length).
+  Arguments are as for CenterCounter, without randomize.
+  '''
+  FIELDS = ('chromosome', 'start', 'length')
+
+  def __init__(self, chromLayout=DEFAULT_LAYOUT, countsDir=None,
+               dtype=np.float64):
+    # Coverage is always whole, so any dtype will do
+    CenterCounter.__init__(self, chromLayout, True, countsDir, dtype)
+    self.finished = False
+
+  def add(self, chromNames, chunk):
+    '''Add a block of reads, as yielded by iterSummaryChunks'''
+    for chromIndex, rows in chromGroups(chromNames, chunk['chromosome'],
+                                        self.chromLayout):
+      starts = chunk['start'][rows]
+
+      # Discard reads outside layout
+      if chromIndex is None:
+        self.nDiscarded += starts.size
+        continue
+
+      addCoverageCounts(self.getCounts(chromIndex), starts,
+                        starts + chunk['length'][rows])
+      self.nAdded += starts.size
+
+  def counted(self):
+    '''Turn the difference arrays into coverage, once, and return them as
+    CenterCounter.counted does'''
+    if not self.finished:
+      for diffs in self.reads.itervalues():
+        np.cumsum(diffs, dtype=diffs.dtype, out=diffs)
+      self.finished = True
+
+    return CenterCounter.counted(self)
+
+  def finish(self):
+    '''Return coverage for all chromosomes as CenterCounter.finish does'''
+    # Chromosomes allocated afterwards have no reads, so need no summing
+    self.counted()
+    return CenterCounter.finish(self)
+
+class LengthClassCounter(CenterCounter):
+  '''
+  Accumulator for per-base fragment center counts stratified by fragment
+  length, over blocks of read summaries. lengthBins lists the (low, high)
+  classes as returned by parseLengthBins; reads in no class, or centered
+  off the end of their chromosome, are discarded.
+  Each chromosome's counts are one (number of classes x length) array,
+  filled for all classes at once by offsetting each center into its class's
+  row. Other arguments are as for CenterCounter; counts are held in memory.
+  Ties are broken with the coins a CenterCounter with the same seed draws,
+  so the classes split its counts exactly.
+  '''
+  FIELDS = ('chromosome', 'center', 'length')
+
+  def __init__(self, lengthBins, chromLayout=DEFAULT_LAYOUT, randomize=True,
+               dtype=np.float64, seed=None):
+    CenterCounter.__init__(self, chromLayout, randomize, None, dtype, seed)
+    self.lengthBins = checkLengthBins(lengthBins)
+
+    # Class bounds, with no upper limit as the largest length
+    self.lows = np.array([low for low, high in self.lengthBins])
+    self.highs = np.array([np.iinfo(np.int64).max if high is None else high
+                           for low, high in self.lengthBins])
+
+  def getCounts(self, chromIndex):
+    '''Get the counts array for a chromosome, allocating it if needed'''
+    if chromIndex not in self.reads:
+      self.reads[chromIndex] = np.zeros((len(self.lengthBins),
+                                         self.chromLengths[chromIndex]),
+                                        dtype=self.dtype)
+    return self.reads[chromIndex]
+
+  def add(self, chromNames, chunk):
+    '''Add a block of reads, as yielded by iterSummaryChunks'''
+    for chromIndex, rows in chromGroups(chromNames, chunk['chromosome'],
+                                        self.chromLayout):
+      # Reads outside layout are reported by the main counter
+      if chromIndex is None:
+        continue
+
+      centers = chunk['center'][rows]
+      lengths = chunk['length'][rows]
+
+      # Find the class of each read, if any, keeping only centers that
+      # cannot spill out of the chromosome into the next class's row
+      classes = np.searchsorted(self.lows, lengths, side='right') - 1
+      inClass = ((classes >= 0) & (centers >= 0) &
+                 (centers <= self.chromLengths[chromIndex] - 1))
+      inClass[inClass] = (lengths[inClass] < self.highs[classes[inClass]])
+      self.nDiscarded += centers.size - inClass.sum()
+
+      # Draw coins for all reads, as CenterCounter does
+      coins = self.drawCoins(chromIndex, centers.size)
+      if coins is not None:
+        coins = coins[inClass]
+
+      counts = self.getCounts(chromIndex)
+      addCenterCounts(counts.reshape(-1), centers[inClass] +
+                      classes[inClass] * counts.shape[1], self.randomize,
+                      coins=coins)
+      self.nAdded += inClass.sum()
+
+  def writeClasses(self, tracksDir, binSizes=(), smoothSigma=None):
+    '''Write the counts for each class to a counts directory in tracksDir
+    named by trackName, with its zoom levels (see writeTracks) inside'''
+    counts = self.finish()
+    for i, lengths in enumerate(self.lengthBins):
+      classDir = os.path.join(tracksDir, trackName(lengths=lengths))
+      createCountsDir(classDir, self.chromLayout)
+      for name, chrom in itertools.izip(self.chromNames, counts):
+        np.save(os.path.join(classDir, name + '.npy'), chrom[i])
+
+      writeTracks([chrom[i] for chrom in counts], self.chromNames, classDir,
+                  binSizes, smoothSigma)
+
+def newCounter(mode='centers', chromLayout=DEFAULT_LAYOUT, randomize=True,
+               countsDir=None, dtype=np.float64, seed=None):
+  '''Function to setup the counter for one of COUNTS_MODES'''
+  if mode == 'coverage':
+    return CoverageCounter(chromLayout, countsDir, dtype)
+  elif mode == 'centers':
+    return CenterCounter(chromLayout, randomize, countsDir, dtype, seed)
+
+  raise ValueError('Unknown counts mode %s' % mode)
+
+def createCountsDir(countsDir, chromLayout):
+  '''Function to setup a directory of per-chromosome counts, recording the
+  chromosome layout in COUNTS_LAYOUT_FILE.'''
+  if not os.path.isdir(countsDir):
+    os.makedirs(countsDir)
+
+  with open(os.path.join(countsDir, COUNTS_LAYOUT_FILE), 'wb') as f:
+    for name, length in chromLayout.iteritems():
+      f.write('%s%s%d\n' % (name, BOWTIE_DELIM, length))
+
+def newCountsArray(length, dtype=np.float64, countsDir=None, name=None):
+  '''Function to allocate a zeroed counts array, memory-mapped to
+  countsDir/name.npy if countsDir is given.'''
+  if countsDir is None:
+    return np.zeros(length, dtype=dtype)
+
+  return np.lib.format.open_memmap(os.path.join(countsDir, name + '.npy'),
+                                   mode='w+', dtype=dtype, shape=(length,))
+
+def loadCountsDir(countsDir, mode='r'):
+  '''Function to load a directory of per-chromosome counts written by
+  readsToCounts. Arrays are memory-mapped with the given mode. Returns
+  (chromNames, counts).'''
+  chromNames = []
+  counts = []
+  with open(os.path.join(countsDir, COUNTS_LAYOUT_FILE), 'rb') as f:
+    for line in f:
+      name = line.rstrip('\r\n').split(BOWTIE_DELIM)[0]
+      chromNames.append(name)
+      counts.append(np.load(os.path.join(countsDir, name + '.npy'),
+                            mmap_mode=mode))
+
+  return chromNames, counts
+
+def trackName(binSize=None, sigma=None, lengths=None):
+  '''Function to name the track directory for counts binned to binSize bp,
+  smoothed with a Gaussian kernel of standard deviation sigma bp, or counted
+  over the fragment length class lengths, a (low, high) pair'''
+  if lengths is not None:
+    low, high = lengths
+    return 'length%d-%s' % (low, '' if high is None else high)
+  if sigma is not None:
+    return 'smooth%g' % sigma
+  return 'bin%d' % binSize
+
+def parseLengthBins(text):
+  '''Function to parse comma-separated fragment length classes, each
+  low-high in bp covering low <= length < high; high may be omitted for no
+  upper limit, e.g. '0-120,120-180,250-'. Returns a sorted list of (low,
+  high) pairs, with high None if omitted.'''
+  lengthBins = []
+  for item in text.split(','):
+    match = re.match(r'^\s*(\d+)-(\d*)\s*$', item)
+    if match is None:
+      raise ValueError('Invalid length class %s' % item)
+    low, high = match.groups()
+    lengthBins.append((int(low), int(high) if high else None))
+
+  return checkLengthBins(lengthBins)
+
+def checkLengthBins(lengthBins):
+  '''Function to sort (low, high) fragment length classes, checking that
+  each is non-empty and that they do not overlap'''
+  lengthBins = sorted(lengthBins)
+  if len(lengthBins) == 0:
+    raise ValueError('No length classes given')
+
+  for i, (low, high) in enumerate(lengthBins):
+    if high is not None and high <= low:
+      raise ValueError('Empty length class %d-%d' % (low, high))
+    if i + 1 < len(lengthBins) and (high is None or
+                                    high > lengthBins[i + 1][0]):
+      raise ValueError('Overlapping length classes %s and %s' %
+                       (trackName(lengths=(low, high)),
+                        trackName(lengths=lengthBins[i + 1])))
+
+  return lengthBins
+
+def binCounts(counts, binSize, dtype=np.float64):
+  '''Function to sum counts over consecutive bins of binSize positions; the
+  last bin may be partial.'''
+  return np.add.reduceat(counts, np.arange(0, counts.size, binSize),
+                         dtype=dtype)
+
+def gaussianSmooth(counts, sigma, fftSize=SMOOTH_FFT_SIZE, out=None):
+  '''
+  Function to convolve counts with a Gaussian kernel of standard deviation
+  sigma (in positions), truncated at SMOOTH_TRUNCATE standard deviations and
+  normalized to sum to 1; positions off either end count as 0. The
+  convolution is done block by block with FFTs of fftSize (larger for wide
+  kernels), each block taking the kernel's half-width of context on either
+  side, so time is O(n log fftSize) and memory stays bounded for long
+  chromosomes. Results go to out if given. Returns the smoothed array.
+  '''
+  if out is None:
+    out = np.empty(counts.size, dtype=np.float64)
+  if counts.size == 0:
+    return out
+
+  halfWidth = int(np.ceil(SMOOTH_TRUNCATE * sigma))
+  kernel = np.exp(-0.5 * (np.arange(-halfWidth, halfWidth + 1) /
+                          float(sigma))**2)
+  kernel /= kernel.sum()
+
+  # Each output is valid once the kernel has passed the block's left
+  # context, so each FFT gives nfft - 2 * halfWidth outputs
+  nfft = min(max(fftSize, 2**int(np.ceil(np.log2(4 * halfWidth)))),
+             2**int(np.ceil(np.log2(counts.size + 2*halfWidth))))
+  blockSize = nfft - 2*halfWidth
+  kernelFFT = np.fft.rfft(kernel, nfft)
+
+  segment = np.zeros(blockSize + 2*halfWidth, dtype=np.float64)
+  for start in xrange(0, counts.size, blockSize):
+    stop = min(start + blockSize, counts.size)
+
+    # Copy block with context, zero beyond the chromosome
+    lo = max(start - halfWidth, 0)
+    hi = min(stop + halfWidth, counts.size)
+    offset = lo - (start - halfWidth)
+    segment[:] = 0
+    segment[offset:offset + hi - lo] = counts[lo:hi]
+
+    smoothed = np.fft.irfft(np.fft.rfft(segment, nfft) * kernelFFT, nfft)
+    out[start:stop] = np.maximum(smoothed[2*halfWidth:2*halfWidth + stop -
+                                          start], 0)
+
+  return out
+
+def writeTracks(counts, chromNames, tracksDir, binSizes=(), smoothSigma=None):
+  '''
+  Function to write zoom levels for per-chromosome counts to tracksDir: a
+  pyramid of binned sums, one counts directory (see loadCountsDir) per bin
+  size named by trackName, whose layout gives the lengths in bins, and
+  optionally a Gaussian-smoothed track at full resolution (float32). Each
+  level of the pyramid is summed from the finest level it is a multiple of.
+  Read them back with loadCountsDir or queryTrack.
+  '''
+  levels = {1 : counts}
+  for binSize in sorted(binSizes):
+    # Find finest existing level dividing this one
+    base = max(size for size in levels if binSize % size == 0)
+    binned = [binCounts(chrom, binSize // base) for chrom in levels[base]]
+    levels[binSize] = binned
+
+    levelDir = os.path.join(tracksDir, trackName(binSize))
+    createCountsDir(levelDir, collections.OrderedDict(
+        (name, chrom.size) for name, chrom in itertools.izip(chromNames,
+                                                             binned)))
+    for name, chrom in itertools.izip(chromNames, binned):
+      np.save(os.path.join(levelDir, name + '.npy'), chrom)
+
+  if smoothSigma is not None:
+    levelDir = os.path.join(tracksDir, trackName(sigma=smoothSigma))
+    createCountsDir(levelDir, collections.OrderedDict(
+        (name, chrom.size) for name, chrom in itertools.izip(chromNames,
+                                                             counts)))
+    for name, chrom in itertools.izip(chromNames, counts):
+      smoothed = newCountsArray(chrom.size, np.float32, levelDir, name)
+      gaussianSmooth(chrom, smoothSigma, out=smoothed)
+      smoothed.flush()
+
+def queryTrack(tracksDir, region, binSize=None, sigma=None, lengths=None):
+  '''Function to get the values of a track written by writeTracks over a
+  region (see parseRegion) given in bp. Binned tracks return the bins
+  overlapping the region. With lengths, the track is read from the counts
+  for that fragment length class (see LengthClassCounter); these are
+  returned at full resolution if neither binSize nor sigma is given.'''
+  chrom, start, end = parseRegion(region)
+  if binSize is not None:
+    start //= binSize
+    if end is not None:
+      end = -(-end // binSize)
+
+  if lengths is not None:
+    tracksDir = os.path.join(tracksDir, trackName(lengths=lengths))
+  if binSize is not None or sigma is not None:
+    tracksDir = os.path.join(tracksDir, trackName(binSize, sigma))
+
+  chromNames, counts = loadCountsDir(tracksDir)
+  return np.array(counts[_regionChromIndex(chromNames, chrom)][start:end])
+
+def writeCounts(counts, outFile, chromNames, countsFormat='text',
+                chromLengths=None):
+  '''
+  Function to write per-chromosome count arrays in one of COUNTS_FORMATS.
+  An array may be None for a chromosome without reads, whose length is then
+  taken from chromLengths; it is written as zeros without being allocated.
+  Formats are:
+    text      comma-separated counts, one chromosome per line
+    sparse    '#chromosome<TAB>length' lines giving the layout, then
+              chromosome, position, count rows for nonzero positions
+    npz       compressed NumPy .npz archive with one array per chromosome,
+              using the smallest dtype from countsDtype
+    bedgraph  chromosome, start, end, count rows for runs of equal nonzero
+              counts (0-based, half-open)
+  Returns the number of bytes written.
+  '''
+  if chromLengths is None:
+    chromLengths = [chrom.size for chrom in counts]
+
+  countsFile = outFile
+  outFile = CountingFile(countsFile)
+
+  if countsFormat == 'text':
+    for chrom, length in itertools.izip(counts, chromLengths):
+      if chrom is None:
+        _writeZeroRow(outFile, length)
+        continue
+      np.savetxt(outFile, chrom[np.newaxis,:],
+                 fmt='%.1f', delimiter=',' )
+  elif countsFormat == 'sparse':
+    for name, length in itertools.izip(chromNames, chromLengths):
+      outFile.write('#%s%s%d\n' % (name, BOWTIE_DELIM, length))
+    for name, chrom in itertools.izip(chromNames, counts):
+      if chrom is None:
+        continue
+      positions = np.flatnonzero(chrom)
+      np.savetxt(outFile, np.column_stack((positions, chrom[positions])),
+                 fmt=_literal(name) + BOWTIE_DELIM.join(('', '%d', '%.1f')))
+  elif countsFormat == 'npz':
+    arrays = {}
+    for name, chrom, length in itertools.izip(chromNames, counts,
+                                              chromLengths):
+      if chrom is None:
+        # Zero-stride view, saved in pieces
+        arrays[name] = np.broadcast_to(np.uint8(0), (length,))
       else:
-        reads[chromIndex][np.floor(center):np.ceil(center)] += 0.5
+        arrays[name] = chrom.astype(countsDtype(chrom))
+    # Zip archives are written with seeks, so build them in a temporary
+    # file for pipes and compressed outputs
+    if _isSeekable(countsFile):
+      start = countsFile.tell()
+      np.savez_compressed(countsFile, **arrays)
+      outFile.nBytes = countsFile.tell() - start
+    else:
+      with tempfile.TemporaryFile() as tempFile:
+        np.savez_compressed(tempFile, **arrays)
+        tempFile.seek(0)
+        shutil.copyfileobj(tempFile, outFile)
+  elif countsFormat == 'bedgraph':
+    for name, chrom in itertools.izip(chromNames, counts):
+      if chrom is None:
+        continue
 
-  # sys.stderr.write(str(chromSet) + '\n')
+      # Find runs of equal counts
+      breaks = np.flatnonzero(np.diff(chrom)) + 1
+      starts = np.r_[0, breaks]
+      ends = np.r_[breaks, chrom.size]
+      values = chrom[starts]
 
-  # Write results
-  for chrom in reads:
-    np.savetxt(outFile, chrom[np.newaxis,:],
-               fmt='%.1f', delimiter=',' )
+      nonzero = (values != 0)
+      np.savetxt(outFile, np.column_stack((starts[nonzero], ends[nonzero],
+                                           values[nonzero])),
+                 fmt=_literal(name) + BOWTIE_DELIM.join(('', '%d', '%d',
+                                                         '%.1f')))
+  else:
+    raise ValueError('Unknown counts format %s' % countsFormat)
 
-def getReadLengthDist(dataFile, outFile, offset=0):
-  # Setup reader object to parse data file into structure format
-  dataReader = csv.DictReader(dataFile, delimiter=BOWTIE_DELIM)
+  return outFile.nBytes
 
-  # Read data and calculate read lengths
-  dist = []
+def countsDtype(counts):
+  '''Function to choose the smallest dtype holding counts exactly: the
+  smallest sufficient unsigned integer type for whole counts, float32
+  otherwise.'''
+  if np.any(counts != np.floor(counts)):
+    return np.float32
 
-  for line in dataReader:
-    # Discard mitochondrial reads
-    try:
-      chromIndex = int(line['chromosome'])-1
-    except:
+  for dtype in (np.uint8, np.uint16, np.uint32):
+    if counts.size == 0 or counts.max() <= np.iinfo(dtype).max:
+      return dtype
+  return np.uint64
+
+def _writeZeroRow(outFile, length, blockSize=2**16):
+  '''Function to write a text counts row of length zeros, in blocks'''
+  for start in xrange(0, length, blockSize):
+    n = min(blockSize, length - start)
+    outFile.write(','.join(['0.0'] * n))
+    outFile.write(',' if start + n < length else '\n')
+
+def _isSeekable(fileObj):
+  '''Function to check whether fileObj is a plain file supporting seeks'''
+  if not isinstance(fileObj, file):
+    return False
+
+  try:
+    fileObj.tell()
+  except IOError:
+    return False
+  return True
+
+def _literal(text):
+  '''Function to escape text for use in a %-format string'''
+  return text.replace('%', '%%')
+
+def loadCounts(path, countsFormat=None, chromLengths=None):
+  '''
+  Function to load per-chromosome counts written by writeCounts, or a
+  counts directory (see loadCountsDir). The format is detected from the file
+  contents unless given. chromLengths optionally
+  maps chromosome names to lengths for bedgraph input, which does not record
+  them; otherwise chromosomes end at their last nonzero run. Returns
+  (chromNames, counts), with counts a list of arrays.
+  '''
+  if os.path.isdir(path):
+    return loadCountsDir(path)
+
+  if countsFormat is None:
+    countsFormat = detectCountsFormat(path)
+
+  if countsFormat == 'npz':
+    # Zip archives need seeks, so compressed ones are read into memory
+    if getCompression(path) is None:
+      archive = np.load(path)
+    else:
+      with openCompressed(path, 'rb') as f:
+        archive = np.load(StringIO.StringIO(f.read()))
+    chromNames = sorted(archive.files, key=_chromSortKey)
+    return chromNames, [archive[name] for name in chromNames]
+
+  chromNames = []
+  counts = []
+  with openCompressed(path, 'rb') as f:
+    if countsFormat == 'text':
+      for line in f:
+        chromNames.append(str(len(counts)+1))
+        counts.append(np.array(line.split(','), dtype=np.float64))
+    elif countsFormat == 'sparse':
+      chromIndex = {}
+      for line in f:
+        fields = line.rstrip('\r\n').split(BOWTIE_DELIM)
+        if line.startswith('#'):
+          chromIndex[fields[0][1:]] = len(counts)
+          chromNames.append(fields[0][1:])
+          counts.append(np.zeros(int(fields[1]), dtype=np.float64))
+        else:
+          counts[chromIndex[fields[0]]][int(fields[1])] = float(fields[2])
+    elif countsFormat == 'bedgraph':
+      runs = collections.OrderedDict()
+      for line in f:
+        if line.startswith('track') or line.startswith('browser'):
+          continue
+        name, start, end, value = line.rstrip('\r\n').split(BOWTIE_DELIM)
+        runs.setdefault(name, []).append( (int(start), int(end),
+                                           float(value)) )
+      for name, chromRuns in runs.iteritems():
+        if chromLengths is not None and name in chromLengths:
+          length = chromLengths[name]
+        else:
+          length = chromRuns[-1][1]
+        chrom = np.zeros(length, dtype=np.float64)
+        for start, end, value in chromRuns:
+          chrom[start:end] = value
+        chromNames.append(name)
+        counts.append(chrom)
+    else:
+      raise ValueError('Unknown counts format %s' % countsFormat)
+
+  return chromNames, counts
+
+def detectCountsFormat(path, maxBytes=2**16):
+  '''Function to detect which of COUNTS_FORMATS a (possibly compressed)
+  counts file is in from the start of its first line, reading at most
+  maxBytes of it, as a text counts line may hold a whole chromosome'''
+  with openCompressed(path, 'rb') as f:
+    firstLine = f.readline(maxBytes)
+
+  if firstLine.startswith('PK'):
+    return 'npz'
+  elif firstLine.startswith('#'):
+    return 'sparse'
+  elif (BOWTIE_DELIM in firstLine or firstLine.startswith('track') or
+        firstLine.startswith('browser')):
+    return 'bedgraph'
+  return 'text'
+
+def _chromSortKey(name):
+  '''Function to sort chromosome names numerically where possible'''
+  try:
+    return (0, int(name), name)
+  except ValueError:
+    return (1, 0, name)
+
+def parseRegion(region):
+  '''Function to parse a region given as 'chrom', 'chrom:start' or
+  'chrom:start-end' into (chrom, start, end). Coordinates are 0-based and
+  half-open, as for counts arrays; start defaults to 0 and end to None (the
+  end of the chromosome).'''
+  match = REGION_RE.match(region)
+  if match is None:
+    raise ValueError('Invalid region %s' % region)
+
+  chrom, start, end = match.groups()
+  start = 0 if start is None else int(start.replace(',', ''))
+  if end is not None:
+    end = int(end.replace(',', ''))
+    if end < start:
+      raise ValueError('Region %s ends before it starts' % region)
+
+  return chrom, start, end
+
+def _regionChromIndex(chromNames, chrom):
+  '''Function to find a chromosome among chromNames as layoutIndices does,
+  raising ValueError if it is absent'''
+  index = layoutIndices([chrom], chromNames)[0]
+  if index is None:
+    raise ValueError('Chromosome %s not found' % chrom)
+  return index
+
+def indexSummaries(summaryPath, indexPath=None, chunkSize=CHUNK_SIZE):
+  '''
+  Function to build a region index for a text or binary read summary file,
+  so querySummaries reads only the fragments in a region. Summaries need not
+  be sorted, but must not be compressed, as they are read by offset. Returns
+  the path of the index, by default summaryPath + REGION_INDEX_SUFFIX.
+
+  The index holds INDEX_MAGIC, then the start, end and location (record
+  number or byte offset) of every fragment, sorted by chromosome and start,
+  as contiguous INDEX_DTYPES columns, then a table of
+  'name<TAB>first<TAB>count<TAB>maxLength' lines giving each chromosome's
+  rows, and a SUMMARY_TRAILER giving the table length.
+  '''
+  if indexPath is None:
+    indexPath = summaryPath + REGION_INDEX_SUFFIX
+  if getCompression(summaryPath) is not None:
+    raise ValueError('Cannot index compressed read summary %s' % summaryPath)
+
+  with open(summaryPath, 'rb') as f:
+    isBinary = (f.read(len(SUMMARY_MAGIC)) == SUMMARY_MAGIC)
+
+  if isBinary:
+    chromNames, records = loadBinarySummary(summaryPath)
+    codes = np.array(records['chromosome'])
+    starts = np.array(records['start'])
+    ends = np.array(records['end'])
+    pointers = np.arange(records.size, dtype=INDEX_DTYPES[2])
+  else:
+    # Scan lines, keeping the byte offset of each
+    chromCodes = {}
+    codes, starts, ends, pointers = [], [], [], []
+    with open(summaryPath, 'rb') as f:
+      header = f.readline().rstrip('\r\n').split(BOWTIE_DELIM)
+      columns = [header.index(field) for field in ('chromosome', 'start',
+                                                   'end')]
+      offset = f.tell()
+      while True:
+        lines = list(itertools.islice(f, chunkSize))
+        if len(lines) == 0:
+          break
+
+        lineOffsets = offset + np.cumsum([0] + map(len, lines[:-1]))
+        offset += sum(itertools.imap(len, lines))
+        rows = [(i, line.rstrip('\r\n').split(BOWTIE_DELIM))
+                for i, line in enumerate(lines)]
+        rows = [(i, row) for i, row in rows if len(row) >= len(header)]
+        if len(rows) == 0:
+          continue
+
+        codes.append(np.array([chromCodes.setdefault(row[columns[0]],
+                                                     len(chromCodes))
+                               for i, row in rows]))
+        starts.append(np.array([row[columns[1]] for i, row in rows],
+                               dtype=INDEX_DTYPES[0]))
+        ends.append(np.array([row[columns[2]] for i, row in rows],
+                             dtype=INDEX_DTYPES[1]))
+        pointers.append(lineOffsets[[i for i, row in rows]])
+
+    chromNames = sorted(chromCodes, key=chromCodes.get)
+    codes, starts, ends, pointers = [
+        np.concatenate(column) if len(column) > 0 else np.zeros(0, dtype)
+        for column, dtype in zip((codes, starts, ends, pointers),
+                                 (np.intp,) + INDEX_DTYPES)]
+
+  # Sort by chromosome, then start
+  order = np.lexsort((starts, codes))
+  codes = codes[order]
+  bounds = np.searchsorted(codes, np.arange(len(chromNames) + 1))
+
+  table = ''
+  for code, name in enumerate(chromNames):
+    first, last = bounds[code], bounds[code+1]
+    if last == first:
       continue
+    maxLength = np.max(ends[order[first:last]] - starts[order[first:last]])
+    table += '%s%s%d%s%d%s%d\n' % (name, BOWTIE_DELIM, first, BOWTIE_DELIM,
+                                   last - first, BOWTIE_DELIM, maxLength)
+
+  with open(indexPath, 'wb') as f:
+    f.write(INDEX_MAGIC)
+    for column, dtype in zip((starts, ends, pointers), INDEX_DTYPES):
+      f.write(column[order].astype(dtype).tostring())
+    f.write(table)
+    f.write(SUMMARY_TRAILER.pack(len(table), INDEX_MAGIC))
+
+  return indexPath
+
+def loadSummaryIndex(indexPath):
+  '''Function to load a region index written by indexSummaries without
+  reading its columns into memory. Returns (table, starts, ends, pointers),
+  where table maps chromosome names to (first, count, maxLength) and the
+  columns are memory-mapped.'''
+  with open(indexPath, 'rb') as f:
+    f.seek(-SUMMARY_TRAILER.size, os.SEEK_END)
+    trailerStart = f.tell()
+    tableLength, magic = SUMMARY_TRAILER.unpack(f.read(SUMMARY_TRAILER.size))
+    if magic != INDEX_MAGIC:
+      raise ValueError('%s is not a complete region index' % indexPath)
 
-    readLength = int(line['length'])
+    f.seek(trailerStart - tableLength)
+    table = collections.OrderedDict()
+    for line in f.read(tableLength).splitlines():
+      name, first, count, maxLength = line.split(BOWTIE_DELIM)
+      table[name] = (int(first), int(count), int(maxLength))
 
-    if len(dist) <= readLength:
-      dist.extend([0]*(readLength-len(dist)+1))
-      dist[readLength] += 1
+  nRows = sum(count for first, count, maxLength in table.itervalues())
+  columns = []
+  offset = len(INDEX_MAGIC)
+  for dtype in INDEX_DTYPES:
+    if nRows == 0:
+      columns.append(np.zeros(0, dtype=dtype))
     else:
-      dist[readLength] += 1
+      columns.append(np.memmap(indexPath, dtype=dtype, mode='r',
+                               offset=offset, shape=(nRows,)))
+    offset += nRows * np.dtype(dtype).itemsize
 
-  dist = np.array(dist)
-  nonzero = np.where(dist > 0)[0]
-  nonzero = np.arange(nonzero.min(), nonzero.max()+1, dtype='i')
+  return (table,) + tuple(columns)
 
-  # Format & write output
-  readLengths = np.vstack( (nonzero, dist[nonzero]) ).T
-  np.savetxt(outFile, readLengths, fmt='%d')
+def querySummaries(summaryPath, region, indexPath=None):
+  '''
+  Function to get the fragments overlapping a region (see parseRegion) from
+  a read summary file, reading only those fragments via its region index
+  (see indexSummaries). The index is built first if it is missing or older
+  than the summaries.
+
+  Returns a dictionary mapping each summary field other than chromosome to
+  an array, sorted by start, as for the chunks of iterSummaryChunks.
+  '''
+  if indexPath is None:
+    indexPath = summaryPath + REGION_INDEX_SUFFIX
+  if (not os.path.exists(indexPath) or
+      os.path.getmtime(indexPath) < os.path.getmtime(summaryPath)):
+    indexSummaries(summaryPath, indexPath)
+
+  chrom, start, end = parseRegion(region)
+  table, starts, ends, pointers = loadSummaryIndex(indexPath)
+  chromNames = table.keys()
+  first, count, maxLength = table[chromNames[_regionChromIndex(chromNames,
+                                                               chrom)]]
+
+  # Binary search the chromosome's starts, then check ends
+  chromStarts = starts[first:first+count]
+  lo = first + np.searchsorted(chromStarts, start - maxLength, 'left')
+  if end is None:
+    hi = first + count
+  else:
+    hi = first + np.searchsorted(chromStarts, end, 'left')
+  hits = np.flatnonzero(ends[lo:hi] >= start) + lo
+  locations = np.sort(pointers[hits])
+
+  fields = OUTPUT_FIELDS[1:]
+  with open(summaryPath, 'rb') as f:
+    isBinary = (f.read(len(SUMMARY_MAGIC)) == SUMMARY_MAGIC)
+    if isBinary:
+      records = loadBinarySummary(summaryPath)[1][locations]
+      chunk = dict((field, np.array(records[field])) for field in fields)
+    else:
+      # Read hit lines in file order
+      f.seek(0)
+      header = f.readline().rstrip('\r\n').split(BOWTIE_DELIM)
+      rows = []
+      for location in locations:
+        f.seek(location)
+        rows.append(f.readline().rstrip('\r\n').split(BOWTIE_DELIM))
+      columns = zip(*rows) if len(rows) > 0 else [()] * len(header)
+
+      chunk = {}
+      for field in fields:
+        column = columns[header.index(field)]
+        if field == 'strand':
+          chunk[field] = np.array(column, dtype='S1')
+        elif field == 'center':
+          chunk[field] = np.array(column, dtype=np.float64)
+        else:
+          chunk[field] = np.array(column, dtype=np.int64)
+
+  # Sort by start, as in the index
+  order = np.argsort(chunk['start'], kind='mergesort')
+  return dict((field, values[order]) for field, values in chunk.iteritems())
 
+def indexCounts(countsPath, indexPath=None, step=COUNTS_INDEX_STEP):
+  '''
+  Function to build a region index for text counts (see writeCounts), so
+  queryCounts reads only the values in a region. The index records the byte
+  offset of every step-th value of each chromosome, and is saved as an .npz
+  archive, by default at countsPath + COUNTS_INDEX_SUFFIX. Returns its path.
+
+  Counts directories and npz archives need no index, as they are read by
+  chromosome; other formats are not indexed.
+  '''
+  if indexPath is None:
+    indexPath = countsPath + COUNTS_INDEX_SUFFIX
+  if getCompression(countsPath) is not None:
+    raise ValueError('Cannot index compressed counts %s' % countsPath)
+
+  lengths = []
+  offsets = []
+  with open(countsPath, 'rb') as f:
+    while True:
+      lineStart = f.tell()
+      line = f.readline()
+      if len(line) == 0:
+        break
+      if line.startswith('#') or BOWTIE_DELIM in line or line.startswith('PK'):
+        raise ValueError('%s is not in text counts format' % countsPath)
+
+      # Values start after each comma
+      commas = np.flatnonzero(np.frombuffer(line, dtype='S1') == ',')
+      lengths.append(commas.size + 1)
+      offsets.append(lineStart + np.r_[0, commas[step-1::step] + 1])
+
+  np.savez(indexPath, step=step, lengths=np.array(lengths, dtype=np.int64),
+           nOffsets=np.array(map(len, offsets), dtype=np.int64),
+           offsets=np.concatenate(offsets) if len(offsets) > 0 else
+           np.zeros(0, dtype=np.int64))
+
+  return indexPath
+
+def queryCounts(countsPath, region, indexPath=None):
+  '''
+  Function to get the counts in a region (see parseRegion) from counts
+  written by readsToCounts. Text counts are read via their region index (see
+  indexCounts), which is built first if it is missing or older than the
+  counts; counts directories are memory-mapped and npz archives read one
+  chromosome at a time. Other formats are loaded in full. Returns an array.
+  '''
+  chrom, start, end = parseRegion(region)
+
+  if os.path.isdir(countsPath):
+    chromNames, counts = loadCountsDir(countsPath)
+    return np.array(counts[_regionChromIndex(chromNames, chrom)][start:end])
+
+  countsFormat = detectCountsFormat(countsPath)
+  isCompressed = (getCompression(countsPath) is not None)
+  if countsFormat == 'npz' and not isCompressed:
+    archive = np.load(countsPath)
+    chromNames = sorted(archive.files, key=_chromSortKey)
+    return archive[chromNames[_regionChromIndex(chromNames,
+                                                chrom)]][start:end]
+
+  if countsFormat != 'text' or isCompressed:
+    chromNames, counts = loadCounts(countsPath, countsFormat)
+    return counts[_regionChromIndex(chromNames, chrom)][start:end]
+
+  # Text counts; chromosomes are numbered from 1 by line
+  if indexPath is None:
+    indexPath = countsPath + COUNTS_INDEX_SUFFIX
+  if (not os.path.exists(indexPath) or
+      os.path.getmtime(indexPath) < os.path.getmtime(countsPath)):
+    indexCounts(countsPath, indexPath)
+
+  index = np.load(indexPath)
+  step = int(index['step'])
+  lengths = index['lengths']
+  chromIndex = _regionChromIndex([str(i+1) for i in xrange(lengths.size)],
+                                 chrom)
+  length = lengths[chromIndex]
+  firstOffset = index['nOffsets'][:chromIndex].sum()
+  offsets = index['offsets'][firstOffset:
+                             firstOffset + index['nOffsets'][chromIndex]]
+
+  start = min(start, length)
+  end = length if end is None else min(end, length)
+  if end <= start:
+    return np.zeros(0, dtype=np.float64)
+
+  # Read the blocks of values spanning the region
+  firstBlock = start // step
+  lastBlock = (end - 1) // step + 1
+  with open(countsPath, 'rb') as f:
+    f.seek(offsets[firstBlock])
+    if lastBlock < offsets.size:
+      data = f.read(offsets[lastBlock] - offsets[firstBlock])
+    else:
+      data = f.readline()
+
+  values = np.array(data.rstrip('\r\n,').split(','), dtype=np.float64)
+  return values[start - firstBlock*step:end - firstBlock*step]
+
+def getReadLengthDist(dataFile, outFile, offset=0, chunkSize=CHUNK_SIZE,
+                      chromLayout=DEFAULT_LAYOUT,
+                      maxLength=MAX_FRAGMENT_LENGTH, partialFile=None,
+                      metrics=None):
+  '''Function to build the distribution of fragment lengths from read
+  summaries. offset is added to each length. Writes the two-column
+  distribution to outFile, if given, and the partial histogram to
+  partialFile, if given (see LengthDistribution.save). Reports to metrics
+  as stage 'lengths', if given.'''
+  if metrics is None:
+    metrics = Metrics()
+
+  # Read data and calculate read lengths
+  dist = LengthDistribution(chromLayout, offset, maxLength)
+
+  with metrics.timer('lengths', 'total'):
+    chunks = iterSummaryChunks(dataFile, ('chromosome', 'length'), chunkSize,
+                               metrics, 'lengths')
+    accumulateChunks(metrics.timeIter('lengths', 'parse', chunks), dist)
+
+    # Format & write output
+    with metrics.timer('lengths', 'write'):
+      if outFile is not None:
+        dist.write(outFile)
+      if partialFile is not None:
+        dist.save(partialFile)
+
+  metrics.add('lengths', 'recordsOut', dist.nAdded)
+  metrics.add('lengths', 'discardedChromosome', dist.nDiscarded)
+
+  return dist
+
+def mergeReadLengthDists(partialFiles, outFile):
+  '''Function to sum partial histograms saved by LengthDistribution.save
+  (e.g. one per lane) and write the combined two-column distribution.'''
+  dist = None
+  for partialFile in partialFiles:
+    partial = LengthDistribution.load(partialFile)
+    if dist is None:
+      dist = partial
+    else:
+      dist.merge(partial)
+
+  if dist is not None:
+    dist.write(outFile)
+
+  return dist
+
+class LengthDistribution:
+  '''
+  Accumulator for the distribution of fragment lengths over blocks of read
+  summaries. Reads outside chromLayout are discarded. offset is added to
+  each length.
+
+  Lengths are tabulated in a fixed array of maxLength bins plus an overflow
+  bin for longer fragments, so memory does not depend on the input.
+  Distributions with the same maxLength and offset can be saved, loaded and
+  merged.
+  '''
+  def __init__(self, chromLayout=DEFAULT_LAYOUT, offset=0,
+               maxLength=MAX_FRAGMENT_LENGTH):
+    self.chromLayout = chromLayout
+    self.offset = offset
+    self.maxLength = maxLength
+    self.dist = np.zeros(maxLength + 1, dtype=np.int64)
+    self.nAdded = 0
+    self.nDiscarded = 0
+
+  def add(self, chromNames, chunk):
+    '''Add a block of reads, as yielded by iterSummaryChunks'''
+    # Discard reads outside layout
+    inLayout = np.array([chromIndex is not None for chromIndex in
+                         layoutIndices(chromNames, self.chromLayout)],
+                        dtype=bool)
+    if inLayout.size == 0:
+      return
+    readLengths = chunk['length'][inLayout[chunk['chromosome']]]
+    self.nAdded += readLengths.size
+    self.nDiscarded += chunk['length'].size - readLengths.size
+
+    # Tabulate lengths, pooling long fragments in the overflow bin
+    readLengths = np.clip(readLengths + self.offset, 0, self.maxLength)
+    self.dist += np.bincount(readLengths, minlength=self.maxLength + 1)
+
+  def merge(self, other):
+    '''Add the counts of another LengthDistribution in place'''
+    if other.maxLength != self.maxLength:
+      raise ValueError('Cannot merge length distributions with maxLength '
+                       '%d and %d' % (self.maxLength, other.maxLength))
+    if other.offset != self.offset:
+      raise ValueError('Cannot merge length distributions with offset '
+                       '%d and %d' % (self.offset, other.offset))
+    self.dist += other.dist
+
+  def save(self, outFile):
+    '''Save the partial histogram (including the overflow bin) to a file or
+    path in .npz format, for merging with LengthDistribution.load'''
+    np.savez_compressed(outFile, dist=self.dist, offset=self.offset)
+
+  @classmethod
+  def load(cls, dataFile):
+    '''Load a partial histogram saved by LengthDistribution.save'''
+    data = np.load(dataFile)
+    dist = cls(offset=int(data['offset']), maxLength=data['dist'].size - 1)
+    dist.dist += data['dist']
+    return dist
+
+  def write(self, outFile):
+    '''Write the distribution in two-column format, covering all lengths
+    between the shortest and longest observed. Fragments of maxLength or
+    longer are pooled in the row for maxLength.'''
+    dist = self.dist
+    nonzero = np.where(dist > 0)[0]
+    if nonzero.size == 0:
+      return
+    nonzero = np.arange(nonzero.min(), nonzero.max()+1, dtype='i')
+
+    if dist[self.maxLength] > 0:
+      print >> sys.stderr, ('Warning: %d fragments of length >= %d pooled' %
+                            (dist[self.maxLength], self.maxLength))
+
+    readLengths = np.vstack( (nonzero, dist[nonzero]) ).T
+    np.savetxt(outFile, readLengths, fmt='%d')
+
+def alignmentsToCounts(alignmentPath, countsFile, lengthDistFile,
+                       summaryFile=None, rmdup=False, randomize=True,
+                       chromLayout=DEFAULT_LAYOUT, countsFormat='text',
+                       countsDir=None, dtype=np.float64, binary=False,
+                       maxDupKeys=MAX_DUP_KEYS, chunkSize=CHUNK_SIZE,
+                       mode='centers', seed=None, metrics=None):
+  '''
+  Function to go from SAM/BAM alignments to center counts and the fragment
+  length distribution in a single pass, without re-reading read summaries.
+  Each block of fragments is fed to both accumulators; summaries are only
+  written if summaryFile is given (binary format if binary is set).
+
+  Alignments are read as in streamSAMOutput and counts are built as in
+  readsToCounts, for either mode and with the same tie-breaking for a given
+  seed; any of countsFile, lengthDistFile and summaryFile may be None to
+  skip that output. Returns completion code.
+
+  Alignments are reported to metrics as stage 'sam' and the accumulated
+  fragments as stage 'counts'; 'counts' parse time covers reading the
+  alignments.
+  '''
+  if metrics is None:
+    metrics = Metrics()
+
+  counter = newCounter(mode, chromLayout, randomize, countsDir, dtype, seed)
+  dist = LengthDistribution(chromLayout)
+
+  summaries = iterSAMSummaries(alignmentPath, rmdup, maxDupKeys, metrics)
+  if summaryFile is not None:
+    summaries = teeSummaries(summaries, summaryFile, binary)
+
+  # Feed each block of fragments to all accumulators
+  time_start = time.time()
+  with metrics.timer('counts', 'total'):
+    chunks = metrics.timeIter('counts', 'parse',
+                              chunkSummaries(summaries, chunkSize))
+    accumulateChunks(chunks, counter, dist)
+
+    # Write results
+    with metrics.timer('counts', 'write'):
+      metrics.add('counts', 'bytesWritten',
+                  counter.write(countsFile, countsFormat))
+      if lengthDistFile is not None:
+        dist.write(lengthDistFile)
+
+  metrics.add('counts', 'recordsIn', counter.nAdded + counter.nDiscarded)
+  metrics.add('counts', 'recordsOut', counter.nAdded)
+  metrics.add('counts', 'discardedChromosome', counter.nDiscarded)
+
+  time_end = time.time()
+  print >> sys.stderr, 'Processing time: %f seconds' % (time_end - time_start)
+
+  return 0
@@ -18,32 +18,101 @@ DESCRIPTION
     However, with SAM output, can parse directly using command-line tools
     (parseSAMOutput.sh script) in 100x or so less time.
     Prints results to stdout.
+    FILE may be gzip/bgzip or zstd compressed.
+    Mates are matched by read ID, so need not be adjacent; mates whose
+    partner never appears are discarded. With --single-end, each alignment
+    is summarized on its own instead.
 
 OPTIONS
+    --single-end        Input is single-end alignments; summarize each read
+                        rather than pairing mates
+    --binary            Write summaries in binary format instead of text
+    --max-unpaired=     Maximum number of mates held in memory while waiting
+                        for their partner before spilling them to disk;
+                        defaults to %d
+    --temp-dir=         Directory for spilled mates; defaults to system temp
+    --output=           Write results to file instead of stdout; compressed
+                        if it ends in .gz/.bgz (bgzip) or .zst
+    --region-index      Also index the output by region, to OUTPUT.idx, for
+                        queryRegions.py; requires an uncompressed --output
+    --metrics=          Write stage metrics (records, discards, bytes and time
+                        spent parsing, computing and writing) to file as JSON at
+                        exit
+    --progress=         Print progress to stderr every given number of seconds
     -h/--help           Print help message and exit
-'''
+''' % libPipeline.MAX_UNPAIRED_MATES
 
 if __name__ == "__main__":
+    # Set defaults
+    pairedEnd = True
+    binary = False
+    metricsPath = None
+    progressInterval = None
+    maxUnpaired = libPipeline.MAX_UNPAIRED_MATES
+    tempDir = None
+    outFile = sys.stdout
+    outputPath = None
+    regionIndex = False
+    
     # Parse arguments
-    options, args = getopt.getopt(sys.argv[1:], 'h', ["help"])
+    options, args = getopt.getopt(sys.argv[1:], 'h',
+                                  ["help", "single-end", "binary",
+                                   "max-unpaired=",
+                                   "temp-dir=", "output=", "region-index",
+                                   "metrics=", "progress="])
     
     for opt, value in options:
         if opt in ("-h", "--help"):
             print >> sys.stderr, helpMsg
             sys.exit(2)
+        elif opt == "--single-end":
+            pairedEnd = False
+        elif opt == "--binary":
+            binary = True
+        elif opt == "--max-unpaired":
+            maxUnpaired = int(value)
+        elif opt == "--temp-dir":
+            tempDir = value
+        elif opt == "--output":
+            outputPath = value
+            outFile = libPipeline.openCompressed(value, "wb")
+        elif opt == "--region-index":
+            regionIndex = True
+        elif opt == "--metrics":
+            metricsPath = value
+        elif opt == "--progress":
+            progressInterval = float(value)
         else:
             print >> sys.stderr, "Error -- option %s not recognized" % opt
             sys.exit(1)
     
+    if regionIndex and (outputPath is None or
+                        libPipeline.getCompression(outputPath) is not None):
+        print >> sys.stderr, ("Error -- --region-index requires an "
+                              "uncompressed --output")
+        sys.exit(1)
+    
     # Parse arguments & options
     if len(args) > 0:
         alignmentFilename = args[0]
         try:
-            alignmentFile = open(alignmentFilename, 'rb')
+            alignmentFile = libPipeline.openCompressed(alignmentFilename, 'rb')
         except:
             print >> sys.stderr, "Error -- could not open %s" % args[0]
             sys.exit(1)
     else:
         alignmentFile = sys.stdin
     
-    libPipeline.processBowtieOutput(alignmentFile, sys.stdout)
+    # Report metrics as requested
+    metrics = libPipeline.Metrics(progressInterval)
+    if metricsPath is not None:
+        metrics.exportAtExit(metricsPath)
+
+    libPipeline.processBowtieOutput(alignmentFile, outFile,
+                                    pairedEnd=pairedEnd, binary=binary,
+                                    maxUnpaired=maxUnpaired, tempDir=tempDir,
+                                    metrics=metrics)
+    outFile.close()
+    
+    if regionIndex:
+        libPipeline.indexSummaries(outputPath)
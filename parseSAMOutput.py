@@ -31,17 +31,61 @@ parseSAMOutput.py
     If SAMFILE has a .unique.bam file extension, all samtools processing is
     skipped, including rmdup.
 
+    With --cache-dir, the outputs of these samtools steps are also kept in a
+    cache keyed by their input, so re-runs on unchanged input skip them.
+
+    With --stream, SAMFILE is read directly in a single pass with no samtools
+    steps or intermediate files; use - to read SAM from stdin (e.g. piped from
+    bowtie). Duplicates are then removed in memory. With --tee-bam, the
+    alignments read are also archived as BAM, so piping bowtie into
+    parseSAMOutput.py needs no SAM file on disk.
+
 OPTIONS
 --rmdup             Remove duplicate reads (reduces PCR effects)
+--stream            Summarize SAMFILE in one streaming pass
+--tee-bam=          With --stream, also write all alignments read to this BAM
+                    file
+--binary            Write summaries in binary format instead of text
+--output=           Write results to file instead of stdout; compressed if it
+                    ends in .gz/.bgz (bgzip) or .zst
+--region-index      Also index the output by region, to OUTPUT.idx, for
+                    queryRegions.py; requires an uncompressed --output
+-p/--processes=     Number of processes used to summarize the sorted BAM;
+                    defaults to 1
+--window=           Shard size in bp for parallel runs; defaults to one shard
+                    per chromosome
+--cache-dir=        Cache samtools outputs in this directory
+--cache-hash        Identify cached inputs by content hash instead of size
+                    and modification time
+--metrics=          Write stage metrics (records, discards, bytes and time
+                    spent parsing, computing and writing) to file as JSON at
+                    exit
+--progress=         Print progress to stderr every given number of seconds
 -h/--help           Print help message and exit
 '''
 
 if __name__ == "__main__":
   # Set defaults
   rmdup = False
+  stream = False
+  binary = False
+  outFile = sys.stdout
+  outputPath = None
+  regionIndex = False
+  nProcesses = 1
+  windowSize = None
+  metricsPath = None
+  progressInterval = None
+  cacheDir = None
+  hashContent = False
+  teePath = None
 
   # Parse arguments
-  options, args = getopt.getopt(sys.argv[1:], 'h', ["help", "rmdup"])
+  options, args = getopt.getopt(sys.argv[1:], 'hp:',
+                                ["help", "rmdup", "stream", "tee-bam=",
+                                 "binary", "processes=", "window=",
+                                 "output=", "region-index", "cache-dir=",
+                                 "cache-hash", "metrics=", "progress="])
 
   for opt, value in options:
     if opt in ("-h", "--help"):
@@ -49,6 +93,29 @@ if __name__ == "__main__":
       sys.exit(2)
     elif opt == "--rmdup":
       rmdup = True
+    elif opt == "--stream":
+      stream = True
+    elif opt == "--tee-bam":
+      teePath = value
+    elif opt == "--binary":
+      binary = True
+    elif opt in ("-p", "--processes"):
+      nProcesses = int(value)
+    elif opt == "--window":
+      windowSize = int(value)
+    elif opt == "--cache-dir":
+      cacheDir = value
+    elif opt == "--cache-hash":
+      hashContent = True
+    elif opt == "--output":
+      outputPath = value
+      outFile = libPipeline.openCompressed(value, "wb")
+    elif opt == "--region-index":
+      regionIndex = True
+    elif opt == "--metrics":
+      metricsPath = value
+    elif opt == "--progress":
+      progressInterval = float(value)
     else:
       print >> sys.stderr, "Error -- option %s not recognized" % opt
       sys.exit(1)
@@ -60,5 +127,32 @@ if __name__ == "__main__":
     print >> sys.stderr, "Error -- need path to SAM file"
     sys.exit(1)
 
-  libPipeline.processSAMOutput(alignmentPath, sys.stdout, rmdup=rmdup)
+  if regionIndex and (outputPath is None or
+                      libPipeline.getCompression(outputPath) is not None):
+    print >> sys.stderr, ("Error -- --region-index requires an "
+                          "uncompressed --output")
+    sys.exit(1)
+
+  cache = None
+  if cacheDir is not None:
+    cache = libPipeline.StageCache(cacheDir, hashContent=hashContent)
+
+  # Report metrics as requested
+  metrics = libPipeline.Metrics(progressInterval)
+  if metricsPath is not None:
+    metrics.exportAtExit(metricsPath)
+
+  if stream:
+    libPipeline.streamSAMOutput(alignmentPath, outFile, rmdup=rmdup,
+                                binary=binary, metrics=metrics,
+                                teePath=teePath)
+  else:
+    libPipeline.processSAMOutput(alignmentPath, outFile, rmdup=rmdup,
+                                 nProcesses=nProcesses, windowSize=windowSize,
+                                 binary=binary, cache=cache,
+                                 metrics=metrics)
+  outFile.close()
+
+  if regionIndex:
+    libPipeline.indexSummaries(outputPath)
 
@@ -7,6 +7,15 @@ import shlex
 import re
 import subprocess
 import sys, os
+import time
+import threading
+import multiprocessing
+import Queue
+
+# Define constants
+PROGRESS_INTERVAL = 0.5
+PROGRESS_RANGE = 1000
+CLOSE_TIMEOUT = 10.
 
 def generalError(parent, msg):
     '''
@@ -43,16 +52,253 @@ def wrapQuotes(*args):
     else:
         return '"' + args[0] + '"'
 
+class Job():
+    """
+    Pipeline job run on a JobQueue worker thread. func is called with the job
+    and reports into job.metrics; progress and completion are sent back to
+    onProgress(job, fraction, message) and onDone(job, status) on the GUI
+    thread via wx.CallAfter. Progress is the fraction of inputFile read, or
+    None when unknown.
+    
+    cancel() stops func at its next metrics report and terminates any
+    subprocess passed to watchProcess. Files in files are closed when the job
+    ends, and paths in outputs are removed unless it succeeded.
+    """
+    def __init__(self, name, func, onProgress, onDone, files=(), outputs=(),
+                 inputFile=None):
+        self.name = name
+        self.func = func
+        self.onProgress = onProgress
+        self.onDone = onDone
+        self.files = files
+        self.outputs = outputs
+        self.inputFile = inputFile
+        
+        self.metrics = libPipeline.Metrics(PROGRESS_INTERVAL,
+                                           onProgress=self.reportMetrics)
+        self.lock = threading.Lock()
+        self.processes = []
+        self.done = threading.Event()
+    
+    def run(self):
+        """
+        Run job on the current (worker) thread
+        """
+        status = "Done"
+        try:
+            if self.isCancelled():
+                raise libPipeline.JobCancelled(self.name)
+            self.reportProgress(0., "Running")
+            self.func(self)
+        except libPipeline.JobCancelled:
+            status = "Cancelled"
+        except Exception, e:
+            status = "Error -- %s" % e
+        
+        for openFile in self.files:
+            openFile.close()
+        
+        if status != "Done":
+            for path in self.outputs:
+                if os.path.exists(path):
+                    os.remove(path)
+        
+        self.done.set()
+        wx.CallAfter(self.onDone, self, status)
+    
+    def cancel(self):
+        """
+        Request cancellation; safe to call from any thread
+        """
+        self.metrics.cancel()
+        with self.lock:
+            for process in self.processes:
+                if process.poll() is None:
+                    process.terminate()
+    
+    def isCancelled(self):
+        return self.metrics.cancelled.is_set()
+    
+    def watchProcess(self, process):
+        """
+        Terminate process if the job is cancelled
+        """
+        with self.lock:
+            self.processes.append(process)
+        if self.isCancelled():
+            self.cancel()
+    
+    def reportProgress(self, fraction, message):
+        wx.CallAfter(self.onProgress, self, fraction, message)
+    
+    def reportMetrics(self, stage, stageMetrics):
+        """
+        Progress callback for job.metrics, run on the worker thread
+        """
+        fraction = None
+        if self.inputFile is not None:
+            try:
+                size = os.fstat(self.inputFile.fileno()).st_size
+                fraction = min(1., self.inputFile.tell() / float(size))
+            except (IOError, OSError, ValueError, ZeroDivisionError):
+                pass
+        
+        self.reportProgress(fraction, "%d records, %.0f records/sec" %
+                            (stageMetrics['recordsIn'],
+                             stageMetrics['recordsPerSec']))
+
+class JobQueue():
+    """
+    Queue of jobs shared by all tabs, run by a fixed set of worker threads so
+    that jobs from several tabs can run concurrently without blocking the GUI
+    """
+    def __init__(self, nWorkers=None):
+        if nWorkers is None:
+            nWorkers = multiprocessing.cpu_count()
+        
+        self.queue = Queue.Queue()
+        self.lock = threading.Lock()
+        self.jobs = []
+        
+        for i in xrange(nWorkers):
+            worker = threading.Thread(target=self.work)
+            worker.daemon = True
+            worker.start()
+    
+    def submit(self, job):
+        with self.lock:
+            self.jobs.append(job)
+        self.queue.put(job)
+    
+    def work(self):
+        while True:
+            job = self.queue.get()
+            job.run()
+            with self.lock:
+                self.jobs.remove(job)
+    
+    def activeJobs(self):
+        """
+        Return list of queued and running jobs
+        """
+        with self.lock:
+            return list(self.jobs)
+    
+    def cancelAll(self, timeout=CLOSE_TIMEOUT):
+        """
+        Cancel all jobs and wait up to timeout seconds for them to stop
+        """
+        jobs = self.activeJobs()
+        for job in jobs:
+            job.cancel()
+        
+        deadline = time.time() + timeout
+        for job in jobs:
+            job.done.wait(max(0., deadline - time.time()))
+
 class TabPanel(wx.Panel):
     """
-    Class for individual tabs of notebook
+    Class for individual tabs of notebook. Jobs started from a tab run on
+    jobQueue; the tab shows their progress and can cancel them.
     """
-    def __init__(self, parent):
+    # Name of job, used in status messages
+    JOB_NAME = "Job"
+    
+    def __init__(self, parent, jobQueue=None):
         """"""
         wx.Panel.__init__(self, parent=parent, id=wx.ID_ANY)
         sizer = wx.BoxSizer(wx.VERTICAL)
         self.SetSizer(sizer)
         
+        if jobQueue is None:
+            jobQueue = JobQueue(1)
+        self.jobQueue = jobQueue
+        self.job = None
+    
+    def addRunControls(self, statusBar=None):
+        """
+        Add run & cancel buttons, progress bar, and status bar if not given
+        """
+        # Add run & cancel buttons
+        buttonSizer = wx.BoxSizer(wx.HORIZONTAL)
+        self.runButton = wx.Button(self, wx.ID_ANY, "&Run",
+                                   style=wx.BU_EXACTFIT)
+        self.cancelButton = wx.Button(self, wx.ID_ANY, "&Cancel",
+                                      style=wx.BU_EXACTFIT)
+        self.cancelButton.Disable()
+        buttonSizer.Add(self.runButton, 0, wx.ALL, 5)
+        buttonSizer.Add(self.cancelButton, 0, wx.ALL, 5)
+        self.GetSizer().Add(buttonSizer, 0,
+                            wx.ALIGN_BOTTOM | wx.ALIGN_CENTER)
+        self.Bind(wx.EVT_BUTTON, self.run, self.runButton)
+        self.Bind(wx.EVT_BUTTON, self.cancel, self.cancelButton)
+        
+        # Add progress bar & message
+        self.progressBar = wx.Gauge(self, wx.ID_ANY, PROGRESS_RANGE,
+                                    size=wx.Size(400,-1))
+        self.GetSizer().Add(self.progressBar, 0,
+                            wx.ALIGN_CENTER | wx.TOP, 10)
+        self.progressText = wx.StaticText(self, wx.ID_ANY)
+        self.GetSizer().Add(self.progressText, 0, wx.ALIGN_CENTER)
+        
+        if statusBar is None:
+            # Add status bar
+            self.statusBar = wx.StatusBar(self)
+            self.GetSizer().Add(self.statusBar, 0, wx.ALIGN_BOTTOM)
+        else:
+            self.statusBar = statusBar
+    
+    def submitJob(self, func, files=(), outputs=(), inputFile=None):
+        """
+        Queue func(job) to run in the background
+        """
+        self.job = Job(self.JOB_NAME, func, self.showProgress, self.jobDone,
+                       files=files, outputs=outputs, inputFile=inputFile)
+        
+        self.runButton.Disable()
+        self.cancelButton.Enable()
+        self.progressBar.SetValue(0)
+        self.progressText.SetLabel("Queued")
+        self.statusBar.SetStatusText("%s: Queued" % self.JOB_NAME)
+        
+        self.jobQueue.submit(self.job)
+    
+    def cancel(self, event):
+        if self.job is not None:
+            self.job.cancel()
+            self.progressText.SetLabel("Cancelling")
+    
+    def showProgress(self, job, fraction, message):
+        if job is not self.job:
+            return
+        
+        if fraction is None:
+            self.progressBar.Pulse()
+        else:
+            self.progressBar.SetValue(int(fraction * PROGRESS_RANGE))
+        self.progressText.SetLabel(message)
+        
+        if message == "Running":
+            self.statusBar.SetStatusText("%s: Running" % self.JOB_NAME)
+    
+    def jobDone(self, job, status):
+        if job is not self.job:
+            return
+        self.job = None
+        
+        self.runButton.Enable()
+        self.cancelButton.Disable()
+        if status == "Done":
+            self.progressBar.SetValue(PROGRESS_RANGE)
+        else:
+            self.progressBar.SetValue(0)
+        self.progressText.SetLabel(status)
+        self.statusBar.SetStatusText("%s: %s" % (self.JOB_NAME, status))
+        
+        if status.startswith("Error"):
+            generalError(self, "%s failed: %s" % (self.JOB_NAME,
+                                                  status[len("Error -- "):]))
+        
 class OptionsPanel(wx.Panel):
     """
     Class for aligned options fields
@@ -174,9 +420,11 @@ class FileField():
         self.textInput.SetValue( dialog.GetPath() )
         
 class TabConvert(TabPanel):
-    def __init__(self, parent, statusBar=None):
+    JOB_NAME = "Convert"
+    
+    def __init__(self, parent, statusBar=None, jobQueue=None):
         # Run parent constructor
-        TabPanel.__init__(self, parent)
+        TabPanel.__init__(self, parent, jobQueue)
         
         # Add description
         self.description = "Convert Illumina data to FASTQ format"
@@ -191,19 +439,8 @@ class TabConvert(TabPanel):
                                          ["Illumina File", "FASTQ File"],
                                          add=True)
         
-        # Add run button
-        self.runButton = wx.Button(self, wx.ID_ANY, "&Run",
-                                   style=wx.BU_EXACTFIT)
-        self.GetSizer().Add(self.runButton, 0,
-                            wx.ALIGN_BOTTOM | wx.ALIGN_CENTER)
-        self.Bind(wx.EVT_BUTTON, self.run, self.runButton)
-        
-        if statusBar is None:
-            # Add status bar
-            self.statusBar = wx.StatusBar(self)
-            self.GetSizer().Add(self.statusBar, 0, wx.ALIGN_BOTTOM)
-        else:
-            self.statusBar = statusBar
+        # Add run controls
+        self.addRunControls(statusBar)
     
     def run(self, event):
         # Get file paths
@@ -227,21 +464,18 @@ class TabConvert(TabPanel):
             fileNotFoundError(self, fastqPath)
             return
         
-        # Set status message
-        self.statusBar.SetStatusText("Running")
-        
-        # Run conversion
-        libPipeline.convertIlluminaToFASTQ(illuminaFile, fastqFile)
+        # Run conversion in background
+        def convert(job):
+            libPipeline.convertIlluminaToFASTQ(illuminaFile, fastqFile,
+                                               metrics=job.metrics)
         
-        # Close files
-        illuminaFile.close()
-        fastqFile.close()
-        
-        # Set status message
-        self.statusBar.SetStatusText("Done")
+        self.submitJob(convert, files=(illuminaFile, fastqFile),
+                       outputs=(fastqPath,), inputFile=illuminaFile)
 
 class TabRunBowtie(TabPanel):
     # Set class constants
+    JOB_NAME = "Bowtie"
+    
     BOWTIE_DEFAULT_OPTIONS = """
         --solexa1.3-quals -q \
         -n 2 --best -M 1 \
@@ -254,13 +488,14 @@ class TabRunBowtie(TabPanel):
     
     BOWTIE_CMD_PATTERN = "bowtie %(options)s %(index)s %(input)s"
     
-    def __init__(self, parent, statusBar=None):
+    def __init__(self, parent, statusBar=None, jobQueue=None):
         # Run parent constructor
-        TabPanel.__init__(self, parent)
+        TabPanel.__init__(self, parent, jobQueue)
         
         # Add description
         self.description = """
-        Run Bowtie on paired- or single-end FASTQ data with given options
+        Run Bowtie on paired- or single-end FASTQ data with given options;
+        paired-end alignments can be summarized as they are produced
         """.strip()
         self.tabDescription = wx.StaticText(self, wx.ID_ANY)
         self.tabDescription.SetLabel(self.description)
@@ -272,7 +507,8 @@ class TabRunBowtie(TabPanel):
         self.fieldPanel = FileFieldPanel(self,
                                          ("FASTQ File 1", "FASTQ File 2",
                                           "Index File (any)",
-                                          "Alignments File", "Log File"),
+                                          "Alignments File", "Log File",
+                                          "Read Summary File"),
                                          add=True)
         
         # Add checkbox for paired-end
@@ -285,6 +521,16 @@ class TabRunBowtie(TabPanel):
         self.fieldPanel.GetSizer().Add(self.isPairedEnd, 0)
         self.Bind(wx.EVT_CHECKBOX, self.switchPairedEnd, self.isPairedEnd)
         
+        # Add checkbox for summarizing while aligning; the alignments file is
+        # then optional and written as BAM
+        self.summarizeLabel = wx.StaticText(self.fieldPanel, wx.ID_ANY,
+                                            "Summarize while\naligning?")
+        self.fieldPanel.GetSizer().Add(self.summarizeLabel, 0)
+        
+        self.isSummarize = wx.CheckBox(self.fieldPanel, wx.ID_ANY)
+        self.isSummarize.SetValue(False)
+        self.fieldPanel.GetSizer().Add(self.isSummarize, 0)
+        
         # Add text fields to get options for Bowtie
         self.optionsPanel = OptionsPanel(self)
         
@@ -294,19 +540,8 @@ class TabRunBowtie(TabPanel):
         
         self.optionsPanel.addToParent(align=wx.TOP, border=15)
         
-        # Add run button
-        self.runButton = wx.Button(self, wx.ID_ANY, "&Run",
-                                   style=wx.BU_EXACTFIT)
-        self.GetSizer().Add(self.runButton, 0,
-                            wx.ALIGN_BOTTOM | wx.ALIGN_CENTER)
-        self.Bind(wx.EVT_BUTTON, self.run, self.runButton)
-        
-        if statusBar is None:
-            # Add status bar
-            self.statusBar = wx.StatusBar(self)
-            self.GetSizer().Add(self.statusBar, 0, wx.ALIGN_BOTTOM)
-        else:
-            self.statusBar = statusBar
+        # Add run controls
+        self.addRunControls(statusBar)
             
     def switchPairedEnd(self, event):
         """
@@ -331,23 +566,40 @@ class TabRunBowtie(TabPanel):
         outPath     = self.fieldPanel.getFieldValue("Alignments File")
         logPath     = self.fieldPanel.getFieldValue("Log File")
         indexPath   = self.fieldPanel.getFieldValue("Index File (any)")
+        summaryPath = self.fieldPanel.getFieldValue("Read Summary File")
+        summarize   = self.isSummarize.GetValue()
+        
+        if summarize and not self.isPairedEnd.GetValue():
+            generalError(self, "only paired-end alignments can be "
+                         "summarized while aligning")
+            return
+        
+        # Alignments are optional, archived as BAM, when summarizing
+        bamPath = None
+        if summarize and len(outPath.strip()) > 0:
+            bamPath = normalizePaths(outPath)
         
         # Normalize paths
         fastq1Path, fastq2Path      = normalizePaths(fastq1Path, fastq2Path)
         outPath, logPath, indexPath = normalizePaths(outPath, logPath,
                                                      indexPath)
         fastq1Path, fastq2Path = wrapQuotes(fastq1Path, fastq2Path)
+        if summarize:
+            outPath = normalizePaths(summaryPath)
         
         # Open output files
         try:
             outFile = open(outPath, "wb")
         except:
             fileNotFoundError(self, outPath)
+            return
         
         try:
             logFile = open(logPath, "wb")
         except:
             fileNotFoundError(self, logPath)
+            outFile.close()
+            return
         
         # Get options
         isPairedEnd     = self.isPairedEnd.GetValue()
@@ -356,6 +608,8 @@ class TabRunBowtie(TabPanel):
         # Clean options
         bowtieOptions   = ' '.join(bowtieOptions.split('\n'))
         bowtieOptions   = ' '.join(bowtieOptions.split('\\'))
+        if summarize and "-S" not in bowtieOptions.split():
+            bowtieOptions += " -S"
         
         indexBase       = re.match(
                                 r"(.*?)(\.rev)?(\.[0-9]+)?(\.[a-zA-Z]*)?$",
@@ -381,28 +635,47 @@ class TabRunBowtie(TabPanel):
         print cmdString
         print cmdParsed
         
-        # Set status message
-        self.statusBar.SetStatusText("Running")
-        
-        # Run Bowtie
-        bowtie      = subprocess.Popen(cmdParsed, stdout=outFile,
-                                       stderr=logFile)
-        exitStatus  = bowtie.wait()
+        if summarize:
+            # Summarize Bowtie's SAM output in background as it is produced
+            def alignAndSummarize(job):
+                exitStatus = libPipeline.alignToSummaries(cmdParsed, outFile,
+                                                          teePath=bamPath,
+                                                          logFile=logFile,
+                                                          metrics=job.metrics)
+                if exitStatus != 0:
+                    raise RuntimeError("Bowtie exited with status %d -- "
+                                       "check log" % exitStatus)
+            
+            outputs = (outPath,)
+            if bamPath is not None:
+                outputs += (bamPath,)
+            self.submitJob(alignAndSummarize, files=(outFile, logFile),
+                           outputs=outputs)
+            return
         
-        # Close output files
-        outFile.close()
-        logFile.close()
+        # Run Bowtie in background, polling so it can be cancelled
+        def align(job):
+            bowtie      = subprocess.Popen(cmdParsed, stdout=outFile,
+                                           stderr=logFile)
+            job.watchProcess(bowtie)
+            while bowtie.poll() is None:
+                job.reportProgress(None, "Running Bowtie")
+                time.sleep(PROGRESS_INTERVAL)
+            
+            if job.isCancelled():
+                raise libPipeline.JobCancelled(job.name)
+            if bowtie.returncode != 0:
+                raise RuntimeError("Bowtie exited with status %d -- check log"
+                                   % bowtie.returncode)
         
-        # Set status message
-        if exitStatus==0:
-            self.statusBar.SetStatusText("Done")
-        else:
-            self.statusBar.SetStatusText("Error in Bowtie run -- check log")
+        self.submitJob(align, files=(outFile, logFile), outputs=(outPath,))
 
 class TabSummarizeAlignments(TabPanel):
-    def __init__(self, parent, statusBar=None):
+    JOB_NAME = "Summarize"
+    
+    def __init__(self, parent, statusBar=None, jobQueue=None):
         # Run parent constructor
-        TabPanel.__init__(self, parent)
+        TabPanel.__init__(self, parent, jobQueue)
         
         # Add description
         self.description = "Summarize paired-end alignments from Bowtie"
@@ -427,19 +700,8 @@ class TabSummarizeAlignments(TabPanel):
         self.isPairedEnd.SetValue(True)
         self.fieldPanel.GetSizer().Add(self.isPairedEnd, 0)
         
-        # Add run button
-        self.runButton = wx.Button(self, wx.ID_ANY, "&Run",
-                                   style=wx.BU_EXACTFIT)
-        self.GetSizer().Add(self.runButton, 0,
-                            wx.ALIGN_BOTTOM | wx.ALIGN_CENTER)
-        self.Bind(wx.EVT_BUTTON, self.run, self.runButton)
-        
-        if statusBar is None:
-            # Add status bar
-            self.statusBar = wx.StatusBar(self)
-            self.GetSizer().Add(self.statusBar, 0, wx.ALIGN_BOTTOM)
-        else:
-            self.statusBar = statusBar
+        # Add run controls
+        self.addRunControls(statusBar)
     
     def run(self, event):
         # Get file paths
@@ -463,23 +725,20 @@ class TabSummarizeAlignments(TabPanel):
             fileNotFoundError(self, outPath)
             return
         
-        # Set status message
-        self.statusBar.SetStatusText("Running")
-        
-        # Summarize Bowtie output
-        libPipeline.processBowtieOutput(alignmentsFile, outFile, pairedEnd)
+        # Summarize Bowtie output in background
+        def summarize(job):
+            libPipeline.processBowtieOutput(alignmentsFile, outFile,
+                                            pairedEnd, metrics=job.metrics)
         
-        # Close files
-        alignmentsFile.close()
-        outFile.close()
-        
-        # Set status message
-        self.statusBar.SetStatusText("Done")
+        self.submitJob(summarize, files=(alignmentsFile, outFile),
+                       outputs=(outPath,), inputFile=alignmentsFile)
 
 class TabReadsToCounts(TabPanel):
-    def __init__(self, parent, statusBar=None):
+    JOB_NAME = "Count"
+    
+    def __init__(self, parent, statusBar=None, jobQueue=None):
         # Run parent constructor
-        TabPanel.__init__(self, parent)
+        TabPanel.__init__(self, parent, jobQueue)
         
         # Add description
         self.description = "Count read centers by base-pair for each chromosome"
@@ -504,19 +763,8 @@ class TabReadsToCounts(TabPanel):
         self.isRandomize.SetValue(True)
         self.fieldPanel.GetSizer().Add(self.isRandomize, 0)
         
-        # Add run button
-        self.runButton = wx.Button(self, wx.ID_ANY, "&Run",
-                                   style=wx.BU_EXACTFIT)
-        self.GetSizer().Add(self.runButton, 0,
-                            wx.ALIGN_BOTTOM | wx.ALIGN_CENTER)
-        self.Bind(wx.EVT_BUTTON, self.run, self.runButton)
-        
-        if statusBar is None:
-            # Add status bar
-            self.statusBar = wx.StatusBar(self)
-            self.GetSizer().Add(self.statusBar, 0, wx.ALIGN_BOTTOM)
-        else:
-            self.statusBar = statusBar
+        # Add run controls
+        self.addRunControls(statusBar)
     
     def run(self, event):
         # Get file paths
@@ -539,24 +787,21 @@ class TabReadsToCounts(TabPanel):
             fileNotFoundError(self, outPath)
             return
         
-        # Set status message
-        self.statusBar.SetStatusText("Running")
-        
-        # Convert reads to counts by bp
-        libPipeline.readsToCounts(readsFile, outFile,
-                                  self.isRandomize.GetValue())
+        # Convert reads to counts by bp in background
+        randomize = self.isRandomize.GetValue()
+        def count(job):
+            libPipeline.readsToCounts(readsFile, outFile, randomize,
+                                      metrics=job.metrics)
         
-        # Close files
-        readsFile.close()
-        outFile.close()
-        
-        # Set status message
-        self.statusBar.SetStatusText("Done")
+        self.submitJob(count, files=(readsFile, outFile),
+                       outputs=(outPath,), inputFile=readsFile)
 
 class TabReadLengthDist(TabPanel):
-    def __init__(self, parent, statusBar=None):
+    JOB_NAME = "Fragment lengths"
+    
+    def __init__(self, parent, statusBar=None, jobQueue=None):
         # Run parent constructor
-        TabPanel.__init__(self, parent)
+        TabPanel.__init__(self, parent, jobQueue)
         
         # Add description
         self.description = "Tabulate distribution of fragment lengths"
@@ -572,19 +817,8 @@ class TabReadLengthDist(TabPanel):
                                           "Fragment Length Dist. File"],
                                          add=True)
         
-        # Add run button
-        self.runButton = wx.Button(self, wx.ID_ANY, "&Run",
-                                   style=wx.BU_EXACTFIT)
-        self.GetSizer().Add(self.runButton, 0,
-                            wx.ALIGN_BOTTOM | wx.ALIGN_CENTER)
-        self.Bind(wx.EVT_BUTTON, self.run, self.runButton)
-        
-        if statusBar is None:
-            # Add status bar
-            self.statusBar = wx.StatusBar(self)
-            self.GetSizer().Add(self.statusBar, 0, wx.ALIGN_BOTTOM)
-        else:
-            self.statusBar = statusBar
+        # Add run controls
+        self.addRunControls(statusBar)
     
     def run(self, event):
         # Get file paths
@@ -607,27 +841,25 @@ class TabReadLengthDist(TabPanel):
             fileNotFoundError(self, outPath)
             return
         
-        # Set status message
-        self.statusBar.SetStatusText("Running")
-        
-        # Tabulate length distribution
-        libPipeline.getReadLengthDist(readsFile, outFile)
-        
-        # Close files
-        readsFile.close()
-        outFile.close()
+        # Tabulate length distribution in background
+        def tabulate(job):
+            libPipeline.getReadLengthDist(readsFile, outFile,
+                                          metrics=job.metrics)
         
-        # Set status message
-        self.statusBar.SetStatusText("Done")
+        self.submitJob(tabulate, files=(readsFile, outFile),
+                       outputs=(outPath,), inputFile=readsFile)
 
 
 class NotebookPanel(wx.Notebook):
     """
     Class for notebook environment
     """
-    def __init__(self,parent, statusBar=None):
-        # Save status bar object
+    def __init__(self,parent, statusBar=None, jobQueue=None):
+        # Save status bar object & job queue shared by tabs
         self.statusBar = statusBar
+        if jobQueue is None:
+            jobQueue = JobQueue()
+        self.jobQueue = jobQueue
         
         # Setup notebook
         wx.Notebook.__init__(self, parent, id=wx.ID_ANY, style=
@@ -638,11 +870,16 @@ class NotebookPanel(wx.Notebook):
                              #wx.BK_RIGHT
                              )
         
-        self.tabConvert     = TabConvert(self, statusBar = statusBar)
-        self.tabBowtie      = TabRunBowtie(self, statusBar = statusBar)
-        self.tabSummarize   = TabSummarizeAlignments(self, statusBar=statusBar)
-        self.tabReadsToCounts = TabReadsToCounts(self, statusBar = statusBar)
-        self.tabLengthDist  = TabReadLengthDist(self, statusBar = statusBar)
+        self.tabConvert     = TabConvert(self, statusBar = statusBar,
+                                         jobQueue = jobQueue)
+        self.tabBowtie      = TabRunBowtie(self, statusBar = statusBar,
+                                           jobQueue = jobQueue)
+        self.tabSummarize   = TabSummarizeAlignments(self, statusBar=statusBar,
+                                                     jobQueue=jobQueue)
+        self.tabReadsToCounts = TabReadsToCounts(self, statusBar = statusBar,
+                                                 jobQueue = jobQueue)
+        self.tabLengthDist  = TabReadLengthDist(self, statusBar = statusBar,
+                                                jobQueue = jobQueue)
         
         self.AddPage(self.tabConvert, "Convert")
         self.AddPage(self.tabBowtie, "Run Bowtie")
@@ -668,7 +905,12 @@ class AppFrame(wx.Frame):
         panel = wx.Panel(self)
         self.CreateStatusBar()
         
-        notebook = NotebookPanel(panel, statusBar=self.GetStatusBar())
+        # Setup job queue shared by all tabs
+        self.jobQueue = JobQueue()
+        self.Bind(wx.EVT_CLOSE, self.close)
+        
+        notebook = NotebookPanel(panel, statusBar=self.GetStatusBar(),
+                                 jobQueue=self.jobQueue)
         self.copyrightMsg = wx.StaticText(panel, wx.ID_ANY, self.COPYRIGHT_TXT)
         sizer = wx.BoxSizer(wx.VERTICAL)
         sizer.Add(notebook, 1, wx.ALL|wx.EXPAND, 5)
@@ -684,6 +926,24 @@ class AppFrame(wx.Frame):
         # Hack to make notebook draw properly on Windows
         self.SetSize(wx.Size(800,499))
         self.SetSize(wx.Size(800,500))
+    
+    def close(self, event):
+        """
+        Confirm before closing with jobs still running, then cancel them
+        """
+        if len(self.jobQueue.activeJobs()) > 0:
+            dialog = wx.MessageDialog(self, "Jobs are still running. Cancel "
+                                      "them and quit?", "Quit",
+                                      style=wx.YES_NO | wx.ICON_QUESTION)
+            answer = dialog.ShowModal()
+            dialog.Destroy()
+            if answer != wx.ID_YES:
+                event.Veto()
+                return
+            
+            self.jobQueue.cancelAll()
+        
+        self.Destroy()
 
 if __name__ == "__main__":
     # Run GUI application
@@ -0,0 +1,134 @@
+#!python
+
+# Load libraries
+import sys, os, getopt
+
+import numpy as np
+
+import libPipeline
+
+HELP_MSG = '''
+SYNOPSIS
+    queryRegions
+    queryRegions [OPTIONS] FILE REGION [REGION ...]
+    #
+DESCRIPTION
+    queryRegions.py
+
+    Prints the fragments or counts in each REGION from a read summary or
+    counts file, reading only the part of FILE covering the region.
+    Prints results to stdout.
+
+    REGION is chrom, chrom:start or chrom:start-end, with 0-based, half-open
+    coordinates as in the counts arrays.
+
+    For read summaries (text or binary), the fragments overlapping each region
+    are printed in summary format, sorted by start. They are read via a region
+    index, FILE.idx, which is built first if missing or out of date (see the
+    --region-index option of parseSAMOutput.py and parseBowtieOutput.py).
+
+    For counts, the counts in each region are printed comma-separated, one
+    region per line. Text counts are read via a region index, FILE.idx.npz,
+    built in the same way (see readsToChromCounts.py --region-index); counts
+    directories and npz archives are read one chromosome at a time.
+
+    With --bin or --smooth, FILE is a tracks directory written by
+    readsToChromCounts.py --tracks-dir, and the binned sums overlapping each
+    region or the smoothed counts in it are printed in the same way. With
+    --lengths, the track is read from the counts for that fragment length
+    class (see readsToChromCounts.py --length-bins), at full resolution
+    unless --bin or --smooth is also given.
+
+OPTIONS
+    --build             Only build the region index for FILE; no REGION is
+                        needed
+    --bin=              Read the track of counts binned to this many bp
+    --smooth=           Read the track smoothed with this standard deviation
+    --lengths=          Read the track for this fragment length class,
+                        given as low-high as for --length-bins
+    -h/--help           Print help message and exit
+'''
+
+def isSummaryFile(path):
+  '''Function to check whether path holds read summaries rather than
+  counts'''
+  if os.path.isdir(path):
+    return False
+
+  with libPipeline.openCompressed(path, 'rb') as f:
+    start = f.read(len(libPipeline.HEADER))
+  return (start.startswith(libPipeline.SUMMARY_MAGIC) or
+          start == libPipeline.HEADER)
+
+if __name__ == "__main__":
+  # Set defaults
+  buildOnly = False
+  binSize = None
+  smoothSigma = None
+  lengths = None
+
+  # Parse arguments
+  options, args = getopt.getopt(sys.argv[1:], "h", ["help", "build", "bin=",
+                                                    "smooth=", "lengths="])
+
+  for opt, value in options:
+    if opt in ('-h', "--help"):
+      sys.stderr.write(HELP_MSG)
+      sys.exit(2)
+    elif opt == "--build":
+      buildOnly = True
+    elif opt == "--bin":
+      binSize = int(value)
+    elif opt == "--smooth":
+      smoothSigma = float(value)
+    elif opt == "--lengths":
+      try:
+        lengths, = libPipeline.parseLengthBins(value)
+      except ValueError:
+        print >> sys.stderr, "Error: invalid length class %s" % value
+        sys.exit(1)
+    else:
+      print >> sys.stderr, "Error: unknown option %s" % opt
+      sys.exit(1)
+
+  if len(args) < 1 or (len(args) < 2 and not buildOnly):
+    print >> sys.stderr, "Error -- need file and at least one region"
+    sys.exit(1)
+
+  path = args[0]
+  regions = args[1:]
+
+  isTrack = (binSize is not None or smoothSigma is not None or
+             lengths is not None)
+
+  try:
+    isSummary = not isTrack and isSummaryFile(path)
+    if buildOnly:
+      if isSummary:
+        libPipeline.indexSummaries(path)
+      else:
+        libPipeline.indexCounts(path)
+      sys.exit(0)
+
+    for region in regions:
+      if isSummary:
+        chrom = libPipeline.parseRegion(region)[0]
+        fragments = libPipeline.querySummaries(path, region)
+        for i in xrange(fragments['start'].size):
+          sys.stdout.write(libPipeline.OUTPUT_FORMAT %
+                           ((chrom,) + tuple(fragments[field][i] for field in
+                                             libPipeline.OUTPUT_FIELDS[1:])))
+      else:
+        if isTrack:
+          counts = libPipeline.queryTrack(path, region, binSize, smoothSigma,
+                                          lengths)
+        else:
+          counts = libPipeline.queryCounts(path, region)
+        np.savetxt(sys.stdout, counts[np.newaxis,:],
+                   fmt='%.4g' if smoothSigma is not None else '%.1f',
+                   delimiter=',')
+  except (IOError, ValueError) as e:
+    print >> sys.stderr, "Error -- %s" % e
+    sys.exit(1)
+
+  sys.exit(0)
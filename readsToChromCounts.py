@@ -16,22 +16,80 @@ DESCRIPTION
 
     Parses Bowtie alignments into paired-end read summaries.
     Prints results to stdout.
+    FILE may be a text or binary read summary, optionally gzip/bgzip or zstd
+    compressed.
 
 OPTIONS
     -r/--randomize      Randomize assignment of ambiguous fragment centers
-    --seed=             Set seed for RNG; initialized from /dev/urandom by
+    --seed=             Set seed for RNG, giving reproducible counts with
+                        --randomize; initialized from /dev/urandom by
                         default.
+    --layout=           SAM/BAM file or FASTA index (.fai) giving the
+                        chromosome names and lengths; defaults to yeast
+    --format=           Output encoding: text (default; comma-separated, one
+                        chromosome per line), sparse (nonzero positions),
+                        npz (binary) or bedgraph
+    --counts-dir=       Accumulate counts in memory-mapped .npy files in this
+                        directory, one per chromosome; these form the output,
+                        so nothing is written to stdout unless --output is
+                        given
+    --dtype=            Counts type: float64 (default), float32, uint32 or
+                        uint16; integer types require --randomize, except
+                        with --coverage
+    --coverage          Count the fragments covering each base instead of
+                        fragment centers
+    --tracks-dir=       Also write zoom levels computed from the counts to
+                        this directory: binned sums in binN/ and the smoothed
+                        track in smoothS/, each a counts directory
+    --bins=             Comma-separated bin sizes in bp for --tracks-dir;
+                        defaults to %s
+    --smooth=           Standard deviation in bp of a Gaussian kernel used to
+                        smooth the counts for --tracks-dir
+    --length-bins=      Comma-separated fragment length classes low-high in
+                        bp (low <= length < high; omit high for no limit),
+                        e.g. 0-120,120-180,250-. Fragment centers in each
+                        class are also counted, in the same pass, to
+                        lengthLOW-HIGH/ in --tracks-dir, which is required;
+                        each is a counts directory with its own zoom levels
+    --output=           Write results to file instead of stdout; compressed
+                        if it ends in .gz/.bgz (bgzip) or .zst
+    --region-index      Also index text counts by region, to OUTPUT.idx.npz,
+                        for queryRegions.py; requires an uncompressed
+                        --output. Counts directories and npz output need no
+                        index.
+    --metrics=          Write stage metrics (records, discards, bytes and time
+                        spent parsing, computing and writing) to file as JSON at
+                        exit
+    --progress=         Print progress to stderr every given number of seconds
     -h/--help           Print help message and exit
-'''
+''' % ','.join(str(size) for size in libPipeline.TRACK_BIN_SIZES)
 
 if __name__ == "__main__":
   # Set defaults
   randomize = False
   seed = None
+  outFile = None
+  outputPath = None
+  regionIndex = False
+  countsDir = None
+  dtype = 'float64'
+  mode = 'centers'
+  countsFormat = 'text'
+  chromLayout = libPipeline.DEFAULT_LAYOUT
+  tracksDir = None
+  binSizes = libPipeline.TRACK_BIN_SIZES
+  smoothSigma = None
+  lengthBins = None
+  metricsPath = None
+  progressInterval = None
 
   # Parse arguments
   options, args = getopt.getopt(sys.argv[1:], "hr",
-                                ["help","randomize","seed="])
+                                ["help","randomize","seed=","output=",
+                                 "format=","layout=","counts-dir=",
+                                 "dtype=","tracks-dir=","bins=","smooth=",
+                                 "length-bins=","region-index","coverage",
+                                 "metrics=","progress="])
 
   for opt, value in options:
     if opt in ('-h', "--help"):
@@ -41,6 +99,43 @@ if __name__ == "__main__":
       randomize = True
     elif opt in ("--seed",):
       seed = int(value)
+    elif opt == "--output":
+      outputPath = value
+      outFile = libPipeline.openCompressed(value, "wb")
+    elif opt == "--region-index":
+      regionIndex = True
+    elif opt == "--format":
+      if value not in libPipeline.COUNTS_FORMATS:
+        print >> sys.stderr, "Error: unknown format %s" % value
+        sys.exit(1)
+      countsFormat = value
+    elif opt == "--layout":
+      chromLayout = libPipeline.loadChromLayout(value)
+    elif opt == "--counts-dir":
+      countsDir = value
+    elif opt == "--dtype":
+      if value not in ('float64', 'float32', 'uint32', 'uint16'):
+        print >> sys.stderr, "Error: unsupported dtype %s" % value
+        sys.exit(1)
+      dtype = value
+    elif opt == "--tracks-dir":
+      tracksDir = value
+    elif opt == "--bins":
+      binSizes = [int(size) for size in value.split(',')]
+    elif opt == "--smooth":
+      smoothSigma = float(value)
+    elif opt == "--length-bins":
+      try:
+        lengthBins = libPipeline.parseLengthBins(value)
+      except ValueError as e:
+        print >> sys.stderr, "Error: %s" % e
+        sys.exit(1)
+    elif opt == "--coverage":
+      mode = 'coverage'
+    elif opt == "--metrics":
+      metricsPath = value
+    elif opt == "--progress":
+      progressInterval = float(value)
     else:
       print >> sys.stderr, "Error: unknown option %s" % opt
       sys.exit(1)
@@ -49,16 +144,47 @@ if __name__ == "__main__":
     dataFilename = args[0]
     dataFile = args[0]
     try:
-      dataFile = open(dataFilename, 'rb')
+      dataFile = libPipeline.openCompressed(dataFilename, 'rb')
     except:
       print >> sys.stderr, "Error -- could not open %s" % args[0]
       sys.exit(1)
   else:
     dataFile = sys.stdin
 
-  np.random.seed(seed)
+  if outFile is None and countsDir is None:
+    outFile = sys.stdout
+
+  if regionIndex and (countsFormat != 'text' or outputPath is None or
+                      libPipeline.getCompression(outputPath) is not None):
+    print >> sys.stderr, ("Error: --region-index requires text counts and "
+                          "an uncompressed --output")
+    sys.exit(1)
+
+  if lengthBins is not None and tracksDir is None:
+    print >> sys.stderr, "Error: --length-bins requires --tracks-dir"
+    sys.exit(1)
+
+  if dtype.startswith('uint') and not randomize and mode != 'coverage':
+    print >> sys.stderr, "Error: --dtype=%s requires --randomize" % dtype
+    sys.exit(1)
+
+  # Report metrics as requested
+  metrics = libPipeline.Metrics(progressInterval)
+  if metricsPath is not None:
+    metrics.exportAtExit(metricsPath)
 
   # Tabulate read centers per base pair
-  libPipeline.readsToCounts(dataFile, sys.stdout, randomize)
+  libPipeline.readsToCounts(dataFile, outFile, randomize,
+                            countsFormat=countsFormat,
+                            chromLayout=chromLayout, countsDir=countsDir,
+                            dtype=np.dtype(dtype), tracksDir=tracksDir,
+                            binSizes=binSizes, smoothSigma=smoothSigma,
+                            lengthBins=lengthBins, mode=mode, seed=seed,
+                            metrics=metrics)
+  if outFile is not None:
+    outFile.close()
+
+  if regionIndex:
+    libPipeline.indexCounts(outputPath)
 
   sys.exit(0)
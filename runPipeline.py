@@ -0,0 +1,475 @@
+#!python
+
+# Load libraries
+import sys, os, getopt, shlex, glob
+import subprocess
+import multiprocessing
+
+import libPipeline
+
+# Set constants
+HELP_MSG = '''
+SYNOPSIS
+    runPipeline
+    runPipeline [OPTIONS] --index=INDEX SAMPLESHEET
+    #
+DESCRIPTION
+    runPipeline.py
+
+    Runs the whole pipeline on each sample in SAMPLESHEET: conversion to
+    FASTQ, Bowtie, read summaries, counts and the fragment length
+    distribution. Several samples are processed at once, with the total
+    number of CPU threads capped.
+
+    SAMPLESHEET is tab-delimited with one sample per line: a name followed by
+    one (single-end) or two (paired-end) raw data files. Files ending in
+    .fq/.fastq (optionally compressed) are passed to Bowtie as is; others are
+    converted from Illumina format first. Blank lines and lines starting with
+    # are ignored.
+
+    Outputs go to OUTDIR/NAME.*: .fastq / _1.fastq / _2.fastq, .sam (or
+    .bowtie for single-end), .bowtie.log, .summary.txt, .counts.txt and
+    .lengths.txt (.sam is replaced by .bam, or omitted, with --pipe). Each
+    stage is skipped if its outputs are newer than its inputs, and a sample
+    is skipped entirely if its counts and length distribution (and coverage)
+    are newer than its raw data.
+
+    With --cache-dir, stage outputs are instead cached, keyed by the stage's
+    inputs and parameters, in place of the modification time checks.
+    Changing only, say, the counts options then reruns only the counts, and
+    switching back restores the earlier counts from the cache.
+
+OPTIONS
+    --index=            Bowtie index prefix (required)
+    --output-dir=       Directory for outputs; defaults to current directory
+    -t/--threads=       Total CPU threads to use; defaults to number of CPUs
+    -j/--jobs=          Number of samples to process at once; defaults to
+                        threads / 4
+    --bowtie-threads=   Threads per Bowtie run; defaults to threads / jobs.
+                        Each Bowtie run waits for this many free threads,
+                        and each Python stage for one.
+    --bowtie-options=   Bowtie options, excluding --threads and input/output;
+                        defaults to "%s"
+    --stream            Summarize SAM in a single pass, without samtools
+    --pipe              For paired-end samples, summarize Bowtie's SAM output
+                        as it is produced instead of writing it to disk;
+                        implies --stream, with duplicates removed in memory
+    --keep-bam          With --pipe, also archive the alignments to
+                        OUTDIR/NAME.bam
+    --rmdup             Remove duplicate reads (reduces PCR effects)
+    -r/--randomize      Randomize assignment of ambiguous fragment centers
+    --seed=             Set seed for RNG, used afresh for each sample so that
+                        its counts do not depend on -j
+    --layout=           SAM/BAM file or FASTA index (.fai) giving the
+                        chromosome names and lengths; defaults to yeast
+    --format=           Counts encoding: text (default), sparse, npz or
+                        bedgraph; see readsToChromCounts.py
+    -o/--offset=        Offset added to fragment lengths; defaults to 0
+    --coverage          Also count the fragments covering each base, to
+                        OUTDIR/NAME.coverage.txt in the counts format
+    --region-index      Index summaries (and text counts) by region, to
+                        .summary.txt.idx and .counts.txt.idx.npz, for
+                        queryRegions.py
+    --cache-dir=        Cache stage outputs in this directory
+    --cache-size=       Maximum cache size in GiB; least recently used
+                        outputs are evicted beyond it. Defaults to %d
+    --cache-hash        Identify cached inputs by content hash instead of size
+                        and modification time
+    --metrics           Write metrics for the stages run for each sample to
+                        OUTDIR/NAME.metrics.json
+    --progress=         Print progress to stderr every given number of seconds
+    --force             Rerun every stage, even if up to date
+    -h/--help           Print help message and exit
+''' % (' '.join(libPipeline.BOWTIE_OPTIONS),
+       libPipeline.CACHE_MAX_BYTES // 2**30)
+
+FASTQ_EXTENSIONS = ('.fq', '.fastq')
+
+# Thread slots shared by worker processes; set by initWorker
+threadSlots = None
+threadGate = None
+
+def readSampleSheet(sheetFile):
+  '''Function to parse a sample sheet into a list of (name, rawPaths)
+  tuples'''
+  samples = []
+  for line in sheetFile:
+    fields = [field.strip() for field in line.rstrip('\r\n').split('\t')]
+    fields = [field for field in fields if len(field) > 0]
+    if len(fields) == 0 or fields[0].startswith('#'):
+      continue
+
+    if len(fields) not in (2, 3):
+      raise ValueError('Expected name and one or two files, got: %s' %
+                       line.strip())
+    samples.append( (fields[0], fields[1:]) )
+
+  return samples
+
+def initWorker(slots, gate):
+  '''Pool initializer to share the thread slots with worker processes'''
+  global threadSlots, threadGate
+  threadSlots = slots
+  threadGate = gate
+
+def acquireThreads(nThreads):
+  '''Block until nThreads thread slots are free, then take them. The gate
+  stops two stages each holding part of what they need.'''
+  with threadGate:
+    for i in xrange(nThreads):
+      threadSlots.acquire()
+
+def releaseThreads(nThreads):
+  for i in xrange(nThreads):
+    threadSlots.release()
+
+def upToDate(outputs, inputs):
+  '''Function to check whether all outputs exist and are newer than all
+  inputs'''
+  if not all(os.path.exists(path) for path in outputs):
+    return False
+
+  return (min(os.path.getmtime(path) for path in outputs) >=
+          max(os.path.getmtime(path) for path in inputs))
+
+def runStage(sample, stage, inputs, outputs, params, nThreads, config, func,
+             *args):
+  '''Function to run a single stage of a sample, unless its outputs are up to
+  date or cached for the same inputs and params. Partial outputs are removed
+  if the stage fails.'''
+  cache = config['cache']
+  if cache is None and not config['force'] and upToDate(outputs, inputs):
+    print >> sys.stderr, '%s: %s up to date' % (sample, stage)
+    return
+
+  if cache is not None:
+    key = cache.key(stage, inputs, params)
+    if not config['force'] and cache.fetch(key, outputs):
+      print >> sys.stderr, '%s: %s restored from cache' % (sample, stage)
+      return
+
+  acquireThreads(nThreads)
+  try:
+    print >> sys.stderr, '%s: running %s' % (sample, stage)
+    func(*args)
+  except:
+    for path in outputs:
+      if os.path.exists(path):
+        os.remove(path)
+    raise
+  finally:
+    releaseThreads(nThreads)
+
+  if cache is not None:
+    cache.store(key, outputs)
+
+def isFASTQ(path):
+  root = path
+  if libPipeline.getCompression(path) is not None:
+    root = os.path.splitext(path)[0]
+  return os.path.splitext(root)[1].lower() in FASTQ_EXTENSIONS
+
+def convertStage(rawPath, fastqPath, metrics):
+  dataFile = libPipeline.openCompressed(rawPath, 'rb')
+  with open(fastqPath, 'wb') as outFile:
+    libPipeline.convertIlluminaToFASTQ(dataFile, outFile, metrics=metrics)
+  dataFile.close()
+
+def bowtieStage(cmd, outPath, logPath):
+  with open(outPath, 'wb') as outFile:
+    with open(logPath, 'wb') as logFile:
+      bowtie = subprocess.Popen(cmd, stdout=outFile, stderr=logFile)
+      exitStatus = bowtie.wait()
+
+  if exitStatus != 0:
+    raise RuntimeError('Bowtie exited with status %d; see %s' %
+                       (exitStatus, logPath))
+
+def pipeStage(cmd, summaryPath, logPath, bamPath, config, metrics):
+  with open(summaryPath, 'wb') as outFile:
+    with open(logPath, 'wb') as logFile:
+      exitStatus = libPipeline.alignToSummaries(cmd, outFile,
+                                                rmdup=config['rmdup'],
+                                                teePath=bamPath,
+                                                logFile=logFile,
+                                                metrics=metrics)
+
+  if exitStatus != 0:
+    raise RuntimeError('Bowtie exited with status %d; see %s' %
+                       (exitStatus, logPath))
+
+def summaryStage(alignmentPath, summaryPath, pairedEnd, config, metrics):
+  with open(summaryPath, 'wb') as outFile:
+    if not pairedEnd:
+      with open(alignmentPath, 'rb') as alignmentFile:
+        libPipeline.processBowtieOutput(alignmentFile, outFile,
+                                        pairedEnd=False, metrics=metrics)
+    elif config['stream']:
+      libPipeline.streamSAMOutput(alignmentPath, outFile,
+                                  rmdup=config['rmdup'], metrics=metrics)
+    else:
+      libPipeline.processSAMOutput(alignmentPath, outFile,
+                                   rmdup=config['rmdup'],
+                                   cache=config['cache'], metrics=metrics)
+
+def countsStage(summaryPath, countsPath, config, metrics, mode='centers'):
+  dataFile = libPipeline.openCompressed(summaryPath, 'rb')
+  with open(countsPath, 'wb') as outFile:
+    libPipeline.readsToCounts(dataFile, outFile, config['randomize'],
+                              countsFormat=config['countsFormat'],
+                              chromLayout=config['chromLayout'], mode=mode,
+                              seed=config['seed'], metrics=metrics)
+  dataFile.close()
+
+def lengthsStage(summaryPath, lengthsPath, config, metrics):
+  dataFile = libPipeline.openCompressed(summaryPath, 'rb')
+  with open(lengthsPath, 'wb') as outFile:
+    libPipeline.getReadLengthDist(dataFile, outFile, config['offset'],
+                                  chromLayout=config['chromLayout'],
+                                  metrics=metrics)
+  dataFile.close()
+
+def runSample(job):
+  '''Function to run all stages for one sample. Returns (name, error), with
+  error None on success.'''
+  (name, rawPaths), config = job
+  prefix = os.path.join(config['outputDir'], name)
+  pairedEnd = len(rawPaths) > 1
+
+  countsPath = prefix + '.counts.txt'
+  lengthsPath = prefix + '.lengths.txt'
+  coveragePath = prefix + '.coverage.txt'
+  finalPaths = [countsPath, lengthsPath]
+  if config['coverage']:
+    finalPaths.append(coveragePath)
+  metrics = libPipeline.Metrics(config['progress'])
+
+  try:
+    if (config['cache'] is None and not config['force'] and
+        upToDate(finalPaths, rawPaths)):
+      print >> sys.stderr, '%s: up to date' % name
+      return (name, None)
+
+    # Convert raw data to FASTQ as needed
+    fastqPaths = []
+    for i, rawPath in enumerate(rawPaths):
+      if isFASTQ(rawPath):
+        fastqPaths.append(rawPath)
+        continue
+
+      if pairedEnd:
+        fastqPath = '%s_%d.fastq' % (prefix, i + 1)
+      else:
+        fastqPath = prefix + '.fastq'
+      runStage(name, 'conversion', [rawPath], [fastqPath], None, 1, config,
+               convertStage, rawPath, fastqPath, metrics)
+      fastqPaths.append(fastqPath)
+
+    # Align with Bowtie; SAM for paired-end, standard output for single-end
+    if pairedEnd:
+      alignmentPath = prefix + '.sam'
+    else:
+      alignmentPath = prefix + '.bowtie'
+    cmd = libPipeline.bowtieCommand(config['index'], fastqPaths,
+                                    config['bowtieOptions'],
+                                    config['bowtieThreads'], sam=pairedEnd)
+    indexPaths = sorted(glob.glob(config['index'] + '.*ebwt'))
+    bowtieParams = {'options' : list(config['bowtieOptions']),
+                    'index' : config['index'], 'pairedEnd' : pairedEnd}
+    summaryPath = prefix + '.summary.txt'
+
+    if pairedEnd and config['pipe']:
+      # Summarize alignments as Bowtie produces them
+      bamPath = None
+      outputs = [summaryPath, prefix + '.bowtie.log']
+      if config['keepBam']:
+        bamPath = prefix + '.bam'
+        outputs.append(bamPath)
+      bowtieParams.update(rmdup=config['rmdup'], keepBam=config['keepBam'])
+      runStage(name, 'Bowtie and summaries', fastqPaths + indexPaths, outputs,
+               bowtieParams, config['bowtieThreads'], config, pipeStage, cmd,
+               summaryPath, prefix + '.bowtie.log', bamPath, config, metrics)
+    else:
+      runStage(name, 'Bowtie', fastqPaths + indexPaths,
+               [alignmentPath, prefix + '.bowtie.log'], bowtieParams,
+               config['bowtieThreads'], config, bowtieStage, cmd,
+               alignmentPath, prefix + '.bowtie.log')
+
+      # Summarize alignments
+      runStage(name, 'summaries', [alignmentPath], [summaryPath],
+               {'pairedEnd' : pairedEnd, 'rmdup' : config['rmdup'],
+                'stream' : config['stream']},
+               1, config, summaryStage, alignmentPath, summaryPath, pairedEnd,
+               config, metrics)
+
+    if config['regionIndex']:
+      indexPath = summaryPath + libPipeline.REGION_INDEX_SUFFIX
+      runStage(name, 'summary index', [summaryPath], [indexPath], None, 1,
+               config, libPipeline.indexSummaries, summaryPath, indexPath)
+
+    # Tabulate counts and lengths
+    runStage(name, 'counts', [summaryPath], [countsPath],
+             {'randomize' : config['randomize'], 'seed' : config['seed'],
+              'countsFormat' : config['countsFormat'],
+              'chromLayout' : config['chromLayout'].items()},
+             1, config, countsStage, summaryPath, countsPath, config, metrics)
+    if config['regionIndex'] and config['countsFormat'] == 'text':
+      indexPath = countsPath + libPipeline.COUNTS_INDEX_SUFFIX
+      runStage(name, 'counts index', [countsPath], [indexPath], None, 1,
+               config, libPipeline.indexCounts, countsPath, indexPath)
+    if config['coverage']:
+      runStage(name, 'coverage', [summaryPath], [coveragePath],
+               {'countsFormat' : config['countsFormat'],
+                'chromLayout' : config['chromLayout'].items()},
+               1, config, countsStage, summaryPath, coveragePath, config,
+               metrics, 'coverage')
+    runStage(name, 'length distribution', [summaryPath], [lengthsPath],
+             {'offset' : config['offset'],
+              'chromLayout' : config['chromLayout'].items()},
+             1, config, lengthsStage, summaryPath, lengthsPath, config,
+             metrics)
+  except Exception as e:
+    return (name, '%s: %s' % (type(e).__name__, e))
+  finally:
+    if config['metrics']:
+      metrics.writeJSON(prefix + '.metrics.json')
+
+  return (name, None)
+
+def runPipeline(samples, config, nThreads, nJobs):
+  '''Function to run all samples, nJobs at a time, using at most nThreads
+  CPU threads. Returns a list of (name, error) tuples for failed samples.'''
+  slots = multiprocessing.BoundedSemaphore(nThreads)
+  gate = multiprocessing.Lock()
+
+  pool = multiprocessing.Pool(nJobs, initWorker, (slots, gate))
+  failed = []
+  for name, error in pool.imap_unordered(runSample, [(sample, config)
+                                                     for sample in samples]):
+    if error is None:
+      print >> sys.stderr, '%s: done' % name
+    else:
+      print >> sys.stderr, '%s: failed -- %s' % (name, error)
+      failed.append( (name, error) )
+  pool.close()
+  pool.join()
+
+  return failed
+
+if __name__ == "__main__":
+  # Set defaults
+  nThreads = multiprocessing.cpu_count()
+  nJobs = None
+  config = {'index' : None, 'outputDir' : '.', 'bowtieThreads' : None,
+            'bowtieOptions' : libPipeline.BOWTIE_OPTIONS, 'stream' : False,
+            'pipe' : False, 'keepBam' : False, 'regionIndex' : False,
+            'coverage' : False,
+            'rmdup' : False, 'randomize' : False, 'seed' : None,
+            'chromLayout' : libPipeline.DEFAULT_LAYOUT,
+            'countsFormat' : 'text', 'offset' : 0, 'force' : False,
+            'cache' : None, 'metrics' : False, 'progress' : None}
+  cacheDir = None
+  cacheBytes = libPipeline.CACHE_MAX_BYTES
+  hashContent = False
+
+  # Parse arguments
+  options, args = getopt.getopt(sys.argv[1:], "ht:j:ro:",
+                                ["help", "index=", "output-dir=", "threads=",
+                                 "jobs=", "bowtie-threads=", "bowtie-options=",
+                                 "stream", "pipe", "keep-bam", "rmdup",
+                                 "randomize", "seed=", "layout=", "format=",
+                                 "offset=", "cache-dir=", "cache-size=",
+                                 "cache-hash", "region-index", "coverage",
+                                 "metrics", "progress=", "force"])
+
+  for opt, value in options:
+    if opt in ('-h', "--help"):
+      sys.stderr.write(HELP_MSG)
+      sys.exit(2)
+    elif opt == "--index":
+      config['index'] = value
+    elif opt == "--output-dir":
+      config['outputDir'] = value
+    elif opt in ('-t', "--threads"):
+      nThreads = int(value)
+    elif opt in ('-j', "--jobs"):
+      nJobs = int(value)
+    elif opt == "--bowtie-threads":
+      config['bowtieThreads'] = int(value)
+    elif opt == "--bowtie-options":
+      config['bowtieOptions'] = shlex.split(value)
+    elif opt == "--stream":
+      config['stream'] = True
+    elif opt == "--pipe":
+      config['pipe'] = True
+    elif opt == "--keep-bam":
+      config['keepBam'] = True
+    elif opt == "--rmdup":
+      config['rmdup'] = True
+    elif opt in ('-r', "--randomize"):
+      config['randomize'] = True
+    elif opt == "--seed":
+      config['seed'] = int(value)
+    elif opt == "--layout":
+      config['chromLayout'] = libPipeline.loadChromLayout(value)
+    elif opt == "--format":
+      if value not in libPipeline.COUNTS_FORMATS:
+        print >> sys.stderr, "Error: unknown format %s" % value
+        sys.exit(1)
+      config['countsFormat'] = value
+    elif opt in ('-o', "--offset"):
+      config['offset'] = int(value)
+    elif opt == "--cache-dir":
+      cacheDir = value
+    elif opt == "--cache-size":
+      cacheBytes = int(float(value) * 2**30)
+    elif opt == "--cache-hash":
+      hashContent = True
+    elif opt == "--coverage":
+      config['coverage'] = True
+    elif opt == "--region-index":
+      config['regionIndex'] = True
+    elif opt == "--metrics":
+      config['metrics'] = True
+    elif opt == "--progress":
+      config['progress'] = float(value)
+    elif opt == "--force":
+      config['force'] = True
+    else:
+      print >> sys.stderr, "Error: unknown option %s" % opt
+      sys.exit(1)
+
+  if config['index'] is None:
+    print >> sys.stderr, "Error -- need Bowtie index (--index)"
+    sys.exit(1)
+
+  if len(args) > 0:
+    try:
+      with open(args[0], 'rb') as sheetFile:
+        samples = readSampleSheet(sheetFile)
+    except (IOError, ValueError) as e:
+      print >> sys.stderr, "Error -- could not read sample sheet: %s" % e
+      sys.exit(1)
+  else:
+    print >> sys.stderr, "Error -- need path to sample sheet"
+    sys.exit(1)
+
+  # Split threads between concurrent samples and Bowtie runs
+  nThreads = max(1, nThreads)
+  if nJobs is None:
+    nJobs = max(1, nThreads // 4)
+  if config['bowtieThreads'] is None:
+    config['bowtieThreads'] = max(1, nThreads // nJobs)
+  config['bowtieThreads'] = min(config['bowtieThreads'], nThreads)
+
+  if not os.path.isdir(config['outputDir']):
+    os.makedirs(config['outputDir'])
+
+  if cacheDir is not None:
+    config['cache'] = libPipeline.StageCache(cacheDir, cacheBytes, hashContent)
+
+  failed = runPipeline(samples, config, nThreads, nJobs)
+  if len(failed) > 0:
+    sys.exit(1)
+
+  sys.exit(0)
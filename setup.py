@@ -9,6 +9,7 @@ setup(name='illuminaPipeline',
       py_modules=['libPipeline'],
       scripts=['pipeline-gui.py', 'convertToFASTQ.py', 'parseBowtieOutput.py',
                'parseSAMOutput.py', 'readsToChromCounts.py',
-               'buildReadLengthDist.py'],
-      requires=['numpy(>=1.1)', 'wx']
+               'buildReadLengthDist.py', 'alignmentsToCounts.py',
+               'runPipeline.py', 'benchmarkPipeline.py', 'queryRegions.py'],
+      requires=['numpy(>=1.16)', 'wx']
       )
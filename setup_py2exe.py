@@ -18,7 +18,8 @@ setup(name='illuminaPipeline',
       author_email='ablocker@gmail.com',
       py_modules=['libPipeline'],
       console=['convertToFASTQ.py','parseBowtieOutput.py',
-               'readsToChromCounts.py','buildReadLengthDist.py'],
+               'readsToChromCounts.py','buildReadLengthDist.py',
+               'alignmentsToCounts.py','runPipeline.py','queryRegions.py'],
       windows=["pipeline-gui.py"],
       requires=['numpy(>=1.1)','wx'],
       data_files=data_files